@@ -0,0 +1,26 @@
+'''An asyncio-based client, which may run on uvloop'''
+
+from __future__ import absolute_import
+import asyncio
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+from .client import Client
+from .connection import Connection
+from .producer import Producer
+from .reader import Reader
+from .response import Message
+
+
+def use_uvloop():
+    '''Run asyncio on uvloop, if it's installed. Returns whether it is
+
+    This sets the event loop policy for the whole process, so it's left to
+    the application to ask for.'''
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
@@ -0,0 +1,224 @@
+'''An asyncio client for talking to NSQ'''
+
+import asyncio
+import random
+
+from .. import logger
+from ..http import nsqlookupd
+from .connection import Connection
+
+
+class Client(object):
+    '''Manages asyncio connections to nsqd instances'''
+    # The class used for our connections
+    connection_class = Connection
+
+    def __init__(self,
+        lookupd_http_addresses=None, nsqd_tcp_addresses=None, topic=None,
+        timeout=None, reconnection_backoff=None, auth_secret=None,
+        check_interval=30, check_jitter=0.1, connections_per_nsqd=1,
+        drain_timeout=60, **identify):
+        # If lookupd_http_addresses are provided, so must a topic be.
+        if lookupd_http_addresses:
+            assert topic
+
+        # Create clients for each of lookupd instances
+        lookupd_http_addresses = lookupd_http_addresses or []
+        params = {}
+        if auth_secret:
+            params['access_token'] = auth_secret
+        self._lookupd = [
+            nsqlookupd.Client(host, **params) for host in lookupd_http_addresses]
+        self._topic = topic
+
+        # The connection timeout and reconnection backoff for connections
+        self._timeout = timeout
+        self._reconnection_backoff = reconnection_backoff
+        # How often we check on our connections once started, varied by up to
+        # check_jitter of that so that many clients don't stay in lockstep
+        self._check_interval = check_interval
+        self._check_jitter = check_jitter
+        # Connections to nsqd instances that lookupd no longer knows about, and
+        # the tasks draining them for up to drain_timeout before closing them
+        self._drain_timeout = drain_timeout
+        self._retiring = {}
+
+        # The options to send along with identify when establishing connections
+        self._identify_options = identify
+        self._auth_secret = auth_secret
+        # A mapping of (host, port, index) to our nsqd connection objects, with
+        # connections_per_nsqd connections to each
+        self._connections = {}
+        self._connections_per_nsqd = connections_per_nsqd
+        self._nsqd_tcp_addresses = nsqd_tcp_addresses or []
+        # The task that periodically checks our connections
+        self._checker = None
+
+    async def start(self):
+        '''Connect, and then keep checking our connections in the background'''
+        await self.check_connections()
+        self._checker = asyncio.ensure_future(self._check_periodically())
+        return self
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, typ, value, trace):
+        await self.close()
+
+    async def _check_periodically(self):
+        '''Check our connections every check interval'''
+        while True:
+            await asyncio.sleep(self._check_interval * random.uniform(
+                1 - self._check_jitter, 1 + self._check_jitter))
+            try:
+                await self.check_connections()
+            except Exception:
+                logger.exception('Failed to check connections')
+
+    async def discover(self, topic):
+        '''Run the discovery mechanism, returning (host, port) of producers'''
+        producers, _ = await self._discover(topic)
+        return producers
+
+    async def _discover(self, topic):
+        '''Returns the (host, port) of producers, and whether every lookupd
+        could be queried'''
+        logger.info('Discovering on topic %s', topic)
+        # The lookupd clients block, so they're queried in the default executor
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(None, lookupd.lookup, topic)
+            for lookupd in self._lookupd], return_exceptions=True)
+
+        producers = []
+        complete = True
+        for lookupd, result in zip(self._lookupd, results):
+            if isinstance(result, Exception):
+                logger.error('Failed to query %s: %s', lookupd, result)
+                complete = False
+                continue
+            for producer in result['producers']:
+                logger.info('Found producer %s on %s', producer, lookupd)
+                producers.append(
+                    (producer['broadcast_address'], producer['tcp_port']))
+        return producers, complete
+
+    async def check_connections(self):
+        '''Connect to all the appropriate instances'''
+        logger.info('Checking connections')
+        addresses = []
+        complete = True
+        if self._lookupd:
+            producers, complete = await self._discover(self._topic)
+            addresses.extend(producers)
+        for hostspec in self._nsqd_tcp_addresses:
+            host, port = hostspec.split(':')
+            addresses.append((host, int(port)))
+
+        # Retire connections to anything that's disappeared from discovery,
+        # unless we can't be sure because a lookupd failed to answer
+        if self._lookupd and complete:
+            keep = set(addresses)
+            for key, conn in list(self._connections.items()):
+                if key[:2] not in keep and conn not in self._retiring:
+                    logger.info('%s is no longer in discovery', conn)
+                    self._retiring[conn] = asyncio.ensure_future(
+                        self.retire(conn))
+
+        # Connect to every address we're not already connected to, as long as
+        # we're not backing off from it
+        pending = []
+        for host, port in set(addresses):
+            for index in range(self._connections_per_nsqd):
+                conn = self._connections.get((host, port, index))
+                if conn is None:
+                    logger.info('Connecting to %s:%s', host, port)
+                    pending.append(self.connect(host, port, index))
+                elif not conn.alive() and conn.ready_to_reconnect():
+                    logger.info('Reconnecting to %s:%s', host, port)
+                    pending.append(self.connect(host, port, index))
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def connect(self, host, port, index=0):
+        '''Connect to the provided host, port (with our index-th connection)'''
+        conn = self._connections.get((host, port, index))
+        if conn is None:
+            conn = self.connection_class(host, port,
+                timeout=self._timeout,
+                reconnection_backoff=self._reconnection_backoff,
+                auth_secret=self._auth_secret,
+                on_message=self.received,
+                on_close=self.closed,
+                **self._identify_options)
+            self._connections[(host, port, index)] = conn
+        if await conn.connect():
+            await self.connected(conn)
+            return conn
+        return None
+
+    async def retire(self, conn):
+        '''Stop using a connection, closing it once nothing is in flight'''
+        self._retiring.setdefault(conn, None)
+        try:
+            if conn.alive():
+                self.retiring(conn)
+            deadline = asyncio.get_running_loop().time() + self._drain_timeout
+            while conn.alive() and not self.drained(conn):
+                if asyncio.get_running_loop().time() >= deadline:
+                    logger.warning('Timed out draining %s', conn)
+                    break
+                await asyncio.sleep(0.1)
+            logger.info('Closing retired %s', conn)
+            if conn.alive():
+                timeout = self._timeout if self._timeout is not None else 1.0
+                try:
+                    await asyncio.wait_for(conn.cls(), timeout)
+                except Exception as exc:
+                    logger.warning('Failed to send CLS to %s: %s', conn, exc)
+            for key, found in list(self._connections.items()):
+                if found is conn:
+                    del self._connections[key]
+            await conn.close()
+        finally:
+            self._retiring.pop(conn, None)
+
+    def retiring(self, conn):
+        '''Hook into when a connection starts being retired'''
+
+    def drained(self, conn):
+        '''Whether a retiring connection has nothing left in flight'''
+        return conn.waiting() == 0
+
+    def active_connections(self):
+        '''Our living connections, less any that are being retired'''
+        return [conn for conn in self.connections()
+            if conn.alive() and conn not in self._retiring]
+
+    async def connected(self, conn):
+        '''Hook into when a connection has been established'''
+
+    def closed(self, conn):
+        '''Hook into when a connection has been lost'''
+
+    def received(self, message):
+        '''Hook into when a message has been received'''
+        logger.warning('Dropping unexpected message %s', message)
+
+    def connections(self):
+        '''Return a list of all our connections'''
+        return list(self._connections.values())
+
+    async def close(self):
+        '''Close this client down'''
+        if self._checker is not None:
+            self._checker.cancel()
+            self._checker = None
+        retiring = list(self._retiring)
+        for task in self._retiring.values():
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(
+            *[conn.close() for conn in set(self.connections() + retiring)],
+            return_exceptions=True)
@@ -0,0 +1,363 @@
+'''A connection to nsqd as an asyncio protocol'''
+
+import asyncio
+import socket
+import sys
+from collections import deque
+
+from .. import backoff
+from .. import commands
+from .. import constants
+from .. import logger
+from .. import util
+from .. import json
+from .. import __version__
+from ..decoder import FrameDecoder
+from ..exceptions import (
+    NSQException, UnsupportedException, ConnectionClosedException,
+    FinFailedException, ReqFailedException, TouchFailedException)
+from ..response import Response, Error
+from .response import Message
+
+
+class Connection(asyncio.Protocol):
+    '''A connection to nsqd built on asyncio's transports
+
+    Responses are matched to the commands awaiting them in the order in which
+    those commands were sent. Messages are passed to on_message as they arrive,
+    and on_close is invoked with this connection when it's lost.'''
+    # Default user agent
+    USER_AGENT = 'nsq-py/%s' % __version__
+    # Errors that nsqd sends without closing the connection. They aren't the
+    # response to any command, since FIN, REQ and TOUCH don't get responses.
+    NONFATAL = (FinFailedException, ReqFailedException, TouchFailedException)
+
+    def __init__(self, host, port, timeout=None, reconnection_backoff=None,
+        auth_secret=None, on_message=None, on_close=None, **identify):
+        # TLS and compression would have to wrap the transport
+        for key in ('tls_v1', 'snappy', 'deflate'):
+            if identify.get(key, False):
+                raise UnsupportedException('Option %s is not supported' % key)
+
+        self.host = host
+        self.port = port
+        self._timeout = timeout if timeout is not None else 1.0
+        self._on_message = on_message
+        self._on_close = on_close
+
+        # The options to use when identifying
+        self._identify_options = dict(identify)
+        self._identify_options.setdefault('hostname', socket.gethostname())
+        self._identify_options.setdefault('client_id', socket.getfqdn().split('.')[0])
+        self._identify_options.setdefault('feature_negotiation', True)
+        self._identify_options.setdefault('user_agent', self.USER_AGENT)
+
+        # In support of auth
+        self._auth_secret = auth_secret
+
+        # Our backoff policy for reconnection, the same as for Connection
+        self._reconnection_backoff = (
+            reconnection_backoff or
+            backoff.Clamped(backoff.Exponential(2, 8), maximum=60))
+        self._reconnnection_counter = backoff.ResettingAttemptCounter(
+            self._reconnection_backoff)
+
+        # Some settings that may be determined by an identify response
+        self.max_rdy_count = sys.maxsize
+        self.msg_timeout = None
+        # Notified when messages are finished or requeued
+        self._listener = None
+        self._reset()
+
+    def _reset(self):
+        '''Reset all of our stateful variables'''
+        self._transport = None
+        self._decoder = FrameDecoder()
+        # Futures for the responses to the commands we've sent, in order
+        self._waiters = deque()
+        # Whether the transport has asked us to stop writing, and the futures
+        # waiting for it to resume
+        self._paused = False
+        self._drainers = deque()
+        # Resolved when the transport has been closed
+        self._closed = None
+        # The identify response we last received from the server
+        self._identify_response = {}
+        # The last ready count sent, and what's left of it
+        self.ready = 0
+        self.last_ready_sent = 0
+        # How many messages we've received but not yet finished or requeued,
+        # and how many we've received in all
+        self.in_flight = 0
+        self.received = 0
+
+    def __str__(self):
+        state = 'alive' if self.alive() else 'dead'
+        return '<asyncio.Connection %s:%s (%s)>' % (self.host, self.port, state)
+
+    def alive(self):
+        '''Returns True if this connection is alive'''
+        return self._transport is not None and not self._transport.is_closing()
+
+    def waiting(self):
+        '''How many commands are waiting on a response'''
+        return len(self._waiters)
+
+    def saturated(self):
+        '''Whether the transport has asked us to stop writing'''
+        return self._paused
+
+    def pending_bytes(self):
+        '''How many bytes are buffered in the transport, waiting to be sent'''
+        if self._transport is None:
+            return 0
+        return self._transport.get_write_buffer_size()
+
+    def ready_to_reconnect(self):
+        '''Returns True if enough time has passed to attempt a reconnection'''
+        return self._reconnnection_counter.ready()
+
+    async def connect(self):
+        '''Establish and identify this connection. Returns True on success'''
+        if self.alive():
+            return True
+
+        self._reset()
+        try:
+            logger.info('Connecting to %s, %s', self.host, self.port)
+            await self._open()
+            self.identified(await asyncio.wait_for(
+                self.identify(self._identify_options), self._timeout))
+            # Now is the appropriate time to send auth
+            if self._identify_response.get('auth_required', False):
+                await asyncio.wait_for(
+                    self.auth(self._auth_secret), self._timeout)
+            self._reconnnection_counter.success()
+            return True
+        except Exception:
+            logger.exception('Failed to connect')
+            await self.close()
+            self._reconnnection_counter.failed()
+            return False
+
+    async def _open(self):
+        '''Open the transport, which then invokes connection_made'''
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(
+            loop.create_connection(lambda: self, self.host, self.port),
+            self._timeout)
+
+    async def close(self):
+        '''Close our connection'''
+        if self._transport is not None:
+            self._transport.close()
+        if self._closed is not None:
+            await self._closed
+
+    def identified(self, res):
+        '''Handle a response to our 'identify' command. Returns response'''
+        try:
+            res.data = json.loads(res.data)
+            self._identify_response = res.data
+            logger.info('Got identify response: %s', res.data)
+        except:
+            logger.warning('Server does not support feature negotiation')
+            self._identify_response = {}
+
+        # Save our max ready count unless it's not provided
+        self.max_rdy_count = self._identify_response.get(
+            'max_rdy_count', self.max_rdy_count)
+        # The server's message timeout, in seconds
+        msg_timeout = self._identify_response.get('msg_timeout')
+        if msg_timeout:
+            self.msg_timeout = msg_timeout / 1000.0
+
+        if self._identify_response.get('auth_required', False):
+            if not self._auth_secret:
+                raise UnsupportedException('Auth required but not provided')
+            logger.warning('Using AUTH without TLS')
+        elif self._auth_secret:
+            logger.warning('Authentication secret provided but not required')
+        return res
+
+    def connection_made(self, transport):
+        '''Send our magic as soon as we're connected'''
+        self._transport = transport
+        self._closed = asyncio.get_running_loop().create_future()
+        self._write(constants.MAGIC_V2)
+
+    def connection_lost(self, exc):
+        '''Fail everything still waiting on this connection'''
+        self._transport = None
+        error = ConnectionClosedException(exc or 'Connection closed')
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_exception(error)
+        self._wake(error)
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def pause_writing(self):
+        '''The transport's buffer is over its high water mark'''
+        self._paused = True
+
+    def resume_writing(self):
+        '''The transport's buffer has drained below its low water mark'''
+        self._paused = False
+        self._wake()
+
+    def _wake(self, exc=None):
+        '''Release everything waiting to write'''
+        while self._drainers:
+            future = self._drainers.popleft()
+            if not future.done():
+                if exc is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(exc)
+
+    async def drain(self):
+        '''Wait until the transport is ready to accept more data'''
+        if self._transport is None:
+            raise ConnectionClosedException()
+        if self._paused:
+            future = asyncio.get_running_loop().create_future()
+            self._drainers.append(future)
+            await future
+
+    def data_received(self, data):
+        '''Decode and dispatch whatever frames are complete'''
+        self._decoder.feed(data)
+        self._decoded()
+
+    def _decoded(self):
+        '''Dispatch the frames that have been completed in our decoder'''
+        frames, messages = self._decoder.decode()
+        self.ready -= messages
+        self.in_flight += messages
+        self.received += messages
+        for frame_type, frame in frames:
+            self._received(frame_type, frame)
+
+    def _received(self, frame_type, data):
+        '''Handle a single frame'''
+        if frame_type == constants.FRAME_TYPE_MESSAGE:
+            if self._on_message is not None:
+                self._on_message(Message(self, frame_type, data))
+            return
+
+        res = Response.from_frame(self, frame_type, data)
+        if isinstance(res, Error):
+            try:
+                exc = res.exception()
+            except TypeError:
+                exc = NSQException(res.data)
+            if isinstance(exc, self.NONFATAL):
+                logger.warning('Received non-fatal error %s on %s', exc, self)
+                return
+            self._respond(res, exc)
+        elif res.data == constants.HEARTBEAT:
+            logger.info('Sending heartbeat to %s', self)
+            self.nop()
+        else:
+            self._respond(res)
+
+    def _respond(self, res, exc=None):
+        '''Resolve the oldest command waiting on a response'''
+        if not self._waiters:
+            logger.warning('Unexpected %s on %s', res, self)
+            return
+        future = self._waiters.popleft()
+        # A waiter that's timed out is cancelled, but still takes its response
+        if not future.done():
+            if exc is None:
+                future.set_result(res)
+            else:
+                future.set_exception(exc)
+
+    def _write(self, data):
+        '''Send data that's already been encoded'''
+        if self._transport is None:
+            raise ConnectionClosedException()
+        self._transport.write(data)
+
+    def send(self, command, message=None):
+        '''Send a command, returning a future for its response'''
+        if message:
+            joined = command + constants.NL + util.pack(message)
+        else:
+            joined = command + constants.NL
+        self._write(joined)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        return future
+
+    def identify(self, data):
+        '''Send an identification message'''
+        return self.send(constants.IDENTIFY, json.dumps(data).encode('UTF-8'))
+
+    def auth(self, secret):
+        '''Send an auth secret'''
+        return self.send(constants.AUTH, secret)
+
+    def sub(self, topic, channel):
+        '''Subscribe to a topic/channel'''
+        return self.send(b' '.join((constants.SUB, topic, channel)))
+
+    def pub(self, topic, message):
+        '''Publish to a topic'''
+        return self.send(b' '.join((constants.PUB, topic)), message)
+
+    def mpub(self, topic, *messages):
+        '''Publish multiple messages to a topic'''
+        return self.send(constants.MPUB + b' ' + topic, messages)
+
+    def dpub(self, topic, delay, message):
+        '''Publish to a topic, deferred by delay milliseconds'''
+        return self.send(
+            b' '.join((constants.DPUB, topic, commands.integer(delay))), message)
+
+    def cls(self):
+        '''Close the connection cleanly'''
+        return self.send(constants.CLS)
+
+    def rdy(self, count):
+        '''Indicate that you're ready to receive'''
+        self.ready = count
+        self.last_ready_sent = count
+        self._write(commands.rdy(count))
+
+    def nop(self):
+        '''Send a no-op'''
+        self._write(constants.NOP + constants.NL)
+
+    def listen(self, callback):
+        '''Invoke callback(connection, count, finished) when count messages are
+        finished (or requeued, if not finished)'''
+        self._listener = callback
+
+    def _landed(self, count, finished):
+        '''Account for count messages no longer being in flight'''
+        self.in_flight = max(0, self.in_flight - count)
+        if self._listener is not None:
+            self._listener(self, count, finished)
+
+    async def fin(self, message_id):
+        '''Indicate that you've finished a message ID'''
+        self._write(commands.fin(message_id))
+        self._landed(1, True)
+        await self.drain()
+
+    async def req(self, message_id, timeout):
+        '''Re-queue a message'''
+        self._write(commands.req(message_id, timeout))
+        self._landed(1, False)
+        await self.drain()
+
+    async def touch(self, message_id):
+        '''Reset the timeout for an in-flight message'''
+        self._write(commands.touch(message_id))
+        await self.drain()
@@ -0,0 +1,60 @@
+'''An asyncio client for publishing'''
+
+import time
+
+from .. import routing
+from .client import Client
+
+
+class Producer(Client):
+    '''Publish messages, awaiting nsqd's confirmation of each
+
+    The connection for each publish is chosen by the router, a Router from
+    nsq.routing or the name of one.'''
+    def __init__(self, nsqd_tcp_addresses=None, lookupd_http_addresses=None,
+        topic=None, router=None, **kwargs):
+        self._router = routing.get(router)
+        Client.__init__(
+            self, lookupd_http_addresses, nsqd_tcp_addresses, topic, **kwargs)
+
+    async def connected(self, conn):
+        '''Start routing publishes to a connection'''
+        self._router.add(conn)
+
+    def retiring(self, conn):
+        '''Stop routing publishes to a connection that's being retired'''
+        self._router.remove(conn)
+
+    def closed(self, conn):
+        '''Stop routing publishes to a connection'''
+        self._router.remove(conn)
+
+    def random_connection(self, key=None):
+        '''Pick a living connection with our router'''
+        while True:
+            conn = self._router.choose(key)
+            if conn.alive():
+                return conn
+            self._router.remove(conn)
+
+    async def _publish(self, conn, pending):
+        '''Await a publish, telling our router how long it took'''
+        start = time.time()
+        res = await pending
+        self._router.acked(conn, time.time() - start)
+        return res.data
+
+    async def pub(self, topic, message, key=None):
+        '''Publish the provided message to the provided topic'''
+        conn = self.random_connection(key)
+        return await self._publish(conn, conn.pub(topic, message))
+
+    async def mpub(self, topic, *messages, key=None):
+        '''Publish messages to a topic'''
+        conn = self.random_connection(key)
+        return await self._publish(conn, conn.mpub(topic, *messages))
+
+    async def dpub(self, topic, delay, message, key=None):
+        '''Publish a message to a topic, deferred by delay milliseconds'''
+        conn = self.random_connection(key)
+        return await self._publish(conn, conn.dpub(topic, delay, message))
@@ -0,0 +1,139 @@
+'''An asyncio client meant exclusively for reading'''
+
+import asyncio
+
+from .. import logger
+from ..backoff import Throttle
+from ..ready import Allocator
+from .client import Client
+
+
+class Reader(Client):
+    '''Consume a topic and channel with `async for message in reader`'''
+    def __init__(self, topic, channel, lookupd_http_addresses=None,
+        nsqd_tcp_addresses=None, max_in_flight=200, ready_window=10.0,
+        ready_rotation=5.0, backoff=None, **kwargs):
+        self._channel = channel
+        self._max_in_flight = max_in_flight
+        # Splits max_in_flight among connections by their recent throughput,
+        # or rotates it every ready_rotation seconds if they outnumber it
+        self._allocator = Allocator(ready_window, ready_rotation)
+        # Stops RDY while messages are being requeued, for durations from the
+        # backoff policy (or the default one, if it's True). Off unless asked
+        # for, since a requeue may be deliberate rather than a failure
+        self.throttle = None
+        if backoff:
+            self.throttle = Throttle(None if backoff is True else backoff)
+        # Messages that have been received, but not yet iterated over. The
+        # number of these is bounded by max_in_flight. The queue is made once
+        # it's first used, so that it belongs to the loop we're running in
+        self._queue = None
+        self._closing = False
+        Client.__init__(
+            self, lookupd_http_addresses, nsqd_tcp_addresses, topic, **kwargs)
+
+    @property
+    def _messages(self):
+        '''The queue of messages waiting to be iterated over'''
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def connected(self, conn):
+        '''Subscribe connection and manipulate its RDY state'''
+        conn.listen(self.landed)
+        await conn.sub(self._topic, self._channel)
+        self.distribute_ready()
+
+    def landed(self, conn, count, finished):
+        '''Back off as messages are requeued, and ramp up as they're finished'''
+        if self.throttle is None:
+            return
+        if finished:
+            changed = self.throttle.succeeded()
+        elif self.throttle.failed():
+            # Let a test message through once the backoff is over
+            asyncio.get_event_loop().call_later(
+                self.throttle.remaining(), self._backoff_ended)
+            changed = True
+        else:
+            changed = False
+        if changed:
+            logger.info('Throttled to %i in flight',
+                self.throttle.max_in_flight(self._max_in_flight))
+            self.distribute_ready()
+
+    def _backoff_ended(self):
+        '''Redistribute the ready state when a backoff has ended'''
+        if not self._closing and self.throttle.ended():
+            self.distribute_ready()
+
+    def closed(self, conn):
+        '''Redistribute the ready state among the remaining connections'''
+        if not self._closing:
+            self.distribute_ready()
+
+    def retiring(self, conn):
+        '''Stop receiving messages on a connection that's being retired'''
+        conn.rdy(0)
+        self.distribute_ready()
+
+    def drained(self, conn):
+        '''Whether every message received on a connection has been handled'''
+        return conn.in_flight <= 0
+
+    def received(self, message):
+        '''Queue up a message to be iterated over'''
+        self._messages.put_nowait(message)
+        # Redistribute our ready state if necessary
+        if self.needs_distribute_ready():
+            self.distribute_ready()
+
+    def distribute_ready(self):
+        '''Distribute the ready state across all of the connections'''
+        # Weight the ready count by where messages have been coming from, or
+        # rotate it if there are more connections than max_in_flight
+        total = self._max_in_flight
+        if self.throttle is not None:
+            total = self.throttle.max_in_flight(total)
+        connections = self.active_connections()
+        for count, conn in self._allocator.plan(total, connections):
+            logger.info('Sending RDY %i to %s', count, conn)
+            conn.rdy(count)
+
+    def set_depth(self, host, port, depth):
+        '''Tell us how many messages are waiting for us on an nsqd'''
+        self._allocator.set_depth(host, port, depth)
+
+    def needs_distribute_ready(self):
+        '''Determine whether or not we need to redistribute the ready state'''
+        alive = self.active_connections()
+        if any(
+            c.last_ready_sent and c.ready <= (c.last_ready_sent * 0.25)
+            for c in alive):
+            return True
+        # Otherwise, rebalance every so often as throughput shifts
+        return bool(alive) and self._allocator.due()
+
+    async def close(self):
+        '''Stop receiving messages, and close our connections'''
+        self._closing = True
+        timeout = self._timeout if self._timeout is not None else 1.0
+        await asyncio.gather(*[
+            asyncio.wait_for(conn.cls(), timeout)
+            for conn in self.connections() if conn.alive()],
+            return_exceptions=True)
+        await Client.close(self)
+        # Wake up anything still iterating
+        self._messages.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._messages.get()
+        if message is None:
+            # Make sure every other iterator sees that we've closed, too
+            self._messages.put_nowait(None)
+            raise StopAsyncIteration
+        return message
@@ -0,0 +1,45 @@
+'''Messages whose fin, req and touch may be awaited'''
+
+from contextlib import asynccontextmanager
+
+from .. import response
+from ..exceptions import ConnectionClosedException
+
+
+class Message(response.Message):
+    '''A message received over an asyncio connection'''
+    __slots__ = ()
+
+    async def fin(self):
+        '''Indicate that this message is finished processing'''
+        await self.connection.fin(self.id)
+        self.processed = True
+
+    async def req(self, timeout):
+        '''Re-queue a message'''
+        await self.connection.req(self.id, timeout)
+        self.processed = True
+
+    async def touch(self):
+        '''Reset the timeout for an in-flight message'''
+        await self.connection.touch(self.id)
+
+    @asynccontextmanager
+    async def handle(self):
+        '''Make sure this message gets either 'fin' or 'req'd'''
+        try:
+            yield self
+        except:
+            # Requeue the message and raise the original exception
+            if not self.processed:
+                try:
+                    await self.req(self.delay())
+                except ConnectionClosedException:
+                    pass
+            raise
+        else:
+            if not self.processed:
+                try:
+                    await self.fin()
+                except ConnectionClosedException:
+                    pass
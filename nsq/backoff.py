@@ -1,6 +1,7 @@
 '''Classes that know about backoffs'''
 
 import sys
+import threading
 import time
 
 
@@ -100,3 +101,85 @@ class DecrementingAttemptCounter(AttemptCounter):
     def success(self):
         AttemptCounter.success(self)
         self.attempts = max(0, self.attempts - 1)
+
+
+class Throttle(object):
+    '''Slow a reader down while its handlers are failing
+
+    A failure (a message being requeued) stops all RDY for the backoff of
+    however many failures there have been. Then a single message is let
+    through to test the water. Each success takes a failure away, doubling
+    how many messages may be in flight until it's back to all of them, and
+    each failure starts another backoff. Outcomes during a backoff are from
+    messages received before it started, and are ignored.'''
+    def __init__(self, backoff=None):
+        self._counter = DecrementingAttemptCounter(
+            backoff or Clamped(Exponential(2, 0.5), maximum=60))
+        self._lock = threading.Lock()
+        # When the current (or last) backoff started and ends, whether its
+        # test message has succeeded, and whether its end has been noticed
+        self._since = None
+        self._until = None
+        self._tested = False
+        self._ended = True
+        # How many times we've backed off, and for how long in all
+        self.backoffs = 0
+        self._backoff_time = 0.0
+
+    def failed(self):
+        '''A message was requeued. Returns whether a backoff started'''
+        with self._lock:
+            now = time.time()
+            if self._until is not None and now < self._until:
+                return False
+            if self._since is not None:
+                self._backoff_time += self._until - self._since
+            self._counter.failed()
+            self._since = now
+            self._until = now + self._counter.backoff()
+            self._tested = False
+            self._ended = False
+            self.backoffs += 1
+            return True
+
+    def succeeded(self):
+        '''A message was finished. Returns whether more may now be in flight'''
+        with self._lock:
+            if not self._counter.attempts or time.time() < self._until:
+                return False
+            self._counter.success()
+            self._tested = True
+            return True
+
+    def remaining(self):
+        '''How many seconds are left of the current backoff'''
+        with self._lock:
+            if self._until is None:
+                return 0
+            return max(0, self._until - time.time())
+
+    def ended(self):
+        '''Whether a backoff has ended since this was last asked'''
+        with self._lock:
+            if self._ended or time.time() < self._until:
+                return False
+            self._ended = True
+            return True
+
+    def max_in_flight(self, total):
+        '''How many of total messages may be in flight right now'''
+        with self._lock:
+            if not self._counter.attempts:
+                return total
+            if time.time() < self._until:
+                return 0
+            if not self._tested:
+                return 1
+            return max(1, total >> self._counter.attempts)
+
+    def backoff_time(self):
+        '''How many seconds all RDY has been stopped for, in all'''
+        with self._lock:
+            if self._since is None:
+                return self._backoff_time
+            return self._backoff_time + min(time.time(), self._until) - self._since
@@ -1,5 +1,6 @@
 '''A class that checks connections'''
 
+import random
 import time
 import threading
 from . import logger
@@ -30,12 +31,18 @@ class PeriodicThread(StoppableThread):
         self._args = args
         self._kwargs = kwargs
         self._last_checked = None
+        # The interval may vary by up to this fraction, so that many threads
+        # started at once don't stay in lockstep
+        self._jitter = 0
 
     def delay(self):
         '''How long to wait before the next check'''
+        interval = self._interval
+        if self._jitter:
+            interval *= random.uniform(1 - self._jitter, 1 + self._jitter)
         if self._last_checked:
-            return self._interval - (time.time() - self._last_checked)
-        return self._interval
+            return interval - (time.time() - self._last_checked)
+        return interval
 
     def callback(self):
         '''Run the callback'''
@@ -54,5 +61,6 @@ class PeriodicThread(StoppableThread):
 
 class ConnectionChecker(PeriodicThread):
     '''A thread that checks the connections on an object'''
-    def __init__(self, client, interval=60):
+    def __init__(self, client, interval=60, jitter=0.1):
         PeriodicThread.__init__(self, interval, client.check_connections)
+        self._jitter = jitter
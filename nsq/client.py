@@ -3,14 +3,23 @@
 from . import connection
 from . import logger
 from . import exceptions
+from . import routing
 from .constants import HEARTBEAT
 from .response import Response, Error
 from .http import nsqlookupd, ClientException
 from .checker import ConnectionChecker
 
 from contextlib import contextmanager
-import random
+import functools
 import select
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    selectors = None
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
 import socket
 import time
 import threading
@@ -21,7 +30,9 @@ class Client(object):
     '''A client for talking to NSQ over a connection'''
     def __init__(self,
         lookupd_http_addresses=None, nsqd_tcp_addresses=None, topic=None,
-        timeout=0.1, reconnection_backoff=None, auth_secret=None, connect_timeout=None, **identify):
+        timeout=0.1, reconnection_backoff=None, auth_secret=None, connect_timeout=None,
+        selector=None, router=None, connections_per_nsqd=1, discovery_ttl=0,
+        discovery_workers=8, drain_timeout=60, **identify):
         # If lookupd_http_addresses are provided, so must a topic be.
         if lookupd_http_addresses:
             assert topic
@@ -34,6 +45,22 @@ class Client(object):
         self._lookupd = [
             nsqlookupd.Client(host, **params) for host in lookupd_http_addresses]
         self._topic = topic
+        # Each lookupd's most recent results for a topic, and when they expire
+        self._discovery_ttl = discovery_ttl
+        self._discovery_cache = {}
+        # How long the last discovery took, and how long each lookupd took to
+        # respond (None if its results were cached, or it failed)
+        self.discovery_latency = None
+        self.lookupd_latency = {}
+        # Connections to nsqd instances that lookupd no longer knows about are
+        # drained before being closed, for up to drain_timeout seconds
+        self._drain_timeout = drain_timeout
+        self._retiring = {}
+        # Lookupd queries and connecting to what's discovered are done in
+        # parallel, as long as concurrent.futures is available
+        self._executor = None
+        if ThreadPoolExecutor is not None and discovery_workers:
+            self._executor = ThreadPoolExecutor(max_workers=discovery_workers)
 
         # The select timeout
         self._timeout = timeout
@@ -45,52 +72,173 @@ class Client(object):
         # The options to send along with identify when establishing connections
         self._identify_options = identify
         self._auth_secret = auth_secret
-        # A mapping of (host, port) to our nsqd connection objects
+        # A mapping of (host, port, index) to our nsqd connection objects. A
+        # busy nsqd may be given several connections to spread work across
         self._connections = {}
+        self._connections_per_nsqd = connections_per_nsqd
 
         self._nsqd_tcp_addresses = nsqd_tcp_addresses or []
         self.heartbeat_interval = 30 * 1000
         self.last_recv_timestamp = time.time()
         # A lock for manipulating our connections
         self._lock = threading.RLock()
+        # Chooses which living connection to publish on. Either a Router, or
+        # the name of one ('random', 'round_robin', 'least_pending', 'latency'
+        # or 'consistent_hash')
+        self._router = routing.get(router)
+
+        # Rather than select over every connection on every read, connections
+        # may be registered once with a selector (epoll, kqueue, etc.). Pass
+        # True to use the best one available, or a selector instance.
+        self._selector = None
+        # Whether the selector and wakeup sockets are ours to close, rather
+        # than shared with other clients
+        self._owns_selector = True
+        # Used to wake up whatever we're waiting on, if there's a need to
+        self._wakeup_reader = self._wakeup_writer = None
+        self._selecting = False
+        if selector:
+            if selectors is None:  # pragma: no cover
+                raise exceptions.UnsupportedException(
+                    'The selectors module is not available')
+            self._use_selector(
+                selectors.DefaultSelector() if selector is True else selector)
+
         # And lastly, instantiate our connections
         self.check_connections()
 
     def discover(self, topic):
         '''Run the discovery mechanism'''
         logger.info('Discovering on topic %s', topic)
+        start = time.time()
+        # Query each lookupd at once, keeping the first of any duplicates
         producers = []
-        for lookupd in self._lookupd:
-            logger.info('Discovering on %s', lookupd)
-            try:
-                # Find all the current producers on this instance
-                for producer in lookupd.lookup(topic)['producers']:
-                    logger.info('Found producer %s on %s', producer, lookupd)
-                    producers.append(
-                        (producer['broadcast_address'], producer['tcp_port']))
-            except ClientException:
-                logger.exception('Failed to query %s', lookupd)
-
-        new = []
+        complete = True
+        for found in self._map(
+            functools.partial(self._lookup, topic), self._lookupd):
+            if found is None:
+                complete = False
+                continue
+            for producer in found:
+                if producer not in producers:
+                    producers.append(producer)
+
+        # Retire connections to anything that's disappeared, unless we can't
+        # be sure because a lookupd failed to answer
+        if complete:
+            keep = set(producers)
+            for hostspec in self._nsqd_tcp_addresses:
+                host, port = hostspec.split(':')
+                keep.add((host, int(port)))
+            with self._lock:
+                gone = [conn for key, conn in self._connections.items()
+                    if key[:2] not in keep and conn not in self._retiring]
+            for conn in gone:
+                logger.info('%s is no longer in discovery', conn)
+                self.retire(conn)
+
+        connect = []
         for host, port in producers:
-            conn = self._connections.get((host, port))
-            if not conn:
-                logger.info('Discovered %s:%s', host, port)
-                new.append(self.connect(host, port))
-            elif not conn.alive():
-                logger.info('Reconnecting to %s:%s', host, port)
-                if conn.connect():
-                    conn.setblocking(0)
-                    self.reconnected(conn)
-            else:
-                logger.debug('Connection to %s:%s still alive', host, port)
+            for index in range(self._connections_per_nsqd):
+                conn = self._connections.get((host, port, index))
+                if not conn:
+                    logger.info('Discovered %s:%s', host, port)
+                    connect.append(functools.partial(self.connect, host, port))
+                elif not conn.alive():
+                    logger.info('Reconnecting to %s:%s', host, port)
+                    connect.append(functools.partial(self._reconnect, conn))
+                else:
+                    logger.debug('Connection to %s:%s still alive', host, port)
+        new = self._map(lambda function: function(), connect)
 
+        self.discovery_latency = time.time() - start
+        logger.info('Discovery on topic %s took %fs', topic, self.discovery_latency)
         # And return all the new connections
         return [conn for conn in new if conn]
 
+    def _lookup(self, topic, lookupd):
+        '''The (host, port) of each producer of a topic known to a lookupd
+
+        Returns None if the lookupd couldn't be queried.'''
+        key = (str(lookupd), topic)
+        cached = self._discovery_cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            logger.debug('Using cached producers from %s', lookupd)
+            self.lookupd_latency[str(lookupd)] = None
+            return cached[1]
+
+        logger.info('Discovering on %s', lookupd)
+        start = time.time()
+        producers = []
+        try:
+            # Find all the current producers on this instance
+            for producer in lookupd.lookup(topic)['producers']:
+                logger.info('Found producer %s on %s', producer, lookupd)
+                producers.append(
+                    (producer['broadcast_address'], producer['tcp_port']))
+        except ClientException:
+            logger.exception('Failed to query %s', lookupd)
+            self.lookupd_latency[str(lookupd)] = None
+            return None
+        self.lookupd_latency[str(lookupd)] = time.time() - start
+        if self._discovery_ttl:
+            self._discovery_cache[key] = (
+                time.time() + self._discovery_ttl, producers)
+        return producers
+
+    def _map(self, function, items):
+        '''Apply function to each of items, in parallel if we can'''
+        items = list(items)
+        if self._executor is None or len(items) < 2:
+            return [function(item) for item in items]
+        return list(self._executor.map(function, items))
+
+    def retire(self, conn):
+        '''Stop using a connection, closing it once nothing is in flight'''
+        self._router.remove(conn)
+        with self._lock:
+            self._retiring[conn] = time.time() + self._drain_timeout
+        if conn.alive():
+            self.retiring(conn)
+        self.reap()
+
+    def retiring(self, conn):
+        '''Hook into when a connection starts being retired'''
+
+    def drained(self, conn):
+        '''Whether a retiring connection has nothing left in flight'''
+        return True
+
+    def reap(self):
+        '''Close retired connections that are drained or out of time'''
+        if not self._retiring:
+            return
+        now = time.time()
+        with self._lock:
+            retiring = list(self._retiring.items())
+        done = [conn for conn, deadline in retiring
+            if deadline <= now or not conn.alive() or self.drained(conn)]
+        with self._lock:
+            for conn in done:
+                self._retiring.pop(conn, None)
+        for conn in done:
+            logger.info('Closing retired %s', conn)
+            if conn.alive():
+                try:
+                    conn.cls()
+                except Exception as exc:
+                    logger.warning('Failed to send CLS to %s: %s', conn, exc)
+            self.remove(conn)
+
+    def active_connections(self):
+        '''Our living connections, less any that are being retired'''
+        return [conn for conn in self.connections()
+            if conn.alive() and conn not in self._retiring]
+
     def check_connections(self):
         '''Connect to all the appropriate instances'''
         logger.info('Checking connections')
+        self.reap()
         if self._lookupd:
             self.discover(self._topic)
 
@@ -99,30 +247,31 @@ class Client(object):
             logger.debug('Checking nsqd instance %s', hostspec)
             host, port = hostspec.split(':')
             port = int(port)
-            conn = self._connections.get((host, port), None)
-            # If there is no connection to it, we have to try to connect
-            if not conn:
-                logger.info('Connecting to %s:%s', host, port)
-                self.connect(host, port)
-            elif not conn.alive():
-                # If we've connected to it before, but it's no longer alive,
-                # we'll have to make a decision about when to try to reconnect
-                # to it, if we need to reconnect to it at all
+            for index in range(self._connections_per_nsqd):
+                self._check_connection(host, port, index)
+
+    def _check_connection(self, host, port, index):
+        '''Make sure one of our connections to an nsqd is alive'''
+        conn = self._connections.get((host, port, index), None)
+        # If there is no connection to it, we have to try to connect
+        if not conn:
+            logger.info('Connecting to %s:%s', host, port)
+            self.connect(host, port)
+        elif not conn.alive():
+            # If we've connected to it before, but it's no longer alive,
+            # we'll have to make a decision about when to try to reconnect
+            # to it, if we need to reconnect to it at all
+            if conn.ready_to_reconnect():
+                logger.info('Reconnecting to %s:%s', host, port)
+                self._reconnect(conn)
+        else:
+            logger.debug('Checking freshness')
+            now = time.time()
+            time_check = math.ceil(now - self.last_recv_timestamp)
+            if time_check >= ((self.heartbeat_interval * 2) / 1000.0):
                 if conn.ready_to_reconnect():
                     logger.info('Reconnecting to %s:%s', host, port)
-                    if conn.connect():
-                        conn.setblocking(0)
-                        self.reconnected(conn)
-            else:
-                logger.debug('Checking freshness')
-                now = time.time()
-                time_check = math.ceil(now - self.last_recv_timestamp)
-                if time_check >= ((self.heartbeat_interval * 2) / 1000.0):
-                    if conn.ready_to_reconnect():
-                        logger.info('Reconnecting to %s:%s', host, port)
-                        if conn.connect():
-                            conn.setblocking(0)
-                            self.reconnected(conn)
+                    self._reconnect(conn)
 
     @contextmanager
     def connection_checker(self):
@@ -150,9 +299,20 @@ class Client(object):
         self.add(conn)
         return conn
 
+    def _reconnect(self, conn):
+        '''Try to reestablish a connection'''
+        if conn.connect():
+            conn.setblocking(0)
+            self._register(conn)
+            self._router.add(conn)
+            self.reconnected(conn)
+
     def reconnected(self, conn):
         '''Hook into when a connection has been reestablished'''
 
+    def responded(self, conn, res):
+        '''Hook into when a response, error or message has been read'''
+
     def connections(self):
         '''Safely return a list of all our connections'''
         with self._lock:
@@ -162,21 +322,28 @@ class Client(object):
         '''Hook into when a connection has been added'''
 
     def add(self, connection):
-        '''Add a connection'''
-        key = (connection.host, connection.port)
+        '''Add a connection, unless we have all we want to its nsqd'''
         with self._lock:
-            if key not in self._connections:
-                self._connections[key] = connection
-                self.added(connection)
-                return connection
-            else:
+            if any(conn is connection for conn in self._connections.values()):
                 return None
+            for index in range(self._connections_per_nsqd):
+                key = (connection.host, connection.port, index)
+                if key not in self._connections:
+                    self._connections[key] = connection
+                    if connection.alive():
+                        self._register(connection)
+                        self._router.add(connection)
+                    self.added(connection)
+                    return connection
+            return None
 
     def remove(self, connection):
         '''Remove a connection'''
-        key = (connection.host, connection.port)
         with self._lock:
-            found = self._connections.pop(key, None)
+            found = None
+            for key, conn in list(self._connections.items()):
+                if conn is connection:
+                    found = self._connections.pop(key)
         try:
             self.close_connection(found)
         except Exception as exc:
@@ -185,36 +352,215 @@ class Client(object):
 
     def close_connection(self, connection):
         '''A hook for subclasses when connections are closed'''
+        self._unregister(connection)
+        self._router.remove(connection)
         connection.close()
 
     def close(self):
         '''Close this client down'''
-        map(self.remove, self.connections())
+        for conn in self.connections():
+            self.remove(conn)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if not self._owns_selector:
+            return
+        if self._selector is not None:
+            self._selector.close()
+        if self._wakeup_reader is not None:
+            self._wakeup_reader.close()
+            self._wakeup_writer.close()
+
+    def _use_selector(self, selector, wakeup=None):
+        '''Register our connections with a selector from now on
+
+        The selector is woken with a (reader, writer) socket pair, which is
+        made and registered unless one that's shared with others is provided.
+        A shared selector and wakeup are left open when we're closed.'''
+        self._selector = selector
+        # A mapping of registered connections to their file descriptors
+        self._registered = {}
+        # Connections whose pending state has changed since the last read
+        self._interest_changes = set()
+        self._interest_lock = threading.Lock()
+        # Wake up the selector when there's something to write
+        if wakeup is None:
+            self._enable_wakeup()
+            self._selector.register(
+                self._wakeup_reader, selectors.EVENT_READ, None)
+        else:
+            self._owns_selector = False
+            self._wakeup_reader, self._wakeup_writer = wakeup
+        for conn in self.connections():
+            if conn.alive():
+                self._register(conn)
+
+    def _register(self, conn):
+        '''Register a connection with our selector'''
+        if self._selector is None:
+            return
+        self._unregister(conn)
+        try:
+            fd = conn.fileno()
+        except exceptions.ConnectionClosedException:
+            return
+        # If the file descriptor was left behind by a connection that was
+        # closed out from under us, it's stale and must be replaced
+        stale = self._selector.get_map().get(fd)
+        if stale is not None:
+            self._selector.unregister(fd)
+            self._registered.pop(stale.data, None)
+        events = selectors.EVENT_READ
+        if conn.pending():
+            events |= selectors.EVENT_WRITE
+        self._selector.register(fd, events, conn)
+        self._registered[conn] = fd
+        conn.watch(self._pending_changed)
+
+    def _unregister(self, conn):
+        '''Unregister a connection from our selector'''
+        if self._selector is None:
+            return
+        fd = self._registered.pop(conn, None)
+        if fd is None:
+            return
+        # With a shared selector, the descriptor may since have been reused
+        # by another client's connection
+        key = self._selector.get_map().get(fd)
+        if key is not None and key.data is conn:
+            try:
+                self._selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+
+    def _pending_changed(self, conn):
+        '''Invoked when a connection's pending state changes'''
+        with self._interest_lock:
+            self._interest_changes.add(conn)
+        self._wakeup()
+
+    def _enable_wakeup(self):
+        '''Make it possible to wake up a read that's waiting on select'''
+        if self._wakeup_reader is None:
+            self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+            self._wakeup_reader.setblocking(0)
+            self._wakeup_writer.setblocking(0)
+
+    def _wakeup(self, always=False):
+        '''Wake up our read if it's waiting, or (always) the next one'''
+        if self._wakeup_writer is not None and (always or self._selecting):
+            try:
+                self._wakeup_writer.send(b'\x00')
+            except socket.error:
+                pass
 
-    def read(self):
-        '''Read from any of the connections that need it'''
-        # We'll check all living connections
+    def _woken(self):
+        '''Consume the wakeups that have been sent'''
+        try:
+            self._wakeup_reader.recv(4096)
+        except socket.error:
+            pass
+
+    def _update_interest(self):
+        '''Update which connections we're waiting to be able to write to'''
+        with self._interest_lock:
+            changed, self._interest_changes = self._interest_changes, set()
+        for conn in changed:
+            fd = self._registered.get(conn)
+            if fd is None:
+                continue
+            # Connections may be closed out from under us (say, when a write
+            # fails while acknowledging a message), leaving a stale descriptor
+            if not conn.alive():
+                self._unregister(conn)
+                continue
+            events = selectors.EVENT_READ
+            if conn.pending():
+                events |= selectors.EVENT_WRITE
+            try:
+                self._selector.modify(fd, events, conn)
+            except (OSError, KeyError, ValueError):
+                logger.warning('Failed to update interest in %s', conn)
+                self._unregister(conn)
+
+    def _select(self):
+        '''Select over all living connections'''
         connections = [c for c in self.connections() if c.alive()]
 
         if not connections:
             # If there are no connections, obviously we return no messages, but
             # we should wait the duration of the timeout
             time.sleep(self._timeout)
-            return []
+            return None
+
+        # Send any coalesced acks that are due, and don't wait any longer than
+        # it takes for the next of them to come due
+        timeout = self.flush_due(connections)
 
         # Not all connections need to be written to, so we'll only concern
         # ourselves with those that require writes
         writes = [c for c in connections if c.pending()]
+        reads = connections
+        if self._wakeup_reader is not None:
+            reads = connections + [self._wakeup_reader]
+        self._selecting = True
         try:
             readable, writable, exceptable = select.select(
-                connections, writes, connections, self._timeout)
+                reads, writes, connections, timeout)
         except exceptions.ConnectionClosedException:
             logger.exception('Tried selecting on closed client')
-            return []
+            return None
         except select.error:
             logger.exception('Error running select')
+            return None
+        finally:
+            self._selecting = False
+        if self._wakeup_reader in readable:
+            self._woken()
+            readable = [conn for conn in readable if conn is not self._wakeup_reader]
+        return readable, writable, exceptable
+
+    def _select_registered(self):
+        '''Wait on our selector for registered connections to be ready'''
+        if not self._registered:
+            time.sleep(self._timeout)
+            return None
+
+        timeout = self.flush_due(list(self._registered))
+        self._update_interest()
+        self._selecting = True
+        try:
+            events = self._selector.select(timeout)
+        finally:
+            self._selecting = False
+
+        readable, writable = [], []
+        for key, mask in events:
+            conn = key.data
+            if conn is None:
+                # Just a wakeup
+                self._woken()
+            elif not conn.alive():
+                self._unregister(conn)
+            else:
+                if mask & selectors.EVENT_READ:
+                    readable.append(conn)
+                if mask & selectors.EVENT_WRITE:
+                    writable.append(conn)
+        return readable, writable, []
+
+    def read(self):
+        '''Read from any of the connections that need it'''
+        self.reap()
+        if self._selector is None:
+            ready = self._select()
+        else:
+            ready = self._select_registered()
+        if ready is None:
             return []
+        return self._process(*ready)
 
+    def _process(self, readable, writable, exceptable):
+        '''Read from, flush and close connections as select found them'''
         # If we returned because the timeout interval passed, log it and return
         if not (readable or writable or exceptable):
             logger.debug('Timed out...')
@@ -232,7 +578,8 @@ class Client(object):
                         logger.debug('Setting last_recv_timestamp')
                         self.last_recv_timestamp = time.time()
                         continue
-                    elif isinstance(res, Error):
+                    self.responded(conn, res)
+                    if isinstance(res, Error):
                         nonfatal = (
                             exceptions.FinFailedException,
                             exceptions.ReqFailedException,
@@ -269,14 +616,45 @@ class Client(object):
 
         return responses
 
+    def flush_due(self, connections):
+        '''Send whatever is due before waiting. Returns the most time to wait'''
+        return self.flush_acks(connections)
+
+    def flush_acks(self, connections):
+        '''Send coalesced acks that are due. Returns the time until the next'''
+        now = time.time()
+        timeout = self._timeout
+        for conn in connections:
+            deadline = conn.ack_deadline()
+            if deadline is None:
+                continue
+            elif deadline <= now:
+                conn.flush_acks()
+            else:
+                timeout = min(timeout, deadline - now)
+        return timeout
+
     @contextmanager
-    def random_connection(self):
-        '''Pick a random living connection'''
+    def random_connection(self, key=None):
+        '''Pick a living connection with our router'''
         # While at the moment there's no need for this to be a context manager
         # per se, I would like to use that interface since I anticipate
         # adding some wrapping around it at some point.
-        yield random.choice(
-            [conn for conn in self.connections() if conn.alive()])
+        yield self.route(key)
+
+    def route(self, key=None):
+        '''Choose a living connection to publish on, optionally for a key'''
+        router = self._router
+        while True:
+            if not router.members():
+                # Connections may have come back to life without our noticing
+                for conn in self.active_connections():
+                    router.add(conn)
+            conn = router.choose(key)
+            if conn.alive():
+                return conn
+            # Connections can die without being closed through us
+            router.remove(conn)
 
     def wait_response(self):
         '''Wait for a response'''
@@ -301,3 +679,9 @@ class Client(object):
         with self.random_connection() as client:
             client.mpub(topic, *messages)
             return self.wait_response()
+
+    def dpub(self, topic, delay, message):
+        '''Publish a message to a topic, deferred by delay milliseconds'''
+        with self.random_connection() as client:
+            client.dpub(topic, delay, message)
+            return self.wait_response()
@@ -0,0 +1,81 @@
+'''Encoders for the commands sent most often, with their framing precomputed'''
+
+from .constants import FIN, REQ, TOUCH, RDY, DPUB, NL
+from .util import pack_string
+
+# Each command's name and the space that follows it
+FIN_PREFIX = FIN + b' '
+REQ_PREFIX = REQ + b' '
+TOUCH_PREFIX = TOUCH + b' '
+RDY_PREFIX = RDY + b' '
+DPUB_PREFIX = DPUB + b' '
+
+# What separates one message ID from the next in a run of the same command
+FIN_SEPARATOR = NL + FIN_PREFIX
+TOUCH_SEPARATOR = NL + TOUCH_PREFIX
+
+# RDY counts and REQ timeouts tend to be drawn from a small set of values, so
+# their encodings are cached, up to this many of them
+INTEGER_CACHE_SIZE = 4096
+_integers = {}
+
+
+def integer(value):
+    '''The ASCII encoding of an integer'''
+    try:
+        return _integers[value]
+    except KeyError:
+        encoded = ('%i' % value).encode('ascii')
+        if len(_integers) < INTEGER_CACHE_SIZE:
+            _integers[value] = encoded
+        return encoded
+
+
+def rdy(count):
+    '''Encode a RDY command'''
+    return RDY_PREFIX + integer(count) + NL
+
+
+def fin(message_id):
+    '''Encode a FIN command'''
+    return FIN_PREFIX + message_id + NL
+
+
+def req(message_id, timeout):
+    '''Encode a REQ command'''
+    return REQ_PREFIX + message_id + b' ' + integer(timeout) + NL
+
+
+def touch(message_id):
+    '''Encode a TOUCH command'''
+    return TOUCH_PREFIX + message_id + NL
+
+
+def fin_many(message_ids):
+    '''Encode FIN commands for a list of message IDs into a single buffer'''
+    if not message_ids:
+        return b''
+    return FIN_PREFIX + FIN_SEPARATOR.join(message_ids) + NL
+
+
+def req_many(message_ids, timeout):
+    '''Encode REQ commands for a list of message IDs into a single buffer'''
+    if not message_ids:
+        return b''
+    suffix = b' ' + integer(timeout) + NL
+    return REQ_PREFIX + (suffix + REQ_PREFIX).join(message_ids) + suffix
+
+
+def touch_many(message_ids):
+    '''Encode TOUCH commands for a list of message IDs into a single buffer'''
+    if not message_ids:
+        return b''
+    return TOUCH_PREFIX + TOUCH_SEPARATOR.join(message_ids) + NL
+
+
+def dpub_many(topic, delay, messages):
+    '''Encode DPUB commands for messages sharing a topic and delay'''
+    if not messages:
+        return b''
+    header = DPUB_PREFIX + topic + b' ' + integer(delay) + NL
+    return b''.join(header + pack_string(message) for message in messages)
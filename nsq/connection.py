@@ -1,15 +1,21 @@
 from . import backoff
+from . import commands
 from . import constants
 from . import logger
 from . import util
 from . import json
 from . import __version__
 from .exceptions import (
-    UnsupportedException, ConnectionClosedException, ConnectionTimeoutException)
+    UnsupportedException, ConnectionClosedException, ConnectionTimeoutException,
+    BufferFullException)
 from .sockets import TLSSocket, SnappySocket, DeflateSocket
-from .response import Response, Message
+from .response import Error, Response
+from .decoder import FrameDecoder
 
 import errno
+import itertools
+import os
+import select
 import socket
 import ssl
 import struct
@@ -19,6 +25,26 @@ import threading
 from collections import deque
 import six
 
+try:
+    import fcntl
+    import termios
+    FIONREAD = termios.FIONREAD
+except (ImportError, AttributeError):  # pragma: no cover
+    FIONREAD = None
+
+# The type of socket we can ask the kernel about. It's captured here so that
+# socket.socket may be patched elsewhere
+SOCKET = socket.socket
+HAS_SENDMSG = hasattr(SOCKET, 'sendmsg')
+
+# The most buffers that can be provided to a single sendmsg
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    IOV_MAX = -1
+if IOV_MAX <= 0:  # pragma: no cover
+    IOV_MAX = 1024
+
 
 class Connection(object):
     '''A socket-based connection to a NSQ server'''
@@ -27,12 +53,51 @@ class Connection(object):
     # Errors that would block
     WOULD_BLOCK_ERRS = (
         errno.EAGAIN, ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ)
+    # What can be done when too much data is waiting to be sent
+    OVERFLOW_POLICIES = ('block', 'raise', 'drop-oldest')
 
     def __init__(self, host, port, timeout=None, reconnection_backoff=None,
-        auth_secret=None, **identify):
+        auth_secret=None, zero_copy=False, min_read_size=4096,
+        max_read_size=1024 * 1024, coalesce_acks=False, ack_max_count=1000,
+        ack_max_bytes=64 * 1024, ack_max_delay_us=5000, high_water=None,
+        low_water=None, overflow='block', **identify):
         assert isinstance(host, six.string_types), host
         assert isinstance(port, int), port
-
+        assert 0 < min_read_size <= max_read_size
+
+        # When coalescing acks, FIN, REQ and TOUCH commands are buffered and
+        # sent together once there are enough of them, they're large enough,
+        # or the oldest of them has waited long enough
+        self._coalesce_acks = coalesce_acks
+        self._ack_max_count = ack_max_count
+        self._ack_max_bytes = ack_max_bytes
+        self._ack_max_delay = ack_max_delay_us / 1e6
+        self._ack_lock = threading.Lock()
+        # Notified when we start or stop having data waiting to be sent, and
+        # when messages are finished or requeued
+        self._watcher = None
+        self._listener = None
+
+        # When not blocking, no more than high_water bytes may wait to be
+        # sent. When that's exceeded, the overflow policy decides what to do:
+        #  - 'block' flushes until there are no more than low_water bytes
+        #  - 'raise' raises a BufferFullException
+        #  - 'drop-oldest' drops unsent commands down to low_water bytes
+        #  - a callable is invoked with this connection and the data, which
+        #    is then queued unless the callable raises
+        assert overflow in self.OVERFLOW_POLICIES or callable(overflow)
+        self._high_water = high_water
+        self._low_water = (
+            low_water if low_water is not None else (high_water or 0) // 2)
+        self._overflow = overflow
+        self._pending_lock = threading.Lock()
+
+        # In zero-copy mode, message bodies are memoryviews into our read
+        # buffer rather than copies of it
+        self._zero_copy = zero_copy
+        # How much we read from the socket at a time adapts between these
+        self._min_read_size = min_read_size
+        self._max_read_size = max_read_size
         self._reset()
 
         # Our host and port
@@ -53,6 +118,7 @@ class Connection(object):
 
         # Some settings that may be determined by an identify response
         self.max_rdy_count = sys.maxsize
+        self.msg_timeout = None
 
         # Check for any options we don't support
         disallowed = []
@@ -96,13 +162,30 @@ class Connection(object):
         # sending
         self._pending = deque()
         self._out_buffer = b''
-        # Our read buffer
-        self._buffer = b''
+        # How many bytes are waiting to be sent, and whether that's exceeded
+        # the high water mark without yet draining to the low water mark
+        self._pending_bytes = 0
+        self._saturated = False
+        # Decodes the frames we read, which are read directly into its buffer
+        self._decoder = FrameDecoder(self._zero_copy)
+        self._read_size = self._min_read_size
+        # Whether the last read filled what we asked for, so more is likely
+        # waiting in the kernel
+        self._filled = False
+        # The size of the kernel's receive buffer, if we know it
+        self._rcvbuf = None
+        # Acks waiting to be coalesced, their size, and when they must be sent
+        self._acks = []
+        self._acks_size = 0
+        self._acks_deadline = None
         # The identify response we last received from the server
         self._identify_response = {}
-        # Our ready state
+        # Our ready state, how many messages we've received but not yet
+        # finished or requeued, and how many we've received in all
         self.last_ready_sent = 0
         self.ready = 0
+        self.in_flight = 0
+        self.received = 0
 
     def connect(self, force=False):
         '''Establish a connection'''
@@ -122,8 +205,11 @@ class Connection(object):
                 self._socket.connect((self.host, self.port))
                 # Set our socket's blocking state to whatever ours is
                 self._socket.setblocking(self._blocking)
+                if isinstance(self._socket, SOCKET):
+                    self._rcvbuf = self._socket.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_RCVBUF)
                 # Safely write our magic
-                self._pending.append(constants.MAGIC_V2)
+                self._write(constants.MAGIC_V2)
                 while self.pending():
                     self.flush()
                 # And send our identify command
@@ -131,17 +217,7 @@ class Connection(object):
                 while self.pending():
                     self.flush()
                 self._reconnnection_counter.success()
-                # Wait until we've gotten a response to IDENTIFY, try to read
-                # one. Also, only spend up to the provided timeout waiting to
-                # establish the connection.
-                limit = time.time() + self._timeout
-                responses = self._read(1)
-                while (not responses) and (time.time() < limit):
-                    responses = self._read(1)
-                if not responses:
-                    raise ConnectionTimeoutException(
-                        'Read identify response timed out (%ss)' % self._timeout)
-                self.identified(responses[0])
+                self.identified(self._handshake_response('identify'))
                 return True
             except:
                 logger.exception('Failed to connect')
@@ -151,12 +227,27 @@ class Connection(object):
                 self._reset()
                 return False
 
+    def _handshake_response(self, command):
+        '''Wait for the response to a command sent while connecting'''
+        # Only spend up to the provided timeout waiting to establish the
+        # connection
+        limit = time.time() + self._timeout
+        responses = self._read(1)
+        while (not responses) and (time.time() < limit):
+            responses = self._read(1)
+        if not responses:
+            raise ConnectionTimeoutException(
+                'Read %s response timed out (%ss)' % (command, self._timeout))
+        return responses[0]
+
     def close(self):
         '''Close our connection'''
-        # Flush any unsent message
+        # Flush any unsent message, if there's still a socket to send it on
         try:
-            while self.pending():
-                self.flush()
+            if self.alive():
+                self.flush_acks()
+                while self.pending():
+                    self.flush()
         except socket.error:
             pass
         with self._socket_lock:
@@ -190,6 +281,10 @@ class Connection(object):
         # Save our max ready count unless it's not provided
         self.max_rdy_count = self._identify_response.get(
             'max_rdy_count', self.max_rdy_count)
+        # The server's message timeout, in seconds
+        msg_timeout = self._identify_response.get('msg_timeout')
+        if msg_timeout:
+            self.msg_timeout = msg_timeout / 1000.0
         if self._identify_options.get('tls_v1', False):
             if not self._identify_response.get('tls_v1', False):
                 raise UnsupportedException(
@@ -203,7 +298,7 @@ class Connection(object):
                 raise UnsupportedException(
                     'Auth required but not provided')
             else:
-                self.auth(self._auth_secret)
+                self.authenticate()
                 # If we're not talking over TLS, warn the user
                 if not self._identify_response.get('tls_v1', False):
                     logger.warning('Using AUTH without TLS')
@@ -211,6 +306,23 @@ class Connection(object):
             logger.warning('Authentication secret provided but not required')
         return res
 
+    def authenticate(self):
+        '''Send our auth secret and consume the response. Returns response
+
+        This is part of connecting, so that the response isn't mistaken for
+        one to a command sent after.'''
+        self.auth(self._auth_secret)
+        while self.pending():
+            self.flush()
+        res = self._handshake_response('auth')
+        if isinstance(res, Error):
+            raise res.exception()
+        try:
+            logger.info('Got auth response: %s', json.loads(res.data))
+        except ValueError:
+            logger.warning('Unexpected auth response: %s', res.data)
+        return res
+
     def alive(self):
         '''Returns True if this connection is alive'''
         return bool(self._socket)
@@ -232,16 +344,43 @@ class Connection(object):
         '''All of the messages waiting to be sent'''
         return self._pending
 
+    def pending_bytes(self):
+        '''The number of bytes waiting to be sent'''
+        return self._pending_bytes
+
+    def saturated(self):
+        '''Whether or not this connection has too much waiting to be sent'''
+        return self._saturated
+
+    def _sent(self, count):
+        '''Account for count pending bytes having been sent'''
+        with self._pending_lock:
+            self._pending_bytes -= count
+            if self._pending_bytes <= self._low_water:
+                self._saturated = False
+        if self._watcher is not None and not self._pending:
+            self._watcher(self)
+
+    def watch(self, callback):
+        '''Invoke callback(connection) when pending() becomes empty or not'''
+        self._watcher = callback
+
+    def listen(self, callback):
+        '''Invoke callback(connection, count, finished) when count messages are
+        finished (or requeued, if not finished)'''
+        self._listener = callback
+
     def flush(self):
         '''Flush some of the waiting messages, returns count written'''
         # When profiling, we found that while there was some efficiency to be
         # gained elsewhere, the big performance hit is sending lots of small
         # messages at a time. In particular, consumers send many 'FIN' messages
         # which are very small indeed and the cost of dispatching so many system
-        # calls is very high. Instead, we prefer to glom together many messages
-        # into a single string to send at once.
+        # calls is very high. Instead, we prefer to send many messages at once.
         total = 0
         for sock in self.socket(blocking=False):
+            if self._vectored(sock):
+                return self._flush_vectored(sock)
             # If there's nothing left in the out buffer, take whatever's in the
             # pending queue.
             #
@@ -249,7 +388,7 @@ class Connection(object):
             # subsequent send requests have to send the same buffer.
             pending = self._pending
             data = self._out_buffer or b''.join(
-                pending.popleft() for _ in range(len(pending)))
+                self._bytes(pending.popleft()) for _ in range(len(pending)))
             try:
                 # Try to send as much of the first message as possible
                 total = sock.send(data)
@@ -260,10 +399,63 @@ class Connection(object):
                 self._out_buffer = data
             else:
                 self._out_buffer = None
-            finally:
                 if total < len(data):
                     # Save the rest of the message that could not be sent
-                    self._pending.appendleft(data[total:])
+                    self._pending.appendleft(memoryview(data)[total:])
+            if total:
+                self._sent(total)
+        return total
+
+    @staticmethod
+    def _bytes(data):
+        '''Pending data as bytes, which python 2 needs to join views'''
+        return data.tobytes() if isinstance(data, memoryview) else data
+
+    def flush_now(self):
+        '''Send coalesced acks, and as much of what's pending as the socket
+        will take right now
+
+        Unlike flush, this waits for the socket if another thread is using it,
+        for writes made away from the read loop that shouldn't wait for it.'''
+        self.flush_acks()
+        with self._socket_lock:
+            while self._pending and self.flush():
+                pass
+
+    def _vectored(self, sock):
+        '''Whether or not we can flush to this socket with sendmsg'''
+        # TLS and compression wrappers have to transform what they send, so
+        # they can't send from many buffers at once
+        return (
+            HAS_SENDMSG and
+            isinstance(sock, SOCKET) and
+            not isinstance(sock, ssl.SSLSocket))
+
+    def _flush_vectored(self, sock):
+        '''Flush pending messages with one sendmsg, returns count written'''
+        pending = self._pending
+        if not pending:
+            return 0
+        try:
+            total = sock.sendmsg(list(itertools.islice(pending, IOV_MAX)))
+        except socket.error as exc:
+            if exc.args[0] not in self.WOULD_BLOCK_ERRS:
+                raise
+            return 0
+
+        # Drop everything that's been sent, and if we only sent part of a
+        # message, keep a view of the rest of it
+        remaining = total
+        while remaining:
+            size = len(pending[0])
+            if size <= remaining:
+                pending.popleft()
+                remaining -= size
+            else:
+                pending[0] = memoryview(pending[0])[remaining:]
+                remaining = 0
+        if total:
+            self._sent(total)
         return total
 
     def send(self, command, message=None):
@@ -272,11 +464,64 @@ class Connection(object):
             joined = command + constants.NL + util.pack(message)
         else:
             joined = command + constants.NL
+        self._write(joined)
+
+    def _write(self, data):
+        '''Send data that's already been encoded'''
         if self._blocking:
             for sock in self.socket():
-                sock.sendall(joined)
+                sock.sendall(data)
+            return
+
+        size = len(data)
+        if self._high_water is not None:
+            if self._pending_bytes + size > self._high_water:
+                self._saturated = True
+                self._overflowed(data)
+        with self._pending_lock:
+            self._pending_bytes += size
+        self._pending.append(data)
+        if self._watcher is not None and len(self._pending) == 1:
+            self._watcher(self)
+
+    def _overflowed(self, data):
+        '''Apply our overflow policy when data would exceed the high water'''
+        if self._overflow == 'raise':
+            raise BufferFullException(
+                '%i bytes pending on %s' % (self._pending_bytes, self))
+        elif self._overflow == 'block':
+            self._drain(self._low_water)
+        elif self._overflow == 'drop-oldest':
+            self._drop(self._low_water - len(data))
         else:
-            self._pending.append(joined)
+            self._overflow(self, data)
+
+    def _drain(self, limit):
+        '''Block until no more than limit bytes are waiting to be sent'''
+        while self._pending_bytes > limit:
+            sock = self._socket
+            if not sock:
+                raise ConnectionClosedException()
+            select.select([], [sock], [], self._timeout)
+            self.flush()
+
+    def _drop(self, limit):
+        '''Drop the oldest unsent commands until no more than limit remain'''
+        dropped = 0
+        pending = self._pending
+        with self._socket_lock:
+            # A partially-sent command has to be finished, so it can't be
+            # dropped, and neither can anything waiting to be retried
+            keep = None
+            if pending and isinstance(pending[0], memoryview):
+                keep = pending.popleft()
+            while pending and (self._pending_bytes - dropped > limit):
+                dropped += len(pending.popleft())
+            if keep is not None:
+                pending.appendleft(keep)
+        if dropped:
+            logger.warning('Dropped %i pending bytes on %s', dropped, self)
+            self._sent(dropped)
 
     def identify(self, data):
         '''Send an identification message'''
@@ -298,32 +543,137 @@ class Connection(object):
         '''Publish multiple messages to a topic'''
         return self.send(constants.MPUB + b' ' + topic, messages)
 
+    def dpub(self, topic, delay, message):
+        '''Publish to a topic, deferred by delay milliseconds'''
+        return self.send(
+            b' '.join((constants.DPUB, topic, commands.integer(delay))), message)
+
+    def dpub_many(self, topic, delay, messages):
+        '''Publish messages to a topic, each deferred by delay milliseconds'''
+        if messages:
+            self._write(commands.dpub_many(topic, delay, messages))
+
     def rdy(self, count):
         '''Indicate that you're ready to receive'''
         self.ready = count
         self.last_ready_sent = count
-        return self.send(constants.RDY + b' ' + six.text_type(count).encode())
+        return self._write(commands.rdy(count))
 
     def fin(self, message_id):
         '''Indicate that you've finished a message ID'''
-        return self.send(constants.FIN + b' ' + message_id)
+        self._landed(1, True)
+        return self._ack(commands.fin(message_id))
+
+    def fin_many(self, message_ids):
+        '''Indicate that you've finished a list of message IDs'''
+        if message_ids:
+            self._landed(len(message_ids), True)
+            return self._ack(commands.fin_many(message_ids))
 
     def req(self, message_id, timeout):
         '''Re-queue a message'''
-        return self.send(constants.REQ + b' ' + message_id + b' ' + six.text_type(timeout).encode())
+        self._landed(1, False)
+        return self._ack(commands.req(message_id, timeout))
+
+    def req_many(self, message_ids, timeout):
+        '''Re-queue a list of message IDs'''
+        if message_ids:
+            self._landed(len(message_ids), False)
+            return self._ack(commands.req_many(message_ids, timeout))
+
+    def _landed(self, count, finished):
+        '''Account for count messages no longer being in flight'''
+        # Messages from before a reconnection may still be acknowledged
+        self.in_flight = max(0, self.in_flight - count)
+        if self._listener is not None:
+            self._listener(self, count, finished)
 
     def touch(self, message_id):
         '''Reset the timeout for an in-flight message'''
-        return self.send(constants.TOUCH + b' ' + message_id)
+        return self._ack(commands.touch(message_id))
+
+    def touch_many(self, message_ids):
+        '''Reset the timeout for a list of in-flight message IDs'''
+        if message_ids:
+            return self._ack(commands.touch_many(message_ids))
+
+    def _ack(self, data):
+        '''Send an acknowledgement, coalescing it with others if configured'''
+        if not self._coalesce_acks:
+            return self._write(data)
+
+        now = time.time()
+        with self._ack_lock:
+            self._acks.append(data)
+            self._acks_size += len(data)
+            if self._acks_deadline is None:
+                self._acks_deadline = now + self.ack_delay()
+            due = (
+                len(self._acks) >= self._ack_max_count or
+                self._acks_size >= self._ack_max_bytes or
+                now >= self._acks_deadline)
+        if due:
+            self.flush_acks()
+
+    def ack_delay(self):
+        '''The longest an ack may wait to be coalesced with others'''
+        # Waiting must only ever be a small fraction of the message timeout,
+        # or the server will give up on messages we've already handled
+        if self.msg_timeout:
+            return min(self._ack_max_delay, self.msg_timeout / 10.0)
+        return self._ack_max_delay
+
+    def ack_deadline(self):
+        '''When the oldest coalesced ack must be sent, or None'''
+        return self._acks_deadline
+
+    def flush_acks(self):
+        '''Send all of the coalesced acks in a single write'''
+        with self._ack_lock:
+            acks = self._acks
+            if not acks:
+                return
+            self._acks = []
+            self._acks_size = 0
+            self._acks_deadline = None
+        self._write(b''.join(acks))
 
     def cls(self):
         '''Close the connection cleanly'''
+        self.flush_acks()
         return self.send(constants.CLS)
 
     def nop(self):
         '''Send a no-op'''
         return self.send(constants.NOP)
 
+    def _next_read_size(self, sock):
+        '''How much we should try to read from the socket'''
+        # Read at least enough to complete the frame we're in the middle of
+        size = max(self._read_size, self._decoder.needed())
+        # If the last read came up short, we've likely drained the kernel, and
+        # asking it how much it has would just cost another system call.
+        # Otherwise, if the kernel can tell us how much it has, take all of it
+        if self._filled and FIONREAD is not None and isinstance(sock, SOCKET):
+            try:
+                available = struct.unpack('i', fcntl.ioctl(
+                    sock.fileno(), FIONREAD, struct.pack('i', 0)))[0]
+                size = max(size, available)
+            except (IOError, OSError):
+                pass
+        return min(size, self._max_read_size)
+
+    def _adapt_read_size(self, size, count):
+        '''Adjust our read size based on how much the last read returned'''
+        self._filled = count >= size
+        if count >= size:
+            # We filled our read, so there's probably more waiting. Without
+            # FIONREAD, the best guess of how much is the kernel's buffer size.
+            size = max(size * 2, self._rcvbuf or 0)
+            self._read_size = min(size, self._max_read_size)
+        elif count < (self._read_size // 4):
+            self._read_size = max(self._read_size // 2, self._min_read_size)
+
     # These are the various incarnations of our read method. In some instances,
     # we want to return responses in the typical way. But while establishing
     # connections or negotiating a TLS connection, we need to do different
@@ -333,12 +683,15 @@ class Connection(object):
         # It's important to know that it may return no responses or multiple
         # responses. It depends on how the buffering works out. First, read from
         # the socket
+        decoder = self._decoder
         for sock in self.socket():
             if sock is None:
                 # Race condition. Connection has been closed.
                 return []
+            size = self._next_read_size(sock)
             try:
-                packet = sock.recv(4096)
+                # Read directly into the free space at the end of our buffer
+                count = sock.recv_into(decoder.reserve(size), size)
             except socket.timeout:
                 # If the socket times out, return nothing
                 return []
@@ -348,34 +701,24 @@ class Connection(object):
                     return []
                 else:
                     raise
-
-            # Append our newly-read data to our buffer
-            self._buffer += packet
-
-        responses = []
-        total = 0
-        buf = self._buffer
-        remaining = len(buf)
-        while limit and (remaining >= 4):
-            size = struct.unpack('>l', buf[total:(total + 4)])[0]
-            # Now check to see if there's enough left in the buffer to read
-            # the message.
-            if (remaining - 4) >= size:
-                responses.append(Response.from_raw(
-                    self, buf[(total + 4):(total + size + 4)]))
-                total += (size + 4)
-                remaining -= (size + 4)
-                limit -= 1
-            else:
-                break
-        self._buffer = self._buffer[total:]
-        return responses
+            decoder.commit(count)
+            self._adapt_read_size(size, count)
+
+        frames, messages = decoder.decode(limit)
+        # Each message we receive consumes some of our ready count
+        self.ready -= messages
+        self.in_flight += messages
+        self.received += messages
+        return [
+            Response.from_frame(self, frame_type, data)
+            for frame_type, data in frames]
 
     def read(self):
         '''Responses from an established socket'''
-        responses = self._read()
-        # Determine the number of messages in here and decrement our ready
-        # count appropriately
-        self.ready -= sum(
-            map(int, (r.frame_type == Message.FRAME_TYPE for r in responses)))
-        return responses
+        # Coalesced acks that are due go out now, rather than waiting for
+        # another ack or for a client to flush them
+        deadline = self._acks_deadline
+        if deadline is not None and time.time() >= deadline:
+            self.flush_acks()
+            self.flush()
+        return self._read()
@@ -17,6 +17,7 @@ AUTH = b'AUTH'
 SUB = b'SUB'
 PUB = b'PUB'
 MPUB = b'MPUB'
+DPUB = b'DPUB'
 RDY = b'RDY'
 FIN = b'FIN'
 REQ = b'REQ'
@@ -0,0 +1,99 @@
+'''Incremental, I/O-free decoding of NSQ frames'''
+
+import struct
+
+from .constants import FRAME_TYPE_MESSAGE
+
+
+# Every frame begins with its size and then its frame type
+HEADER = struct.Struct('>ll')
+SIZE = struct.Struct('>l')
+
+
+class FrameDecoder(object):
+    '''Turns a stream of bytes into (frame_type, data) frames
+
+    Bytes are either fed in with `feed`, or written directly into the buffer
+    provided by `reserve` (as with `socket.recv_into`) and then committed. In
+    zero-copy mode, message data is a memoryview into the decoder's buffer.
+    Those views pin the buffer they came from, so rather than writing over
+    regions that have already been decoded, a fresh buffer is allocated.'''
+    # The minimum size of the buffer we allocate
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, zero_copy=False):
+        self._zero_copy = zero_copy
+        self._buffer = bytearray()
+        # The undecoded data lives in [_start, _end)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        '''The number of bytes buffered but not yet decoded'''
+        return self._end - self._start
+
+    def needed(self):
+        '''The number of bytes still needed to complete the next frame'''
+        available = self._end - self._start
+        if available < 4:
+            return 4 - available
+        size = SIZE.unpack_from(self._buffer, self._start)[0]
+        return max(0, size + 4 - available)
+
+    def reserve(self, size):
+        '''Return a writable memoryview with room for at least size bytes'''
+        buf = self._buffer
+        if len(buf) - self._end < size:
+            start, end = self._start, self._end
+            used = end - start
+            capacity = max(self.BUFFER_SIZE, used + size)
+            if self._zero_copy or capacity > len(buf):
+                self._buffer = bytearray(capacity)
+            # Move the undecoded data to the front of the buffer
+            memoryview(self._buffer)[:used] = memoryview(buf)[start:end]
+            self._start = 0
+            self._end = used
+        return memoryview(self._buffer)[self._end:]
+
+    def commit(self, count):
+        '''Mark count bytes of the reserved buffer as written'''
+        self._end += count
+
+    def feed(self, data):
+        '''Append data to the buffer'''
+        count = len(data)
+        self.reserve(count)[:count] = data
+        self.commit(count)
+
+    def decode(self, limit=None):
+        '''Decode up to limit frames. Returns (frames, message count)'''
+        frames = []
+        messages = 0
+        remaining = -1 if limit is None else limit
+        buf = self._buffer
+        view = memoryview(buf)
+        start, end = self._start, self._end
+        unpack = HEADER.unpack_from
+        copy = not self._zero_copy
+        while remaining and (end - start >= 8):
+            size, frame_type = unpack(buf, start)
+            stop = start + size + 4
+            if stop > end:
+                break
+            data = view[(start + 8):stop]
+            if frame_type == FRAME_TYPE_MESSAGE:
+                messages += 1
+                if copy:
+                    data = data.tobytes()
+            else:
+                # Non-message frames are small and inspected as bytes
+                data = data.tobytes()
+            frames.append((frame_type, data))
+            start = stop
+            remaining -= 1
+
+        if (start == end) and copy:
+            # Everything has been consumed, so we can start over at the front
+            start = end = 0
+        self._start, self._end = start, end
+        return frames, messages
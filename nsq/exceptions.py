@@ -17,6 +17,14 @@ class UnsupportedException(NSQException):
     '''When a requested feature cannot be used'''
 
 
+class BufferFullException(NSQException):
+    '''Too much data is waiting to be sent on a connection'''
+
+
+class SpoolFullException(NSQException):
+    '''There's no room left to spool a message to disk'''
+
+
 class TimeoutException(NSQException):
     '''Exception for failing a timeout'''
 
@@ -69,3 +77,13 @@ class ReqFailedException(NSQException):
 class TouchFailedException(NSQException):
     '''Exception for E_TOUCH_FAILED'''
     name = b'E_TOUCH_FAILED'
+
+
+class AuthFailedException(NSQException):
+    '''Exception for E_AUTH_FAILED'''
+    name = b'E_AUTH_FAILED'
+
+
+class UnauthorizedException(NSQException):
+    '''Exception for E_UNAUTHORIZED'''
+    name = b'E_UNAUTHORIZED'
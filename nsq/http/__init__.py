@@ -69,6 +69,9 @@ class BaseClient(object):
             raise TypeError('Host must be a string or tuple')
         self._params = params
 
+    def __str__(self):
+        return urlunsplit(self._host)
+
     @wrap
     def get(self, path, *args, **kwargs):
         '''GET the provided endpoint'''
@@ -16,9 +16,12 @@ class Client(BaseClient):
         return self.get('info')
 
     @ok_check
-    def pub(self, topic, message):
-        '''Publish a message to a topic'''
-        return self.post('pub', params={'topic': topic}, data=message)
+    def pub(self, topic, message, defer=None):
+        '''Publish a message to a topic, optionally deferred by defer ms'''
+        params = {'topic': topic}
+        if defer is not None:
+            params['defer'] = defer
+        return self.post('pub', params=params, data=message)
 
     @ok_check
     def mpub(self, topic, messages, binary=True):
@@ -0,0 +1,441 @@
+'''A client for publishing with many commands in flight'''
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import functools
+import math
+import threading
+import time
+
+try:
+    from concurrent.futures import Future
+except ImportError:  # pragma: no cover
+    Future = None
+
+from .checker import PeriodicThread, StoppableThread
+from .client import Client, selectors
+from .response import Error, Message
+from .spool import Spool
+from . import exceptions
+from . import logger
+
+
+# The result of publishes that were spooled to disk rather than sent
+SPOOLED = b'SPOOLED'
+
+# Errors that mean spooled messages will never be accepted, so are dropped
+REJECTED = (
+    exceptions.InvalidException,
+    exceptions.BadBodyException,
+    exceptions.BadTopicException,
+    exceptions.BadMessageException
+)
+
+
+class ResponseReader(StoppableThread):
+    '''A thread that reads a client's responses until stopped'''
+    def __init__(self, client):
+        StoppableThread.__init__(self)
+        self.daemon = True
+        self._client = client
+
+    def run(self):
+        '''Read until stopped'''
+        while not self._event.is_set():
+            try:
+                self._client.read()
+            except Exception:
+                logger.exception('Failed to read responses')
+
+
+class Batch(object):
+    '''Messages for a topic waiting to be published together'''
+    __slots__ = ('messages', 'futures', 'size', 'deadline')
+
+    def __init__(self, deadline):
+        self.messages = []
+        self.futures = []
+        self.size = 0
+        # When this batch must be sent, regardless of how full it is
+        self.deadline = deadline
+
+    def add(self, message, future):
+        '''Add a message and the future for its acknowledgement'''
+        self.messages.append(message)
+        self.futures.append(future)
+        # Each message in an MPUB body is prefixed with its 4-byte size
+        self.size += len(message) + 4
+
+    def resolve(self, future):
+        '''Resolve each message's future from that of the MPUB'''
+        for waiting in self.futures:
+            chain(future, waiting)
+
+
+def chain(future, waiting):
+    '''Resolve a waiting future with the outcome of another'''
+    exc = future.exception()
+    if exc is None:
+        waiting.set_result(future.result())
+    else:
+        waiting.set_exception(exc)
+
+
+class Producer(Client):
+    '''Publishes with many PUB and MPUB commands in flight per connection
+
+    pub and mpub return futures. nsqd responds to the commands on a connection
+    in the order they were sent, so each response resolves the oldest future
+    waiting on that connection. Responses are read by calling read, or in the
+    background while in `with producer.running():`.
+
+    With batching enabled, pub collects messages per topic and sends them in a
+    single MPUB once there are batch_max_count of them, they're at least
+    batch_max_bytes in size, or the first of them has waited batch_linger_ms.
+    Every message's future is resolved with the MPUB's response.
+
+    There's no deferred MPUB, but dpub batches the same way, grouping messages
+    whose deadlines fall in the same dpub_bucket_ms. Their DPUB commands are
+    encoded together, with a delay computed once for the whole bucket. That
+    delay is rounded up, so messages are never delivered early.
+
+    The connection for each publish is chosen by the router (see nsq.routing).
+    Publishes may carry a key for routers that use one, like consistent_hash,
+    in which case batches are collected separately for each connection.
+
+    If a spool (a Spool, or the path to a directory for one) is provided, PUB
+    and MPUB messages are written to it when there are no connections to
+    publish on, and their futures are resolved with SPOOLED. While running,
+    they're republished with MPUB every spool_drain_interval seconds. A spool
+    that's full rejects a whole publish, rather than keeping part of it.'''
+    def __init__(self, nsqd_tcp_addresses=None, lookupd_http_addresses=None,
+        topic=None, batch=False, batch_max_count=100,
+        batch_max_bytes=256 * 1024, batch_linger_ms=5, dpub_bucket_ms=100,
+        spool=None, spool_drain_interval=1, **kwargs):
+        if Future is None:  # pragma: no cover
+            raise exceptions.UnsupportedException(
+                'Producer requires concurrent.futures (the futures package)')
+        # Publishes are flushed as soon as they're made when using a selector,
+        # rather than when select next times out
+        if selectors is not None:
+            kwargs.setdefault('selector', True)
+        # The futures waiting on each connection's responses, oldest first,
+        # along with when they were sent. Enqueueing a command's future and
+        # sending it take turns on each connection's send lock, so that the two
+        # are in the same order without holding up reading responses.
+        self._futures = {}
+        self._futures_lock = threading.Lock()
+        self._send_locks = {}
+        # The batches waiting to be sent for each (topic, deadline, connection),
+        # how they're limited, and how they've been sent. The deadline is None
+        # for PUB, and the connection is None unless publishes have a key
+        self._batches = {}
+        self._batch_lock = threading.Lock()
+        self._batching = batch
+        self._batch_max_count = batch_max_count
+        self._batch_max_bytes = batch_max_bytes
+        self._batch_linger = batch_linger_ms / 1000.0
+        self._dpub_bucket = dpub_bucket_ms
+        self._batch_counters = Counter()
+        # Where messages are written when there's nowhere to publish them
+        self._spool = Spool(spool) if isinstance(spool, str) else spool
+        self._spool_drain_interval = spool_drain_interval
+        self._drain_lock = threading.Lock()
+        Client.__init__(
+            self, lookupd_http_addresses, nsqd_tcp_addresses, topic, **kwargs)
+
+    def added(self, conn):
+        '''Start tracking publishes on a new connection'''
+        with self._futures_lock:
+            self._futures.setdefault(conn, deque())
+
+    def reconnected(self, conn):
+        '''Start tracking publishes on a reestablished connection'''
+        self.added(conn)
+
+    def close_connection(self, connection):
+        '''Fail everything still waiting on a connection that's closed'''
+        Client.close_connection(self, connection)
+        with self._futures_lock:
+            futures = self._futures.pop(connection, None) or ()
+        for future, _ in futures:
+            future.set_exception(exceptions.ConnectionClosedException(
+                'Connection to %s closed' % connection))
+
+    def drained(self, conn):
+        '''Whether a connection has no publishes waiting on a response'''
+        with self._futures_lock:
+            return not self._futures.get(conn)
+
+    def responded(self, conn, res):
+        '''Resolve the oldest future waiting on this connection'''
+        if isinstance(res, Message):
+            logger.warning('Unexpected message on %s', conn)
+            return
+        with self._futures_lock:
+            futures = self._futures.get(conn)
+            future, sent = futures.popleft() if futures else (None, None)
+        if future is None:
+            logger.warning('Unexpected %s on %s', res, conn)
+            return
+        self._router.acked(conn, time.time() - sent)
+        if isinstance(res, Error):
+            future.set_exception(res.exception())
+        else:
+            future.set_result(res.data)
+
+    def _publish(self, send, key=None, conn=None):
+        '''Send a publishing command, returning a future for its response'''
+        return self._publish_many(send, 1, key, conn)[0]
+
+    def _publish_many(self, send, count, key=None, conn=None):
+        '''Send count publishing commands, returning futures for each
+
+        They're sent on conn if it's provided, alive and not being retired, and
+        otherwise on the connection our router chooses for key.'''
+        if conn is None or not conn.alive() or conn in self._retiring:
+            conn = self.route(key)
+        futures = [Future() for _ in range(count)]
+        with self._futures_lock:
+            lock = self._send_locks.setdefault(conn, threading.Lock())
+        with lock:
+            # The futures are enqueued first, in case the response is read
+            # before send returns
+            sent = time.time()
+            with self._futures_lock:
+                waiting = self._futures.setdefault(conn, deque())
+                waiting.extend((future, sent) for future in futures)
+            try:
+                send(conn)
+            except Exception:
+                # Sends on this connection take turns, so ours are the newest,
+                # unless the connection's been closed and they've been failed
+                with self._futures_lock:
+                    if self._futures.get(conn) is waiting:
+                        for _ in futures:
+                            waiting.pop()
+                raise
+        return futures
+
+    def _publish_or_spool(self, topic, messages, send, key=None, conn=None):
+        '''Publish, or spool the messages if there's nowhere to publish them'''
+        try:
+            return self._publish(send, key, conn)
+        except exceptions.ConnectionClosedException:
+            if self._spool is None:
+                raise
+        self._spool.extend(topic, messages)
+        future = Future()
+        future.set_result(SPOOLED)
+        return future
+
+    def _batch_connection(self, key):
+        '''The connection to batch a keyed publish for, if it has a key'''
+        return None if key is None else self.route(key)
+
+    def pub(self, topic, message, key=None):
+        '''Publish a message to a topic, returning a future for the response'''
+        if self._batching:
+            try:
+                conn = self._batch_connection(key)
+            except exceptions.ConnectionClosedException:
+                # There's nowhere to batch a keyed publish for, so it's spooled
+                if self._spool is None:
+                    raise
+            else:
+                return self._batch((topic, None, conn), message)
+        return self._publish_or_spool(
+            topic, [message], lambda conn: conn.pub(topic, message), key)
+
+    def mpub(self, topic, *messages, **kwargs):
+        '''Publish messages to a topic, returning a future for the response
+
+        Accepts a routing key as the keyword argument `key`.'''
+        return self._publish_or_spool(topic, messages,
+            lambda conn: conn.mpub(topic, *messages), kwargs.get('key'))
+
+    def dpub(self, topic, delay, message, key=None):
+        '''Publish a message to a topic, deferred by delay milliseconds'''
+        if self._batching:
+            bucket = self._dpub_bucket
+            deadline = time.time() * 1000 + delay
+            deadline = int(math.ceil(deadline / bucket)) * bucket
+            return self._batch(
+                (topic, deadline, self._batch_connection(key)), message)
+        return self._publish(
+            lambda conn: conn.dpub(topic, delay, message), key)
+
+    def _batch(self, key, message):
+        '''Add a message to its batch, sending the batch if it's full'''
+        future = Future()
+        full = None
+        with self._batch_lock:
+            batch = self._batches.get(key)
+            started = batch is None
+            if started:
+                batch = self._batches[key] = Batch(
+                    time.time() + self._batch_linger)
+            batch.add(message, future)
+            if len(batch.messages) >= self._batch_max_count:
+                full = 'full_count'
+            elif batch.size >= self._batch_max_bytes:
+                full = 'full_bytes'
+            if full:
+                del self._batches[key]
+        if full:
+            self._send_batch(key, batch, full)
+        elif started:
+            # Make sure we don't wait past this batch's deadline
+            self._wakeup()
+        return future
+
+    def _send_batch(self, key, batch, reason):
+        '''Publish a batch with MPUB, or with DPUBs if it's deferred'''
+        topic, deadline, conn = key
+        messages = batch.messages
+        try:
+            if deadline is None:
+                futures = [self._publish_or_spool(topic, messages,
+                    lambda conn: conn.mpub(topic, *messages), conn=conn)]
+            else:
+                delay = max(0, int(math.ceil(deadline - time.time() * 1000)))
+                futures = self._publish_many(
+                    lambda conn: conn.dpub_many(topic, delay, messages),
+                    len(messages), conn=conn)
+        except Exception as exc:
+            for waiting in batch.futures:
+                waiting.set_exception(exc)
+            return
+        if deadline is None:
+            futures[0].add_done_callback(batch.resolve)
+        else:
+            for future, waiting in zip(futures, batch.futures):
+                future.add_done_callback(
+                    functools.partial(chain, waiting=waiting))
+        with self._batch_lock:
+            self._batch_counters['batches'] += 1
+            self._batch_counters['messages'] += len(messages)
+            self._batch_counters['bytes'] += batch.size
+            self._batch_counters[reason] += 1
+
+    def flush_batches(self, force=False):
+        '''Send due batches (or all of them). Returns the time until the next'''
+        now = time.time()
+        due = []
+        delay = None
+        with self._batch_lock:
+            for key, batch in list(self._batches.items()):
+                if force or batch.deadline <= now:
+                    due.append((key, self._batches.pop(key)))
+                elif delay is None or batch.deadline - now < delay:
+                    delay = batch.deadline - now
+        for key, batch in due:
+            self._send_batch(key, batch, 'forced' if force else 'linger')
+        return delay
+
+    def flush_due(self, connections):
+        '''Send due batches and acks. Returns the most time to wait'''
+        timeout = Client.flush_due(self, connections)
+        delay = self.flush_batches()
+        if delay is not None:
+            timeout = min(timeout, delay)
+        return timeout
+
+    def configure_batching(self, enabled=None, max_count=None, max_bytes=None,
+        linger_ms=None):
+        '''Change any of the batching parameters'''
+        with self._batch_lock:
+            if max_count is not None:
+                self._batch_max_count = max_count
+            if max_bytes is not None:
+                self._batch_max_bytes = max_bytes
+            if linger_ms is not None:
+                self._batch_linger = linger_ms / 1000.0
+            if enabled is not None:
+                self._batching = enabled
+        # Anything already waiting is sent rather than held to the old limits
+        self.flush_batches(force=True)
+
+    def batch_stats(self):
+        '''Counts of batches sent, their messages, bytes and why they were sent
+
+        Batches are sent because they were full by count ('full_count') or
+        by size ('full_bytes'), they waited out their 'linger' time, or they
+        were 'forced' out.'''
+        with self._batch_lock:
+            stats = dict(self._batch_counters)
+        for key in ('batches', 'messages', 'bytes', 'full_count', 'full_bytes',
+            'linger', 'forced'):
+            stats.setdefault(key, 0)
+        stats['mean_size'] = (
+            float(stats['messages']) / stats['batches'] if stats['batches'] else 0)
+        return stats
+
+    def drain_spool(self, timeout=10):
+        '''Republish spooled messages. Returns how many were published
+
+        Messages are republished in order with MPUB, waiting up to timeout
+        for each to be acknowledged, so responses must be read elsewhere (as
+        they are while running). Stops at the first failure, to be retried.'''
+        if self._spool is None:
+            return 0
+        count = 0
+        with self._drain_lock:
+            while True:
+                position, topic, messages = self._spool.read(
+                    self._batch_max_count, self._batch_max_bytes)
+                if not messages:
+                    break
+                try:
+                    self._publish(
+                        lambda conn: conn.mpub(topic, *messages)).result(timeout)
+                    count += len(messages)
+                except REJECTED as exc:
+                    logger.error(
+                        'Dropping %i spooled messages: %s', len(messages), exc)
+                except Exception as exc:
+                    logger.warning('Failed to drain spool: %s', exc)
+                    break
+                self._spool.commit(position)
+        if count:
+            logger.info('Republished %i spooled messages', count)
+        return count
+
+    def close(self):
+        '''Send anything still batched, and close'''
+        self.flush_batches(force=True)
+        Client.close(self)
+        if self._spool is not None:
+            self._spool.close()
+
+    def pending(self):
+        '''How many publishes are waiting on a response'''
+        with self._futures_lock:
+            return sum(len(futures) for futures in self._futures.values())
+
+    @contextmanager
+    def running(self):
+        '''Read responses, check connections (and drain any spool) in
+        background threads'''
+        thread = ResponseReader(self)
+        logger.info('Starting response-reader thread')
+        thread.start()
+        drainer = None
+        if self._spool is not None:
+            drainer = PeriodicThread(
+                self._spool_drain_interval, self.drain_spool)
+            drainer.daemon = True
+            logger.info('Starting spool-drainer thread')
+            drainer.start()
+        try:
+            # Connections have to come back for the spool to be drained
+            with self.connection_checker():
+                yield thread
+        finally:
+            if drainer is not None:
+                logger.info('Stopping spool-drainer')
+                drainer.stop()
+                drainer.join()
+            logger.info('Stopping response-reader')
+            thread.stop()
+            thread.join()
@@ -1,59 +1,157 @@
+from .backoff import Throttle
 from .client import Client
-from .response import Message
-from .util import distribute
+from .response import Message, fin_batch, req_batch
+from .ready import Allocator
+from .touch import Toucher
+from .util import apportion
+from . import exceptions
 from . import logger
+from .checker import ConnectionChecker
+
+from collections import deque
+from contextlib import contextmanager
+import select
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    selectors = None
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+import socket
+import threading
+import time
 
 
 class Reader(Client):
     '''A client meant exclusively for reading'''
     def __init__(self, topic, channel, lookupd_http_addresses=None,
-        nsqd_tcp_addresses=None, max_in_flight=200, **identify):
+        nsqd_tcp_addresses=None, max_in_flight=200, ready_window=10.0,
+        ready_rotation=5.0, backoff=None, auto_touch=None, **identify):
         self._channel = channel
         self._max_in_flight = max_in_flight
+        # Splits max_in_flight among connections by their recent throughput,
+        # or rotates it every ready_rotation seconds if they outnumber it
+        self._allocator = Allocator(ready_window, ready_rotation)
+        self._ready_lock = threading.RLock()
+        # Stops RDY while messages are being requeued, for durations from the
+        # backoff policy (or the default one, if it's True). Off unless asked
+        # for, since a requeue may be deliberate rather than a failure
+        self.throttle = None
+        if backoff:
+            self.throttle = Throttle(None if backoff is True else backoff)
+        # Set to stop run()
+        self._stopped = threading.Event()
+        # Touches in-flight messages every auto_touch of their msg_timeout, so
+        # that long-running handlers don't have them redelivered. A Toucher
+        # may be shared with other readers, in which case it isn't ours to stop
+        self._toucher = None
+        self._owns_toucher = False
+        if isinstance(auto_touch, Toucher):
+            self._toucher = auto_touch
+        elif auto_touch:
+            self._toucher = Toucher(auto_touch)
+            self._toucher.start()
+            self._owns_toucher = True
         Client.__init__(
             self, lookupd_http_addresses, nsqd_tcp_addresses, topic, **identify)
 
     def reconnected(self, conn):
         '''Subscribe connection and manipulate its RDY state'''
+        if self._toucher is not None:
+            # Messages from before the reconnection can no longer be touched
+            self._toucher.forget(conn)
         conn.sub(self._topic, self._channel)
-        conn.rdy(1)
+        # Only give it RDY if it has a share of max_in_flight
+        self.distribute_ready()
 
     def added(self, conn):
         '''Subscribe connection and manipulate its RDY state'''
+        conn.listen(self.landed)
         if conn.alive():
             self.reconnected(conn)
 
+    def landed(self, conn, count, finished):
+        '''Back off as messages are requeued, and ramp up as they're finished'''
+        if self.throttle is None:
+            return
+        changed = False
+        for _ in range(count):
+            if finished:
+                changed = self.throttle.succeeded() or changed
+            else:
+                changed = self.throttle.failed() or changed
+        if changed:
+            logger.info('Throttled to %i in flight',
+                self.throttle.max_in_flight(self._max_in_flight))
+            self.distribute_ready()
+
+    def retiring(self, conn):
+        '''Stop receiving messages on a connection that's being retired'''
+        conn.rdy(0)
+        self.distribute_ready()
+
+    def drained(self, conn):
+        '''Whether every message received on a connection has been handled'''
+        return conn.in_flight <= 0
+
+    def set_max_in_flight(self, max_in_flight):
+        '''Change how many messages may be in flight, redistributing RDY
+
+        RDY is redistributed even if it's unchanged, in case any connections
+        have more than their share. Only the RDY that has changed is sent.'''
+        self._max_in_flight = max_in_flight
+        if self.active_connections():
+            self.distribute_ready()
+
     def distribute_ready(self):
         '''Distribute the ready state across all of the connections'''
-        connections = [c for c in self.connections() if c.alive()]
-        if len(connections) > self._max_in_flight:
-            raise NotImplementedError(
-                'Max in flight must be greater than number of connections')
-        else:
-            # Distribute the ready count evenly among the connections
-            for count, conn in distribute(self._max_in_flight, connections):
-                # We cannot exceed the maximum RDY count for a connection
-                if count > conn.max_rdy_count:
-                    logger.info(
-                        'Using max_rdy_count (%i) instead of %i for %s RDY',
-                        conn.max_rdy_count, count, conn)
-                    count = conn.max_rdy_count
+        # Weight the ready count by where messages have been coming from, or
+        # rotate it if there are more connections than max_in_flight
+        with self._ready_lock:
+            total = self._max_in_flight
+            if self.throttle is not None:
+                total = self.throttle.max_in_flight(total)
+            connections = self.active_connections()
+            for count, conn in self._allocator.plan(total, connections):
                 logger.info('Sending RDY %i to %s', count, conn)
                 conn.rdy(count)
 
+    def set_depth(self, host, port, depth):
+        '''Tell us how many messages are waiting for us on an nsqd'''
+        self._allocator.set_depth(host, port, depth)
+
     def needs_distribute_ready(self):
         '''Determine whether or not we need to redistribute the ready state'''
+        # Let through a test message once we're done backing off
+        if self.throttle is not None and self.throttle.ended():
+            return True
         # Try to pre-empty starvation by comparing current RDY against
         # the last value sent.
-        alive = [c for c in self.connections() if c.alive()]
-        if any(c.ready <= (c.last_ready_sent * 0.25) for c in alive):
+        alive = self.active_connections()
+        if any(
+            c.last_ready_sent and c.ready <= (c.last_ready_sent * 0.25)
+            for c in alive):
+            return True
+        # Otherwise, rebalance every so often as throughput shifts
+        if alive and self._allocator.due():
             return True
 
     def close_connection(self, connection):
         '''A hook into when connections are closed'''
         Client.close_connection(self, connection)
+        if self._toucher is not None:
+            self._toucher.forget(connection)
         self.distribute_ready()
 
+    def close(self):
+        '''Close this reader down'''
+        Client.close(self)
+        if self._owns_toucher:
+            self._toucher.stop()
+            self._toucher.join()
+
     def read(self):
         '''Read some number of messages'''
         found = Client.read(self)
@@ -65,6 +163,16 @@ class Reader(Client):
         # Finally, return all the results we've read
         return found
 
+    def _process(self, readable, writable, exceptable):
+        '''Read from, flush and close connections as select found them'''
+        found = Client._process(self, readable, writable, exceptable)
+        # Keep messages alive for as long as they're being handled
+        if self._toucher is not None:
+            for message in found:
+                if isinstance(message, Message):
+                    self._toucher.track(message)
+        return found
+
     def __iter__(self):
         with self.connection_checker():
             while True:
@@ -74,3 +182,420 @@ class Reader(Client):
                         # We'll probably add a hook in here to track the RDY
                         # states of our connections
                         yield message
+
+    def run(self, handler, concurrency=10, executor='thread'):
+        '''Handle messages on a pool of workers until stopped
+
+        The network loop stays on this thread, and hands each message to
+        handler on a pool of concurrency threads, or processes if executor is
+        'process' (or on an Executor instance). max_in_flight is set to
+        concurrency, so RDY only ever covers free workers. Once handler returns,
+        the message is finished, or requeued if it raises, back on this thread
+        and its own connection. Processes are given a copy of each message with
+        no connection, so handler must be picklable and mustn't finish, requeue
+        or touch it.'''
+        if ThreadPoolExecutor is None:  # pragma: no cover
+            raise exceptions.UnsupportedException(
+                'concurrent.futures is not available')
+        if executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers=concurrency)
+        elif executor == 'process':
+            pool = ProcessPoolExecutor(max_workers=concurrency)
+        else:
+            pool = executor
+        copy = isinstance(pool, ProcessPoolExecutor)
+
+        # The message being handled by each future, and the futures that are
+        # done, for their messages to be finished or requeued here
+        working = {}
+        done = deque()
+
+        def handled(future):
+            '''Invoked in the pool when a handler has returned'''
+            done.append(future)
+            self._wakeup(always=True)
+
+        self._stopped.clear()
+        self._enable_wakeup()
+        self.set_max_in_flight(concurrency)
+        try:
+            with self.connection_checker():
+                while not self._stopped.is_set():
+                    for message in self.read():
+                        if isinstance(message, Message):
+                            work = message
+                            if copy:
+                                # Zero-copy messages are views, which can't be
+                                # pickled (and bytes() of one is its repr on
+                                # python 2)
+                                data = message.data
+                                if isinstance(data, memoryview):
+                                    data = data.tobytes()
+                                work = Message(None, message.frame_type, data)
+                            future = pool.submit(handler, work)
+                            working[future] = message
+                            future.add_done_callback(handled)
+                    while done:
+                        future = done.popleft()
+                        self._settle(working.pop(future), future)
+        finally:
+            # Wait for the handlers that are still running
+            for future in list(working):
+                self._settle(working.pop(future), future)
+            if pool is not executor:
+                pool.shutdown(wait=True)
+            for conn in self.connections():
+                if conn.alive() and conn.pending():
+                    try:
+                        conn.flush()
+                    except socket.error:
+                        logger.exception('Failed to flush %s', conn)
+
+    def batches(self, max_size=100, max_wait=1.0):
+        '''Yield lists of up to max_size messages until stopped
+
+        A batch is yielded once it's full or max_wait seconds after its first
+        message arrived, or sooner if that would leave any of its messages less
+        than half of their msg_timeout to be handled. If need be,
+        max_in_flight is raised to max_size, so that a full batch may be in
+        flight at once.'''
+        if self._max_in_flight < max_size:
+            logger.info('Raising max_in_flight to %i for batches', max_size)
+            self.set_max_in_flight(max_size)
+        batch = []
+        deadline = None
+        with self.connection_checker():
+            while not self._stopped.is_set():
+                for message in self.read():
+                    if not isinstance(message, Message):
+                        continue
+                    now = time.time()
+                    if not batch:
+                        deadline = now + max_wait
+                    batch.append(message)
+                    timeout = message.connection.msg_timeout
+                    if timeout:
+                        deadline = min(deadline, now + timeout / 2.0)
+                    if len(batch) >= max_size:
+                        batch, full = [], batch
+                        yield full
+                if batch and time.time() >= deadline:
+                    batch, due = [], batch
+                    yield due
+            if batch:
+                yield batch
+
+    def run_batches(self, handler, max_size=100, max_wait=1.0):
+        '''Handle batches of messages until stopped
+
+        Each batch from batches() is passed to handler. Once it returns, the
+        batch is finished, or requeued if it raises, with a write to each of
+        its connections. Messages handler finishes or requeues itself are
+        left alone.'''
+        self._stopped.clear()
+        for batch in self.batches(max_size, max_wait):
+            try:
+                handler(batch)
+            except Exception:
+                logger.exception('Failed to handle batch of %i', len(batch))
+                req_batch([message for message in batch if not message.processed])
+            else:
+                fin_batch([message for message in batch if not message.processed])
+
+    def _settle(self, message, future):
+        '''Finish or requeue a message once its handler has returned'''
+        try:
+            with message.handle():
+                future.result()
+        except Exception:
+            logger.exception('Failed to handle message %s', message.id)
+
+    def stop(self):
+        '''Stop run() once the handlers that are running have returned, or
+        run_batches() or batches() once the current batch has been handled'''
+        self._stopped.set()
+        self._wakeup(always=True)
+
+
+class MultiReader(object):
+    '''Read from several topics and channels with one select loop
+
+    Each subscription is a (topic, channel) or (topic, channel, weight) tuple.
+    nsqd subscribes each connection to exactly one topic and channel, so every
+    subscription gets its own Reader, but their connections are all selected
+    over together and their discovery is run by a single connection checker.
+    max_in_flight is split among the subscriptions that have connections: each
+    gets 1, and the rest goes in proportion to their weights. When there are
+    more of them than max_in_flight, it's rotated among them every rotation
+    seconds instead, going to whichever have waited longest (times their
+    weights). With auto_touch, one Toucher thread touches the messages of
+    every subscription, and with selector (True, or a selector instance),
+    every subscription's connections are registered with the one selector.'''
+    def __init__(self, subscriptions, lookupd_http_addresses=None,
+        nsqd_tcp_addresses=None, max_in_flight=200, timeout=0.1,
+        discovery_workers=8, auto_touch=None, rotation=5.0, selector=None,
+        **kwargs):
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        # When rotating, the readers with some of max_in_flight, when they were
+        # chosen, and when each reader last had some (or was first seen)
+        self._rotation = rotation
+        self._rebalance_lock = threading.Lock()
+        self._holders = []
+        self._rotated = 0
+        self._held = {}
+        # Subscriptions' discovery is done in parallel, rather than each of
+        # their readers having threads of its own
+        self._executor = None
+        if ThreadPoolExecutor is not None and discovery_workers:
+            self._executor = ThreadPoolExecutor(max_workers=discovery_workers)
+        self._toucher = None
+        if auto_touch:
+            self._toucher = Toucher(auto_touch)
+            self._toucher.start()
+
+        self._subscriptions = []
+        for subscription in subscriptions:
+            topic, channel = subscription[:2]
+            weight = subscription[2] if len(subscription) > 2 else 1
+            self._subscriptions.append((topic, channel, weight))
+
+        def reader(subscription):
+            '''Make the reader for a subscription, which gets its share of
+            max_in_flight once rebalanced'''
+            topic, channel, _ = subscription
+            return Reader(topic, channel, lookupd_http_addresses,
+                nsqd_tcp_addresses, max_in_flight=0,
+                timeout=timeout, discovery_workers=None,
+                auto_touch=self._toucher, **kwargs)
+        self._readers = self._map(reader, self._subscriptions)
+
+        # Rather than selecting over every connection on every read, they may
+        # all be registered with one selector, with a single wakeup
+        self._selector = None
+        self._wakeup_reader = self._wakeup_writer = None
+        if selector:
+            if selectors is None:  # pragma: no cover
+                raise exceptions.UnsupportedException(
+                    'The selectors module is not available')
+            self._selector = (
+                selectors.DefaultSelector() if selector is True else selector)
+            self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+            self._wakeup_reader.setblocking(0)
+            self._wakeup_writer.setblocking(0)
+            self._selector.register(
+                self._wakeup_reader, selectors.EVENT_READ, None)
+            wakeup = (self._wakeup_reader, self._wakeup_writer)
+            for sub in self._readers:
+                sub._use_selector(self._selector, wakeup)
+        self.rebalance()
+
+    def _map(self, function, items):
+        '''Apply function to each of items, in parallel if we can'''
+        items = list(items)
+        if self._executor is None or len(items) < 2:
+            return [function(item) for item in items]
+        return list(self._executor.map(function, items))
+
+    def readers(self):
+        '''The (topic, channel, reader) of each subscription'''
+        return [(topic, channel, reader) for (topic, channel, _), reader in
+            zip(self._subscriptions, self._readers)]
+
+    def connections(self):
+        '''All of our subscriptions' connections'''
+        return [conn for reader in self._readers for conn in reader.connections()]
+
+    def rebalance(self):
+        '''Split max_in_flight among subscriptions with connections by weight'''
+        with self._rebalance_lock:
+            active = [(reader, weight) for (_, _, weight), reader in
+                zip(self._subscriptions, self._readers)
+                if reader.active_connections()]
+            if not active:
+                return
+            total = self._max_in_flight
+            if len(active) > total:
+                shares = self._rotate(total, active)
+            else:
+                self._holders = []
+                spare = apportion(
+                    total - len(active), [weight for _, weight in active])
+                shares = [1 + share for share in spare]
+            # Take from some subscriptions before giving to others, so that
+            # they never have more than max_in_flight between them
+            changes = sorted(zip(shares, [reader for reader, _ in active]),
+                key=lambda change: change[0] - change[1]._max_in_flight)
+            for share, reader in changes:
+                reader.set_max_in_flight(share)
+
+    def _rotate(self, total, active):
+        '''Choose which total of the active (reader, weight) get 1 for now'''
+        now = time.time()
+        self._held = dict(
+            (reader, self._held.get(reader, now)) for reader, _ in active)
+        holders = [reader for reader in self._holders if reader in self._held]
+        if now - self._rotated >= self._rotation:
+            for reader in holders:
+                self._held[reader] = now
+            holders = []
+            self._rotated = now
+        if len(holders) < total:
+            # Whoever has waited longest goes next, but the waits of heavier
+            # subscriptions count for more
+            waiting = [(reader, weight) for reader, weight in active
+                if reader not in holders]
+            waiting.sort(
+                key=lambda item: -(now - self._held[item[0]]) * item[1])
+            holders.extend(
+                reader for reader, _ in waiting[:total - len(holders)])
+        self._holders = holders
+        return [1 if reader in holders else 0 for reader, _ in active]
+
+    def rotation_due(self):
+        '''Whether it's time to rotate max_in_flight among subscriptions'''
+        return bool(self._holders) and (
+            time.time() - self._rotated >= self._rotation)
+
+    def check_connections(self):
+        '''Check each subscription's connections, then rebalance'''
+        self._map(lambda reader: reader.check_connections(), self._readers)
+        self.rebalance()
+
+    @contextmanager
+    def connection_checker(self):
+        '''Run periodic reconnection checks for every subscription'''
+        thread = ConnectionChecker(self)
+        logger.info('Starting connection-checker thread')
+        thread.start()
+        try:
+            yield thread
+        finally:
+            logger.info('Stopping connection-checker')
+            thread.stop()
+            thread.join()
+
+    def read(self):
+        '''Read from any of the connections that need it
+
+        Returns a (topic, channel, response) for each response read.'''
+        if self._selector is None:
+            ready = self._select()
+        else:
+            ready = self._select_registered()
+
+        found = []
+        for topic, channel, reader in self.readers():
+            if reader in ready:
+                for res in reader._process(*ready[reader]):
+                    found.append((topic, channel, res))
+            if reader.needs_distribute_ready():
+                reader.distribute_ready()
+        if self.rotation_due():
+            self.rebalance()
+        return found
+
+    def _select(self):
+        '''Select over every subscription's living connections
+
+        Returns the (readable, writable, exceptable) for each reader.'''
+        owners = {}
+        timeout = self._timeout
+        for reader in self._readers:
+            reader.reap()
+            alive = [conn for conn in reader.connections() if conn.alive()]
+            for conn in alive:
+                owners[conn] = reader
+            if alive:
+                timeout = min(timeout, reader.flush_due(alive))
+
+        if not owners:
+            time.sleep(self._timeout)
+            return {}
+
+        connections = list(owners)
+        writes = [conn for conn in connections if conn.pending()]
+        try:
+            ready = select.select(connections, writes, connections, timeout)
+        except exceptions.ConnectionClosedException:
+            logger.exception('Tried selecting on closed client')
+            return {}
+        except select.error:
+            logger.exception('Error running select')
+            return {}
+
+        found = {}
+        for reader in set(owners.values()):
+            found[reader] = [[conn for conn in group if owners[conn] is reader]
+                for group in ready]
+        return found
+
+    def _select_registered(self):
+        '''Wait on our selector for any subscription's connections
+
+        Returns the (readable, writable, exceptable) for each reader.'''
+        timeout = self._timeout
+        registered = False
+        for reader in self._readers:
+            reader.reap()
+            if reader._registered:
+                registered = True
+                timeout = min(
+                    timeout, reader.flush_due(list(reader._registered)))
+                reader._update_interest()
+
+        if not registered:
+            time.sleep(self._timeout)
+            return {}
+
+        found = {}
+        for key, mask in self._selector.select(timeout):
+            conn = key.data
+            if conn is None:
+                # Just a wakeup
+                try:
+                    self._wakeup_reader.recv(4096)
+                except socket.error:
+                    pass
+                continue
+            reader = self._owner(conn)
+            if reader is None:
+                continue
+            if not conn.alive():
+                reader._unregister(conn)
+                continue
+            readable, writable, _ = found.setdefault(reader, ([], [], []))
+            if mask & selectors.EVENT_READ:
+                readable.append(conn)
+            if mask & selectors.EVENT_WRITE:
+                writable.append(conn)
+        return found
+
+    def _owner(self, conn):
+        '''The reader a registered connection belongs to, if any'''
+        for reader in self._readers:
+            if conn in reader._registered:
+                return reader
+        return None
+
+    def __iter__(self):
+        '''Yield (topic, channel, message) for each message received'''
+        with self.connection_checker():
+            while True:
+                for topic, channel, res in self.read():
+                    if isinstance(res, Message):
+                        yield topic, channel, res
+
+    def close(self):
+        '''Close every subscription's reader'''
+        for reader in self._readers:
+            reader.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._toucher is not None:
+            self._toucher.stop()
+            self._toucher.join()
+        if self._selector is not None:
+            self._selector.close()
+            self._wakeup_reader.close()
+            self._wakeup_writer.close()
@@ -0,0 +1,159 @@
+'''Deciding how much RDY each of a reader's connections gets'''
+
+import math
+import threading
+import time
+
+from . import logger
+from .util import apportion, distribute
+
+
+class Allocator(object):
+    '''Split max_in_flight among connections by where messages are coming from
+
+    Each connection gets a RDY of at least 1, so that idle nsqd instances are
+    still probed for messages. The rest is split in proportion to each
+    connection's weight: an exponentially-weighted moving average of the rate
+    it's been receiving messages (over about window seconds), plus its nsqd's
+    depth, if known, spread over the next DEPTH_HORIZON seconds. Until there's
+    anything to go on, it's split evenly.
+
+    When there are more connections than max_in_flight, RDY 1 is rotated among
+    them instead: every rotation seconds, a new subset is chosen by how long
+    each has gone without RDY. Waits count BUSY times over for connections
+    that would have been expected to get a message while they had RDY, so nsqd
+    instances that have recently had messages come around again sooner, but
+    every one comes around eventually.
+
+    Rather than sending RDY to every connection each time, only those whose
+    allocation has gone down, gone up significantly, or that have nearly used
+    up their RDY are sent a new one, decreases first. So the total RDY never
+    exceeds max_in_flight.'''
+    # How long we'd like the known depth of an nsqd to take to drain
+    DEPTH_HORIZON = 60.0
+    # Increases smaller than this fraction of the current RDY are put off until
+    # the connection needs more RDY anyway
+    SLACK = 0.1
+    # How much sooner busy connections get RDY again when rotating
+    BUSY = 2.0
+
+    def __init__(self, window=10.0, rotation=5.0):
+        self._window = window
+        self._rotation = rotation
+        self._lock = threading.Lock()
+        self._updated = time.time()
+        # The last count of messages received on each connection, and the
+        # moving average of the rate they've been received
+        self._counts = {}
+        self._rates = {}
+        # The known depth of each (host, port)
+        self._depths = {}
+        # When rotating, the connections with RDY, when they were chosen, and
+        # when each connection last had RDY (or was first seen)
+        self._holders = []
+        self._rotated = 0
+        self._held = {}
+
+    def rate(self, conn):
+        '''The moving average of how many messages a second a connection gets'''
+        with self._lock:
+            return self._rates.get(conn, 0.0)
+
+    def set_depth(self, host, port, depth):
+        '''Record how many messages are waiting on an nsqd'''
+        with self._lock:
+            self._depths[(host, port)] = depth
+
+    def due(self):
+        '''Whether it's been long enough that allocations may have shifted'''
+        now = time.time()
+        if self._holders and now - self._rotated >= self._rotation:
+            return True
+        return now - self._updated >= self._window / 4.0
+
+    def _update(self, connections):
+        '''Update the rates of our connections, forgetting any others'''
+        now = time.time()
+        elapsed = now - self._updated
+        counts, rates = {}, {}
+        decay = math.exp(-elapsed / self._window) if elapsed > 0 else 1.0
+        for conn in connections:
+            count = conn.received
+            delta = count - self._counts.get(conn, count)
+            if delta < 0:
+                # The connection was reset
+                delta = count
+            counts[conn] = count
+            rate = self._rates.get(conn, 0.0)
+            if elapsed > 0:
+                rate = decay * rate + (1 - decay) * delta / elapsed
+            rates[conn] = rate
+        self._counts, self._rates, self._updated = counts, rates, now
+
+    def _weights(self, connections):
+        '''The weight of each connection'''
+        per_endpoint = {}
+        for conn in connections:
+            endpoint = (conn.host, conn.port)
+            per_endpoint[endpoint] = per_endpoint.get(endpoint, 0) + 1
+        return [
+            self._rates[conn] +
+            self._depths.get((conn.host, conn.port), 0) /
+            self.DEPTH_HORIZON / per_endpoint[(conn.host, conn.port)]
+            for conn in connections]
+
+    def _rotate(self, total, connections, weights):
+        '''Choose which total of connections get RDY 1 for now'''
+        now = time.time()
+        self._held = dict(
+            (conn, self._held.get(conn, now)) for conn in connections)
+        holders = [conn for conn in self._holders if conn in self._held]
+        if now - self._rotated >= self._rotation:
+            for conn in holders:
+                self._held[conn] = now
+            holders = []
+            self._rotated = now
+        if len(holders) < total:
+            # Whoever has waited longest goes next, but busy connections'
+            # waits count for more
+            busy = set(conn for conn, weight in zip(connections, weights)
+                if weight * self._rotation >= 1)
+            waiting = [conn for conn in connections if conn not in holders]
+            waiting.sort(key=lambda conn: -(now - self._held[conn]) * (
+                self.BUSY if conn in busy else 1))
+            holders.extend(waiting[:total - len(holders)])
+        self._holders = holders
+        chosen = set(holders)
+        return [(1 if conn in chosen else 0, conn) for conn in connections]
+
+    def allocate(self, total, connections):
+        '''The (count, conn) each connection should have of total'''
+        with self._lock:
+            self._update(connections)
+            weights = self._weights(connections)
+            if len(connections) > total:
+                return self._rotate(total, connections, weights)
+            self._holders = []
+        if not any(weights):
+            return list(distribute(total, connections))
+        spare = apportion(total - len(connections), weights)
+        return [(1 + share, conn) for share, conn in zip(spare, connections)]
+
+    def plan(self, total, connections):
+        '''The (count, conn) of the RDY that should be sent'''
+        decreases, increases = [], []
+        for count, conn in self.allocate(total, connections):
+            # We cannot exceed the maximum RDY count for a connection
+            if count > conn.max_rdy_count:
+                logger.info(
+                    'Using max_rdy_count (%i) instead of %i for %s RDY',
+                    conn.max_rdy_count, count, conn)
+                count = conn.max_rdy_count
+            last = conn.last_ready_sent
+            if count < last:
+                decreases.append((count, conn))
+            elif count and conn.ready <= last * 0.25:
+                increases.append((count, conn))
+            elif count - last > last * self.SLACK:
+                increases.append((count, conn))
+        return decreases + increases
@@ -5,11 +5,16 @@ import six
 from .constants import FRAME_TYPE_RESPONSE, FRAME_TYPE_MESSAGE, FRAME_TYPE_ERROR
 from . import exceptions
 
+from collections import OrderedDict
 from contextlib import contextmanager
 import socket
 import sys
 
 
+# The frame type that prefixes every frame
+FRAME_TYPE = struct.Struct('>l')
+
+
 class Response(object):
     '''A response from NSQ'''
     FRAME_TYPE = FRAME_TYPE_RESPONSE
@@ -19,14 +24,23 @@ class Response(object):
     @staticmethod
     def from_raw(conn, raw):
         '''Return a new response from a raw buffer'''
-        frame_type = struct.unpack('>l', raw[0:4])[0]
-        message = raw[4:]
+        return Response.from_frame(
+            conn, FRAME_TYPE.unpack_from(raw)[0], raw[4:])
+
+    @staticmethod
+    def from_frame(conn, frame_type, data):
+        '''Return a new response from a decoded frame
+
+        The data may be a memoryview, in which case messages reference it
+        without copying. Responses and errors are always copied into bytes.'''
         if frame_type == FRAME_TYPE_MESSAGE:
-            return Message(conn, frame_type, message)
-        elif frame_type == FRAME_TYPE_RESPONSE:
-            return Response(conn, frame_type, message)
+            return Message(conn, frame_type, data)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if frame_type == FRAME_TYPE_RESPONSE:
+            return Response(conn, frame_type, data)
         elif frame_type == FRAME_TYPE_ERROR:
-            return Error(conn, frame_type, message)
+            return Error(conn, frame_type, data)
         else:
             raise TypeError('Unknown frame type: %s' % frame_type)
 
@@ -56,6 +70,7 @@ class Message(Response):
 
     format = '>qH16s'
     size = struct.calcsize(format)
+    header = struct.Struct(format)
 
     __slots__ = ('timestamp', 'attempts', 'id', 'body', 'processed')
 
@@ -71,8 +86,7 @@ class Message(Response):
 
     def __init__(self, conn, frame_type, data):
         Response.__init__(self, conn, frame_type, data)
-        self.timestamp, self.attempts, self.id = struct.unpack(
-            self.format, data[:self.size])
+        self.timestamp, self.attempts, self.id = self.header.unpack_from(data)
         self.body = data[self.size:]
         self.processed = False
 
@@ -124,6 +138,45 @@ class Message(Response):
                     self.connection.close()
 
 
+def _grouped(messages, key):
+    '''Messages grouped by key, in the order each key was first seen'''
+    groups = OrderedDict()
+    for message in messages:
+        groups.setdefault(key(message), []).append(message)
+    return groups.items()
+
+
+def fin_batch(messages):
+    '''Finish messages, with a single write to each of their connections'''
+    for conn, group in _grouped(messages, lambda message: message.connection):
+        try:
+            conn.fin_many([message.id for message in group])
+        except socket.error:
+            conn.close()
+            continue
+        for message in group:
+            message.processed = True
+
+
+def req_batch(messages, timeout=None):
+    '''Requeue messages, with a single write to each of their connections
+
+    Each message is delayed by timeout, or by its own delay() if None.'''
+    def key(message):
+        '''The connection and timeout for a message'''
+        return (message.connection,
+            message.delay() if timeout is None else timeout)
+
+    for (conn, delay), group in _grouped(messages, key):
+        try:
+            conn.req_many([message.id for message in group], delay)
+        except socket.error:
+            conn.close()
+            continue
+        for message in group:
+            message.processed = True
+
+
 class Error(Response):
     '''An error'''
     FRAME_TYPE = FRAME_TYPE_ERROR
@@ -0,0 +1,211 @@
+'''Strategies for choosing which connection to publish on'''
+
+import bisect
+import hashlib
+import itertools
+import random
+import threading
+
+from .exceptions import ConnectionClosedException
+
+
+class Router(object):
+    '''Router base class
+
+    Routers keep track of the living connections as they're added and removed,
+    rather than finding them again for every publish.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = []
+
+    def members(self):
+        '''The connections we're currently routing to'''
+        with self._lock:
+            return list(self._members)
+
+    def add(self, conn):
+        '''Start routing to a connection'''
+        with self._lock:
+            if conn not in self._members:
+                self._members.append(conn)
+                self._added(conn)
+
+    def remove(self, conn):
+        '''Stop routing to a connection'''
+        with self._lock:
+            if conn in self._members:
+                self._members.remove(conn)
+                self._removed(conn)
+
+    def _added(self, conn):
+        '''Invoked with our lock held when a connection is added'''
+
+    def _removed(self, conn):
+        '''Invoked with our lock held when a connection is removed'''
+
+    def choose(self, key=None):
+        '''Choose a connection, optionally for a particular key'''
+        with self._lock:
+            if not self._members:
+                raise ConnectionClosedException('No connections available')
+            return self._choose(key)
+
+    def _choose(self, key):
+        '''Choose one of our (non-empty) members with our lock held'''
+        raise NotImplementedError()
+
+    def acked(self, conn, latency):
+        '''Invoked with how long a connection took to acknowledge a publish'''
+
+
+class Random(Router):
+    '''Choose uniformly at random, preferring unsaturated connections'''
+    def _choose(self, key):
+        conn = random.choice(self._members)
+        if not conn.saturated():
+            return conn
+        unsaturated = [c for c in self._members if not c.saturated()]
+        return random.choice(unsaturated or self._members)
+
+
+class RoundRobin(Router):
+    '''Take turns, skipping over saturated connections'''
+    def __init__(self):
+        Router.__init__(self)
+        self._counter = itertools.count()
+
+    def _choose(self, key):
+        count = len(self._members)
+        start = next(self._counter)
+        for offset in range(count):
+            conn = self._members[(start + offset) % count]
+            if not conn.saturated():
+                return conn
+        return self._members[start % count]
+
+
+class LeastPending(Router):
+    '''Choose the connection with the fewest bytes waiting to be sent'''
+    def _choose(self, key):
+        return min(self._members, key=lambda conn: conn.pending_bytes())
+
+
+class Latency(Router):
+    '''Choose at random, weighted by the inverse of each connection's latency
+
+    Latency is an exponentially-weighted moving average of how long it takes a
+    connection to acknowledge a publish. Connections that haven't yet been
+    measured are weighted as the fastest one, so that they get tried.'''
+    def __init__(self, alpha=0.2):
+        Router.__init__(self)
+        self._alpha = alpha
+        self._latency = {}
+
+    def _removed(self, conn):
+        self._latency.pop(conn, None)
+
+    def latency(self, conn):
+        '''The moving average of a connection's latency, if measured'''
+        with self._lock:
+            return self._latency.get(conn)
+
+    def acked(self, conn, latency):
+        with self._lock:
+            if conn not in self._members:
+                return
+            previous = self._latency.get(conn)
+            if previous is None:
+                self._latency[conn] = latency
+            else:
+                self._latency[conn] = (
+                    self._alpha * latency + (1 - self._alpha) * previous)
+
+    def _choose(self, key):
+        measured = [l for l in self._latency.values() if l > 0]
+        fastest = min(measured) if measured else 1.0
+        weights = [
+            1.0 / (self._latency.get(conn) or fastest) for conn in self._members]
+        target = random.random() * sum(weights)
+        for conn, weight in zip(self._members, weights):
+            target -= weight
+            if target < 0:
+                return conn
+        return self._members[-1]
+
+
+class ConsistentHash(Router):
+    '''Choose by hashing a key onto a ring of nsqd instances
+
+    Messages published with the same key go to the same nsqd for as long as
+    it's alive. When nsqd instances come and go, only the keys on their part of
+    the ring move. With several connections to an nsqd, a key always uses the
+    same one of them while their number is unchanged. Messages without a key
+    are routed at random.'''
+    def __init__(self, replicas=100):
+        Router.__init__(self)
+        self._replicas = replicas
+        # Sorted points on the ring, and the (host, port) at each of them
+        self._points = []
+        self._owners = []
+        # The connections to each (host, port)
+        self._endpoints = {}
+
+    @staticmethod
+    def hash(value):
+        '''Hash a key (or point) onto the ring'''
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+    def _added(self, conn):
+        endpoint = (conn.host, conn.port)
+        connections = self._endpoints.setdefault(endpoint, [])
+        connections.append(conn)
+        if len(connections) > 1:
+            return
+        for replica in range(self._replicas):
+            point = self.hash('%s:%s-%i' % (conn.host, conn.port, replica))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, endpoint)
+
+    def _removed(self, conn):
+        endpoint = (conn.host, conn.port)
+        connections = self._endpoints[endpoint]
+        connections.remove(conn)
+        if connections:
+            return
+        del self._endpoints[endpoint]
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != endpoint]
+        self._points = [point for point, _ in keep]
+        self._owners = [owner for _, owner in keep]
+
+    def _choose(self, key):
+        if key is None:
+            return random.choice(self._members)
+        hashed = self.hash(key)
+        index = bisect.bisect(self._points, hashed)
+        connections = self._endpoints[self._owners[index % len(self._owners)]]
+        return connections[hashed % len(connections)]
+
+
+# The routers that may be selected by name
+ROUTERS = {
+    'random': Random,
+    'round_robin': RoundRobin,
+    'least_pending': LeastPending,
+    'latency': Latency,
+    'consistent_hash': ConsistentHash
+}
+
+
+def get(router=None):
+    '''Get a router from a name, an instance, or None for the default'''
+    if router is None:
+        return Random()
+    if isinstance(router, Router):
+        return router
+    try:
+        return ROUTERS[router]()
+    except KeyError:
+        raise ValueError('Unknown router %r' % (router,))
@@ -41,6 +41,11 @@ class SocketWrapper(object):
         '''Same as socket.recv'''
         raise NotImplementedError()
 
-    def recv_into(self, buff, nbytes, flags=0):
+    def recv_into(self, buff, nbytes=0, flags=0):
         '''Same as socket.recv_into'''
-        raise NotImplementedError('Wrapped sockets do not implement recv_into')
+        # Wrappers transform the data they read, so they can't read directly
+        # into the provided buffer. Instead, copy what recv produces into it.
+        data = self.recv(nbytes or len(buff), flags)
+        count = len(data)
+        buff[:count] = data
+        return count
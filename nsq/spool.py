@@ -0,0 +1,236 @@
+'''An append-only, memory-mapped spool of messages on disk'''
+
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from . import logger
+from .exceptions import SpoolFullException
+
+
+class Spool(object):
+    '''Messages waiting on disk to be published
+
+    The spool is a directory of fixed-size segment files that are each mapped
+    into memory, so appending a message is a copy rather than a write call.
+    Each record is its size and a CRC32, followed by the topic's size, the
+    topic and the message. Segments are zero-filled, so a zero size (or a bad
+    CRC, from a write that was cut short) marks the end of a segment's records.
+
+    Records are read from the position that was last committed, and the
+    position is only committed once they've been published. It's saved by
+    atomically replacing the offsets file, so after a crash, records are
+    replayed at least once. Segments are deleted once they've been read and
+    appending fails once there are max_bytes worth of them.'''
+    # The header preceding each record, and the topic's size in each record
+    HEADER = struct.Struct('>II')
+    TOPIC = struct.Struct('>H')
+    # The format of segment file names, and of the offsets file
+    SEGMENT = '%020i.spool'
+    SEGMENT_PATTERN = re.compile(r'^(\d{20})\.spool$')
+    OFFSETS = struct.Struct('>QQ')
+
+    def __init__(self, path, segment_bytes=64 * 1024 * 1024,
+        max_bytes=1024 * 1024 * 1024, sync=False):
+        self._path = path
+        self._segment_bytes = segment_bytes
+        self._max_segments = max(1, max_bytes // segment_bytes)
+        # Whether to flush each append to disk, rather than leaving that to
+        # the operating system
+        self._sync = sync
+        self._lock = threading.Lock()
+        # The mapped segments, and where each one's records end
+        self._maps = {}
+        self._ends = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._recover()
+
+    def _recover(self):
+        '''Find our segments and where we left off reading and writing'''
+        segments = sorted(
+            int(match.group(1)) for match in (
+                self.SEGMENT_PATTERN.match(name) for name in os.listdir(self._path))
+            if match)
+        self._read_segment, self._read_offset = self._load_offsets()
+        if segments and self._read_segment < segments[0]:
+            self._read_segment, self._read_offset = segments[0], 0
+        for segment in segments:
+            if segment < self._read_segment:
+                os.remove(self._segment_path(segment))
+            else:
+                self._open(segment)
+        if not self._maps:
+            self._open(self._read_segment)
+            self._read_offset = 0
+        self._write_segment = max(self._maps)
+
+    def _segment_path(self, segment):
+        '''The path to a segment file'''
+        return os.path.join(self._path, self.SEGMENT % segment)
+
+    def _offsets_path(self):
+        '''The path to our offsets file'''
+        return os.path.join(self._path, 'offsets')
+
+    def _load_offsets(self):
+        '''Load the committed read position'''
+        try:
+            with open(self._offsets_path(), 'rb') as fin:
+                return self.OFFSETS.unpack(fin.read(self.OFFSETS.size))
+        except (IOError, OSError, struct.error):
+            return 0, 0
+
+    def _save_offsets(self):
+        '''Atomically save the committed read position'''
+        path = self._offsets_path()
+        with open(path + '.tmp', 'wb') as fout:
+            fout.write(self.OFFSETS.pack(self._read_segment, self._read_offset))
+            fout.flush()
+            if self._sync:
+                os.fsync(fout.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _open(self, segment):
+        '''Map a segment into memory, finding the end of its records'''
+        path = self._segment_path(segment)
+        with open(path, 'a+b') as fout:
+            fout.truncate(self._segment_bytes)
+            self._maps[segment] = mmap.mmap(fout.fileno(), self._segment_bytes)
+        offset = 0
+        while True:
+            record = self._record(segment, offset)
+            if record is None:
+                break
+            offset = record[0]
+        self._ends[segment] = offset
+
+    def _record(self, segment, offset):
+        '''The (next offset, payload) of the record at offset, if there is one'''
+        data = self._maps[segment]
+        start = offset + self.HEADER.size
+        if start > self._segment_bytes:
+            return None
+        size, crc = self.HEADER.unpack_from(data, offset)
+        end = start + size
+        if size == 0 or end > self._segment_bytes:
+            return None
+        payload = data[start:end]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return end, payload
+
+    def append(self, topic, message):
+        '''Append a message for a topic'''
+        self.extend(topic, [message])
+
+    def extend(self, topic, messages):
+        '''Append messages for a topic
+
+        Either all of the messages are appended, or SpoolFullException is
+        raised having appended none of them.'''
+        prefix = self.TOPIC.pack(len(topic)) + topic
+        records = []
+        for message in messages:
+            payload = prefix + message
+            record = self.HEADER.pack(
+                len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+            if len(record) > self._segment_bytes:
+                raise SpoolFullException(
+                    'Message of %i bytes is too large to spool' % len(message))
+            records.append(record)
+        with self._lock:
+            if len(self._maps) + self._rotations(records) > self._max_segments:
+                raise SpoolFullException('Spool at %s is full' % self._path)
+            for record in records:
+                offset = self._ends[self._write_segment]
+                if offset + len(record) > self._segment_bytes:
+                    self._rotate()
+                    offset = 0
+                data = self._maps[self._write_segment]
+                data[offset:offset + len(record)] = record
+                self._ends[self._write_segment] = offset + len(record)
+                if self._sync:
+                    data.flush()
+
+    def _rotations(self, records):
+        '''How many new segments appending records would take'''
+        rotations = 0
+        offset = self._ends[self._write_segment]
+        for record in records:
+            if offset + len(record) > self._segment_bytes:
+                rotations += 1
+                offset = 0
+            offset += len(record)
+        return rotations
+
+    def _rotate(self):
+        '''Start writing to a new segment'''
+        if len(self._maps) >= self._max_segments:
+            raise SpoolFullException('Spool at %s is full' % self._path)
+        self._maps[self._write_segment].flush()
+        self._write_segment += 1
+        self._open(self._write_segment)
+        logger.info('Rotated spool to segment %i', self._write_segment)
+
+    def read(self, max_count=None, max_bytes=None):
+        '''Read records for one topic without committing them
+
+        Reads consecutive records from where we last committed, stopping before
+        any for a different topic. Returns the position to commit once they've
+        been handled, the topic, and the messages.'''
+        topic = None
+        messages = []
+        size = 0
+        with self._lock:
+            segment, offset = self._read_segment, self._read_offset
+            while max_count is None or len(messages) < max_count:
+                if offset >= self._ends[segment]:
+                    if segment == self._write_segment:
+                        break
+                    segment, offset = segment + 1, 0
+                    continue
+                end, payload = self._record(segment, offset)
+                length, = self.TOPIC.unpack_from(payload)
+                start = self.TOPIC.size + length
+                if messages:
+                    if payload[self.TOPIC.size:start] != topic:
+                        break
+                    if max_bytes is not None and size + len(payload) > max_bytes:
+                        break
+                else:
+                    topic = payload[self.TOPIC.size:start]
+                messages.append(payload[start:])
+                size += len(payload)
+                offset = end
+        return (segment, offset), topic, messages
+
+    def commit(self, position):
+        '''Commit having handled the records before a position from read'''
+        with self._lock:
+            self._read_segment, self._read_offset = position
+            self._save_offsets()
+            for segment in [s for s in self._maps if s < self._read_segment]:
+                self._maps.pop(segment).close()
+                self._ends.pop(segment)
+                os.remove(self._segment_path(segment))
+
+    def size(self):
+        '''How many bytes of records have yet to be committed'''
+        with self._lock:
+            return sum(self._ends.values()) - self._read_offset
+
+    def empty(self):
+        '''Whether there's nothing left to read'''
+        return self.size() == 0
+
+    def close(self):
+        '''Flush and unmap our segments'''
+        with self._lock:
+            for data in self._maps.values():
+                data.flush()
+                data.close()
+            self._maps.clear()
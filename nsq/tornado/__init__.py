@@ -0,0 +1,10 @@
+'''A tornado-based client'''
+
+from __future__ import absolute_import
+
+# Tornado's IOLoop runs on asyncio, so the tornado client is the asyncio client
+# with its connections reading and writing through IOStreams. By importing this
+# here, it makes a tornado-compatible client available from nsq.tornado
+from .connection import Connection
+from .producer import Producer
+from .reader import Reader
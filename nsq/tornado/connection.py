@@ -0,0 +1,86 @@
+'''A connection to nsqd over a tornado IOStream'''
+
+from datetime import timedelta
+from functools import partial
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from ..asyncio import connection
+from ..exceptions import ConnectionClosedException
+
+
+class Connection(connection.Connection):
+    '''A connection to nsqd that reads and writes through an IOStream
+
+    Frames are read directly into the decoder's buffer. Since IOStream doesn't
+    apply flow control of its own, fin, req and touch wait once more than
+    high_water bytes have been written but not yet flushed, until no more than
+    low_water bytes remain.'''
+    def __init__(self, host, port, read_size=64 * 1024, high_water=64 * 1024,
+        low_water=16 * 1024, **kwargs):
+        self._read_size = read_size
+        self._high_water = high_water
+        self._low_water = low_water
+        connection.Connection.__init__(self, host, port, **kwargs)
+
+    def _reset(self):
+        '''Reset all of our stateful variables'''
+        connection.Connection._reset(self)
+        # How many bytes have been written, but not yet flushed
+        self._unflushed = 0
+
+    def __str__(self):
+        state = 'alive' if self.alive() else 'dead'
+        return '<tornado.Connection %s:%s (%s)>' % (self.host, self.port, state)
+
+    def alive(self):
+        '''Returns True if this connection is alive'''
+        return self._transport is not None and not self._transport.closed()
+
+    def pending_bytes(self):
+        '''How many bytes have been written, but not yet flushed'''
+        return self._unflushed
+
+    async def _open(self):
+        '''Open the stream and start reading from it'''
+        stream = await gen.with_timeout(
+            timedelta(seconds=self._timeout),
+            TCPClient().connect(self.host, self.port))
+        self.connection_made(stream)
+        IOLoop.current().spawn_callback(self._read_forever, stream)
+
+    async def _read_forever(self, stream):
+        '''Read and dispatch frames until the stream is closed'''
+        try:
+            while True:
+                count = await stream.read_into(
+                    self._decoder.reserve(self._read_size), partial=True)
+                self._decoder.commit(count)
+                self._decoded()
+        except StreamClosedError:
+            # The stream may have been replaced by a reconnection
+            if stream is self._transport:
+                self.connection_lost(stream.error)
+
+    def _write(self, data):
+        '''Send data that's already been encoded'''
+        if self._transport is None:
+            raise ConnectionClosedException()
+        size = len(data)
+        self._unflushed += size
+        self._transport.write(data).add_done_callback(
+            partial(self._flushed, size))
+        if not self._paused and self._unflushed > self._high_water:
+            self.pause_writing()
+
+    def _flushed(self, size, future):
+        '''Account for data that has been flushed to the socket'''
+        # If the stream was closed, the reason is handled by the reader
+        if not future.cancelled():
+            future.exception()
+        self._unflushed -= size
+        if self._paused and self._unflushed <= self._low_water:
+            self.resume_writing()
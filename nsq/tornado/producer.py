@@ -0,0 +1,9 @@
+'''A tornado client for publishing'''
+
+from ..asyncio import producer
+from .connection import Connection
+
+
+class Producer(producer.Producer):
+    '''Publish messages on the IOLoop, awaiting nsqd's confirmation of each'''
+    connection_class = Connection
@@ -0,0 +1,43 @@
+'''A tornado client meant exclusively for reading'''
+
+import inspect
+
+from tornado.ioloop import IOLoop
+
+from .. import logger
+from ..asyncio import reader
+from .connection import Connection
+
+
+class Reader(reader.Reader):
+    '''Consume a topic and channel on the IOLoop
+
+    Messages are iterated over with `async for`, or if a message_handler is
+    provided, it's invoked with each message as it arrives. The handler may be
+    a plain callback or a coroutine. Messages are finished once the handler
+    returns and requeued if it raises, unless the handler has already done one
+    or the other.'''
+    connection_class = Connection
+
+    def __init__(self, topic, channel, message_handler=None, **kwargs):
+        self._message_handler = message_handler
+        reader.Reader.__init__(self, topic, channel, **kwargs)
+
+    def received(self, message):
+        '''Hand a message to our handler, or queue it up to be iterated over'''
+        if self._message_handler is None:
+            return reader.Reader.received(self, message)
+        IOLoop.current().spawn_callback(self._handle, message)
+        # Redistribute our ready state if necessary
+        if self.needs_distribute_ready():
+            self.distribute_ready()
+
+    async def _handle(self, message):
+        '''Invoke our handler with a message'''
+        try:
+            async with message.handle():
+                result = self._message_handler(message)
+                if inspect.isawaitable(result):
+                    await result
+        except Exception:
+            logger.exception('Failed to handle %s', message)
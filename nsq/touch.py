@@ -0,0 +1,141 @@
+'''Touching in-flight messages before nsqd gives up on them'''
+
+import heapq
+import itertools
+import socket
+import threading
+import time
+
+from . import logger
+from .checker import StoppableThread
+
+
+class Toucher(StoppableThread):
+    '''A thread that touches in-flight messages before they time out
+
+    Each message is touched once fraction of its connection's msg_timeout has
+    passed since it was received or last touched, until it's finished or
+    requeued. Messages are kept in a heap of deadlines for each connection,
+    and those that come due together are touched in a single write to their
+    connection.'''
+    # The msg_timeout nsqd uses by default, for connections that haven't told
+    # us theirs
+    DEFAULT_MSG_TIMEOUT = 60.0
+    # Touches due within this many seconds (or a tenth of the interval between
+    # touches, if less) of each other are sent together
+    TICK = 0.5
+
+    def __init__(self, fraction=0.5):
+        StoppableThread.__init__(self)
+        self.daemon = True
+        self._fraction = fraction
+        self._changed = threading.Condition()
+        # A heap of (deadline, sequence, message) for each connection. Messages
+        # that have been finished or requeued are dropped as they come up
+        self._heaps = {}
+        self._sequence = itertools.count()
+
+    def interval(self, conn):
+        '''How long to wait between touches of a message on a connection'''
+        return self._fraction * (conn.msg_timeout or self.DEFAULT_MSG_TIMEOUT)
+
+    def track(self, message):
+        '''Start touching a message that's just been received'''
+        conn = message.connection
+        deadline = time.time() + self.interval(conn)
+        with self._changed:
+            earliest = self._earliest()
+            heap = self._heaps.setdefault(conn, [])
+            heapq.heappush(heap, (deadline, next(self._sequence), message))
+            # Don't let the messages that have been handled pile up
+            if len(heap) > 2 * conn.in_flight + 64:
+                heap[:] = [entry for entry in heap if not entry[2].processed]
+                heapq.heapify(heap)
+            if earliest is None or deadline < earliest:
+                self._changed.notify()
+
+    def forget(self, conn):
+        '''Stop touching the messages on a connection'''
+        with self._changed:
+            self._heaps.pop(conn, None)
+
+    def pending(self, conn):
+        '''How many messages on a connection may still need touching'''
+        with self._changed:
+            return len(self._heaps.get(conn, ()))
+
+    def _earliest(self):
+        '''The earliest deadline of any message, or None'''
+        deadlines = [heap[0][0] for heap in self._heaps.values() if heap]
+        return min(deadlines) if deadlines else None
+
+    def _due(self, now):
+        '''Pop the messages due by now on each connection'''
+        due = []
+        for conn, heap in list(self._heaps.items()):
+            if not conn.alive():
+                del self._heaps[conn]
+                continue
+            messages = []
+            tick = min(self.TICK, self.interval(conn) / 10.0)
+            while heap and heap[0][0] <= now + tick:
+                message = heapq.heappop(heap)[2]
+                if not message.processed:
+                    messages.append(message)
+            if not heap:
+                del self._heaps[conn]
+            if messages:
+                due.append((conn, messages))
+        return due
+
+    def touch(self, now=None):
+        '''Touch the messages that are due, returning how many were touched'''
+        now = time.time() if now is None else now
+        with self._changed:
+            due = self._due(now)
+        touched = 0
+        for conn, messages in due:
+            try:
+                conn.touch_many([message.id for message in messages])
+                # The read loop may be blocked in a handler, so it can't be
+                # relied upon to send the touches
+                conn.flush_now()
+            except socket.error:
+                logger.exception('Failed to touch messages on %s', conn)
+                conn.close()
+                continue
+            touched += len(messages)
+            deadline = now + self.interval(conn)
+            with self._changed:
+                heap = self._heaps.setdefault(conn, [])
+                for message in messages:
+                    if not message.processed:
+                        heapq.heappush(
+                            heap, (deadline, next(self._sequence), message))
+        return touched
+
+    def delay(self):
+        '''How long until the next message is due to be touched, or None'''
+        earliest = self._earliest()
+        if earliest is None:
+            return None
+        return max(0, earliest - time.time())
+
+    def run(self):
+        '''Touch messages as they come due until stopped'''
+        while not self._event.is_set():
+            with self._changed:
+                if not self._event.is_set():
+                    self._changed.wait(self.delay())
+            if self._event.is_set():
+                break
+            try:
+                self.touch()
+            except Exception:
+                logger.exception('Failed to touch messages')
+
+    def stop(self):
+        '''Stop touching messages'''
+        with self._changed:
+            StoppableThread.stop(self)
+            self._changed.notify()
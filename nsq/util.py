@@ -47,3 +47,17 @@ def distribute(total, objects):
         start = (index * total) // len(objects)
         stop = ((index + 1) * total) // len(objects)
         yield (stop - start, obj)
+
+
+def apportion(total, weights):
+    '''Split total into whole numbers in proportion to weights'''
+    whole = float(sum(weights))
+    parts = []
+    cumulative = 0
+    previous = 0
+    for weight in weights:
+        cumulative += weight
+        boundary = int(total * cumulative / whole) if whole else 0
+        parts.append(boundary - previous)
+        previous = boundary
+    return parts
@@ -15,8 +15,11 @@ setup(name               = 'nsq-py',
     author_email         = 'dan@moz.com',
     license              = "MIT License",
     keywords             = 'nsq, queue',
-    packages             = ['nsq', 'nsq.http', 'nsq.sockets'],
-    package_dir          = {'nsq': 'nsq', 'nsq.http': 'nsq/http', 'nsq.sockets': 'nsq/sockets'},
+    packages             = [
+        'nsq', 'nsq.asyncio', 'nsq.http', 'nsq.sockets', 'nsq.tornado'],
+    package_dir          = {'nsq': 'nsq', 'nsq.asyncio': 'nsq/asyncio',
+        'nsq.http': 'nsq/http', 'nsq.sockets': 'nsq/sockets',
+        'nsq.tornado': 'nsq/tornado'},
     classifiers          = [
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
@@ -27,8 +30,12 @@ setup(name               = 'nsq-py',
         'requests',
         'decorator',
         'six',
-        'statsd'
+        'statsd',
+        'futures; python_version < "3"'
     ],
+    extras_require={
+        'tornado': ['tornado']
+    },
     tests_requires=[
         'nose',
         'coverage'
@@ -71,6 +71,354 @@ def basic(topic='topic', channel='channel', count=1e6, size=10, gevent=False,
         count, start, count / start))
 
 
+@task
+def tornado(topic='topic', channel='channel', count=1e5, size=10,
+    max_in_flight=2500, profile=False):
+    '''Publish and consume with the tornado client, then the threaded one'''
+    import asyncio
+    from tornado.ioloop import IOLoop
+    from nsq import client
+    from nsq.reader import Reader
+    from nsq import tornado
+
+    count = int(count)
+    size = int(size)
+    max_in_flight = int(max_in_flight)
+    bodies = [m.encode() for m in messages(count, size)]
+
+    async def run():
+        async with tornado.Producer(['localhost:4150']) as producer:
+            start = -time.time()
+            await asyncio.gather(*[
+                producer.mpub(topic.encode(), *batch)
+                for batch in grouper(bodies, 1000)])
+            start += time.time()
+        print('tornado: published %i messages in %fs (%5.2f messages / second)' % (
+            count, start, count / start))
+
+        async with tornado.Reader(topic.encode(), channel.encode(),
+            nsqd_tcp_addresses=['localhost:4150'],
+            max_in_flight=max_in_flight) as reader:
+            start = -time.time()
+            consumed = 0
+            async for message in reader:
+                await message.fin()
+                consumed += 1
+                if consumed == count:
+                    break
+            start += time.time()
+        print('tornado: consumed %i messages in %fs (%5.2f messages / second)' % (
+            count, start, count / start))
+
+    def threaded():
+        producer = client.Client(nsqd_tcp_addresses=['localhost:4150'])
+        with closing(producer):
+            start = -time.time()
+            for batch in grouper(bodies, 1000):
+                producer.mpub(topic.encode(), *batch)
+            start += time.time()
+        print('threaded: published %i messages in %fs (%5.2f messages / second)' % (
+            count, start, count / start))
+
+        reader = Reader(topic.encode(), channel.encode(),
+            nsqd_tcp_addresses=['localhost:4150'], max_in_flight=max_in_flight)
+        with closing(reader):
+            start = -time.time()
+            for message in islice(reader, count):
+                message.fin()
+            start += time.time()
+        print('threaded: consumed %i messages in %fs (%5.2f messages / second)' % (
+            count, start, count / start))
+
+    if profile:
+        with profiler():
+            IOLoop.current().run_sync(run)
+            threaded()
+    else:
+        IOLoop.current().run_sync(run)
+        threaded()
+
+
+@task
+def produce(topic='topic', count=1e5, size=10, profile=False):
+    '''Compare Client.pub against the pipelined Producer, with and without
+    batching'''
+    from concurrent.futures import wait
+    from nsq.client import Client
+    from nsq.producer import Producer
+
+    count = int(count)
+    size = int(size)
+    topic = topic.encode()
+    bodies = [m.encode() for m in messages(count, size)]
+
+    def client():
+        with closing(Client(nsqd_tcp_addresses=['localhost:4150'])) as nsq:
+            for body in bodies:
+                nsq.pub(topic, body)
+
+    def producer(**kwargs):
+        nsq = Producer(nsqd_tcp_addresses=['localhost:4150'], **kwargs)
+        with closing(nsq):
+            with nsq.running():
+                wait([nsq.pub(topic, body) for body in bodies])
+            return nsq
+
+    def batched():
+        stats = producer(batch=True).batch_stats()
+        print('Sent %(batches)i batches (%(mean_size)5.2f messages each)' % stats)
+
+    benchmarks = (
+        ('Client', client), ('Producer', producer), ('Batched', batched))
+    for name, function in benchmarks:
+        start = -time.time()
+        if profile:
+            with profiler():
+                function()
+        else:
+            function()
+        start += time.time()
+        print('%10s: published %i messages in %fs (%5.2f messages / second)' % (
+            name, count, start, count / start))
+
+
+@task
+def connections(topic='topic', channel='channel', count=1e5, size=10,
+    max_in_flight=2500, counts='1,2,4,8'):
+    '''Publish and consume with more and more connections to the same nsqd'''
+    from concurrent.futures import wait
+    from nsq.producer import Producer
+    from nsq.reader import Reader
+
+    count = int(count)
+    size = int(size)
+    max_in_flight = int(max_in_flight)
+    topic = topic.encode()
+    channel = channel.encode()
+    bodies = [m.encode() for m in messages(count, size)]
+
+    for per_nsqd in [int(n) for n in counts.split(',')]:
+        producer = Producer(nsqd_tcp_addresses=['localhost:4150'],
+            router='round_robin', connections_per_nsqd=per_nsqd)
+        with closing(producer):
+            with producer.running():
+                start = -time.time()
+                wait([producer.pub(topic, body) for body in bodies])
+                start += time.time()
+        print('%2i connections: published %i messages in %fs '
+            '(%5.2f messages / second)' % (
+                per_nsqd, count, start, count / start))
+
+        reader = Reader(topic, channel, nsqd_tcp_addresses=['localhost:4150'],
+            max_in_flight=max_in_flight, connections_per_nsqd=per_nsqd)
+        with closing(reader):
+            start = -time.time()
+            for message in islice(reader, count):
+                message.fin()
+            start += time.time()
+        print('%2i connections: consumed %i messages in %fs '
+            '(%5.2f messages / second)' % (
+                per_nsqd, count, start, count / start))
+
+
+@task
+def decode(path=None, count=1e6, size=100, chunk=4096, zero_copy=False,
+    profile=False):
+    '''Benchmark the frame decoder on a recorded stream of bytes
+
+    If no path to a recorded stream is provided, one is synthesized from count
+    messages of the provided size.'''
+    from nsq.decoder import FrameDecoder
+    from nsq.response import Message
+
+    count = int(count)
+    size = int(size)
+    chunk = int(chunk)
+
+    if path:
+        with open(path, 'rb') as fin:
+            stream = fin.read()
+    else:
+        stream = Message.pack(0, 1, b'0' * 16, b'x' * size) * count
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+
+    def run():
+        decoder = FrameDecoder(zero_copy=zero_copy)
+        frames = 0
+        for data in chunks:
+            decoder.feed(data)
+            frames += len(decoder.decode()[0])
+        return frames
+
+    start = -time.time()
+    if profile:
+        with profiler():
+            frames = run()
+    else:
+        frames = run()
+    start += time.time()
+    print('Decoded %i frames (%i bytes) in %fs (%5.2f frames / second, '
+        '%5.2f MB / second)' % (
+            frames, len(stream), start, frames / start,
+            len(stream) / start / (1024 * 1024)))
+
+
+@task
+def commands(count=1e6):
+    '''Compare the command encoders against naive concatenation'''
+    import six
+    from nsq import commands, constants
+
+    count = int(count)
+    message_id = b'0123456789abcdef'
+    ids = [message_id] * 100
+
+    def naive_fin():
+        for _ in range(count):
+            constants.FIN + b' ' + message_id + constants.NL
+
+    def naive_rdy():
+        for i in range(count):
+            constants.RDY + b' ' + six.text_type(i % 2500).encode() + constants.NL
+
+    def naive_req():
+        for _ in range(count):
+            (constants.REQ + b' ' + message_id + b' ' +
+                six.text_type(60).encode() + constants.NL)
+
+    def naive_fin_batch():
+        for _ in range(count // len(ids)):
+            b''.join(constants.FIN + b' ' + i + constants.NL for i in ids)
+
+    def encoded_fin():
+        fin = commands.fin
+        for _ in range(count):
+            fin(message_id)
+
+    def encoded_rdy():
+        rdy = commands.rdy
+        for i in range(count):
+            rdy(i % 2500)
+
+    def encoded_req():
+        req = commands.req
+        for _ in range(count):
+            req(message_id, 60)
+
+    def encoded_fin_batch():
+        fin_many = commands.fin_many
+        for _ in range(count // len(ids)):
+            fin_many(ids)
+
+    benchmarks = (
+        ('FIN', naive_fin, encoded_fin),
+        ('RDY', naive_rdy, encoded_rdy),
+        ('REQ', naive_req, encoded_req),
+        ('FIN x %i' % len(ids), naive_fin_batch, encoded_fin_batch))
+    for name, naive, encoded in benchmarks:
+        results = []
+        for function in (naive, encoded):
+            start = -time.time()
+            function()
+            start += time.time()
+            results.append(start)
+        print('%10s: naive %fs, encoded %fs (%5.2fx)' % (
+            name, results[0], results[1], results[0] / results[1]))
+
+
+@task
+def selector(connections=500, active=10, rounds=1000, profile=False):
+    '''Compare select and a registered selector for many idle connections
+
+    Each round, a few of the connections receive a response while the rest stay
+    idle. Note that select can't handle file descriptors past FD_SETSIZE
+    (usually 1024), and each connection here uses two of them.'''
+    import mock
+    import random
+    import socket
+    import struct
+    from nsq import client, connection, constants
+
+    connections = int(connections)
+    active = int(active)
+    rounds = int(rounds)
+    data = b'hello'
+    frame = struct.pack(
+        '>ll', len(data) + 4, constants.FRAME_TYPE_RESPONSE) + data
+
+    def run(use_selector):
+        nsq = client.Client(timeout=1, selector=use_selector)
+        servers = []
+        for port in range(connections):
+            # Each connection is backed by a socketpair rather than nsqd
+            with mock.patch.object(connection.Connection, 'connect'):
+                conn = connection.Connection('localhost', port)
+            conn._reset()
+            conn._socket, server = socket.socketpair()
+            conn.setblocking(0)
+            nsq.add(conn)
+            servers.append(server)
+
+        responses = 0
+        start = -time.time()
+        with (profiler() if profile else closing(nsq)):
+            for _ in range(rounds):
+                for server in random.sample(servers, active):
+                    server.sendall(frame)
+                remaining = active
+                while remaining > 0:
+                    count = len(nsq.read())
+                    remaining -= count
+                    responses += count
+        start += time.time()
+        nsq.close()
+        for server in servers:
+            server.close()
+        return responses, start
+
+    for name, use_selector in (('select', False), ('selector', True)):
+        responses, duration = run(use_selector)
+        print('%10s: %i responses over %i connections in %fs '
+            '(%5.2f rounds / second)' % (
+                name, responses, connections, duration, rounds / duration))
+
+
+@task
+def spool(count=1e6, size=100, segment=64 * 1024 * 1024):
+    '''Append to and replay from a spool, as a producer would in an outage'''
+    import shutil
+    import tempfile
+    from nsq.spool import Spool
+
+    count = int(count)
+    segment = int(segment)
+    message = b'x' * int(size)
+    path = tempfile.mkdtemp()
+    try:
+        spooled = Spool(path, segment_bytes=segment, max_bytes=1 << 40)
+        start = -time.time()
+        for _ in range(count):
+            spooled.append(b'topic', message)
+        start += time.time()
+        print('Appended %i messages in %fs (%f messages / second)' % (
+            count, start, count / start))
+
+        replayed = 0
+        start = -time.time()
+        while True:
+            position, _, messages = spooled.read(100)
+            if not messages:
+                break
+            spooled.commit(position)
+            replayed += len(messages)
+        start += time.time()
+        print('Replayed %i messages in %fs (%f messages / second)' % (
+            replayed, start, replayed / start))
+        spooled.close()
+    finally:
+        shutil.rmtree(path)
+
+
 @task
 def stats():
     '''Read a stream of floats and give summary statistics'''
@@ -0,0 +1,89 @@
+import asyncio
+import struct
+
+from nsq import constants
+from nsq import json
+from nsq.response import Response, Error, Message
+
+
+def message(_id, body, attempts=1):
+    '''Pack a message frame'''
+    return Message.pack(0, attempts, _id.ljust(16, b'0'), body)
+
+
+class FakeNsqd(object):
+    '''Just enough of nsqd to exercise the asyncio client'''
+    def __init__(self):
+        self.server = None
+        self.commands = []
+        self.published = []
+        self.writers = []
+        # Messages to send once there's enough RDY for them
+        self.messages = []
+        self.ready = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, '127.0.0.1', 0)
+        return self
+
+    @property
+    def address(self):
+        '''The host:port of this server'''
+        return '127.0.0.1:%i' % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def body(self, reader):
+        '''Read a size-prefixed body'''
+        size = struct.unpack('>l', await reader.readexactly(4))[0]
+        return await reader.readexactly(size)
+
+    def send(self, writer):
+        '''Send as many messages as we're ready for'''
+        while self.messages and self.ready > 0:
+            writer.write(self.messages.pop(0))
+            self.ready -= 1
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        assert (await reader.readexactly(4)) == constants.MAGIC_V2
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.strip().split(b' ')
+            self.commands.append(command)
+            name = command[0]
+            if name == constants.IDENTIFY:
+                json.loads(await self.body(reader))
+                writer.write(Response.pack(json.dumps(
+                    {'max_rdy_count': 2500, 'msg_timeout': 60000}).encode()))
+            elif name == constants.SUB:
+                writer.write(Response.pack(b'OK'))
+            elif name == constants.PUB:
+                body = await self.body(reader)
+                if command[1] == b'bad':
+                    writer.write(Error.pack(b'E_BAD_TOPIC bad topic'))
+                else:
+                    self.published.append(body)
+                    writer.write(Response.pack(b'OK'))
+            elif name == constants.DPUB:
+                self.published.append((int(command[2]), await self.body(reader)))
+                writer.write(Response.pack(b'OK'))
+            elif name == constants.MPUB:
+                await self.body(reader)
+                writer.write(Response.pack(b'OK'))
+            elif name == constants.RDY:
+                self.ready = int(command[1])
+                self.send(writer)
+            elif name == constants.FIN:
+                if command[1].startswith(b'missing'):
+                    writer.write(Error.pack(b'E_FIN_FAILED missing'))
+            elif name == constants.CLS:
+                writer.write(Response.pack(b'CLOSE_WAIT'))
+            await writer.drain()
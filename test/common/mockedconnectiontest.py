@@ -12,17 +12,34 @@ class MockConnection(mock.Mock):
         self.port = port
         self._responses = []
         self._alive = True
+        self.received = 0
+        self.msg_timeout = None
+        self.in_flight = 0
+        self.ready = self.last_ready_sent = 0
+        self.max_rdy_count = 2500
+        # Keep track of the RDY sent, as a real connection would
+        self.rdy = mock.Mock(side_effect=self._rdy)
+
+    def _rdy(self, count):
+        self.ready = self.last_ready_sent = count
 
     def read(self):
         '''Return all of our responses'''
-        found = list(self._responses)
-        self._responses = []
+        # Swapped in one step, so that responses added from other threads
+        # aren't lost
+        found, self._responses = self._responses, []
         return found
 
     def response(self, message):
         self._responses.append(
             response.Response(self, response.Response.FRAME_TYPE, message))
 
+    def message(self, body, message_id=b'0' * 16):
+        '''Send a message'''
+        self._responses.append(response.Message(
+            self, response.Message.FRAME_TYPE,
+            response.Message.header.pack(0, 1, message_id) + body))
+
     def error(self, exception):
         '''Send an error'''
         self._responses.append(
@@ -31,6 +48,12 @@ class MockConnection(mock.Mock):
     def alive(self):
         return self._alive
 
+    def ack_deadline(self):
+        return None
+
+    def saturated(self):
+        return False
+
     def close(self):
         self._alive = False
 
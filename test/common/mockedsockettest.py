@@ -34,6 +34,11 @@ class MockSocket(mock.Mock):
             self._to_client_buffer[:limit], self._to_client_buffer[limit:])
         return data
 
+    def recv_into(self, buff, nbytes=0):
+        data = self.recv(nbytes or len(buff))
+        buff[:len(data)] = data
+        return len(data)
+
     def response(self, message):
         '''Send the provided message as a response'''
         self.write(response.Response.pack(message))
@@ -52,11 +57,11 @@ class MockSocket(mock.Mock):
 
 class MockedSocketTest(unittest.TestCase):
     '''A test where socket is patched'''
-    def connect(self, identify_response=None):
+    def connect(self, identify_response=None, **kwargs):
         sock = MockSocket()
         sock.identify(identify_response)
         with mock.patch('nsq.connection.socket.socket', return_value=sock):
-            return connection.Connection('localhost', 1234, 0.01)
+            return connection.Connection('localhost', 1234, 0.01, **kwargs)
 
     def setUp(self):
         self.connection = self.connect()
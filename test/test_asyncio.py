@@ -0,0 +1,378 @@
+import asyncio
+import mock
+import unittest
+
+from nsq import backoff
+from nsq import constants
+from nsq import exceptions
+from nsq import json
+from nsq import routing
+from nsq.asyncio import Connection, Message, Producer, Reader, use_uvloop
+from nsq.response import Response, Error
+
+from common.fakensqd import FakeNsqd, message
+
+
+class FakeTransport(object):
+    '''A transport that records what's written to it'''
+    def __init__(self):
+        self.written = []
+        self.closing = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+
+
+class TestConnection(unittest.IsolatedAsyncioTestCase):
+    '''Tests for the asyncio protocol'''
+    async def asyncSetUp(self):
+        self.messages = []
+        self.closed = []
+        self.connection = Connection(
+            'localhost', 4150, on_message=self.messages.append,
+            on_close=self.closed.append)
+        self.transport = FakeTransport()
+        self.connection.connection_made(self.transport)
+
+    def test_magic(self):
+        '''Sends the magic as soon as it's connected'''
+        self.assertEqual(self.transport.written, [constants.MAGIC_V2])
+
+    def test_alive(self):
+        self.assertTrue(self.connection.alive())
+
+    def test_unsupported(self):
+        '''Raises an exception for options that wrap the socket'''
+        for key in ('tls_v1', 'snappy', 'deflate'):
+            self.assertRaises(exceptions.UnsupportedException,
+                Connection, 'localhost', 4150, **{key: True})
+
+    async def test_responses_in_order(self):
+        '''Matches responses to commands in the order they were sent'''
+        first = self.connection.pub(b'topic', b'first')
+        second = self.connection.sub(b'topic', b'channel')
+        self.connection.data_received(
+            Response.pack(b'one') + Response.pack(b'two'))
+        self.assertEqual((await first).data, b'one')
+        self.assertEqual((await second).data, b'two')
+
+    async def test_partial_frames(self):
+        '''Waits for a frame to be complete'''
+        future = self.connection.pub(b'topic', b'first')
+        frame = Response.pack(b'OK')
+        self.connection.data_received(frame[:5])
+        self.assertFalse(future.done())
+        self.connection.data_received(frame[5:])
+        self.assertEqual((await future).data, b'OK')
+
+    async def test_error(self):
+        '''Raises the error sent in response to a command'''
+        future = self.connection.pub(b'topic', b'first')
+        self.connection.data_received(Error.pack(b'E_BAD_TOPIC bad'))
+        with self.assertRaises(exceptions.BadTopicException):
+            await future
+
+    async def test_nonfatal_error(self):
+        '''Non-fatal errors don't answer a command'''
+        future = self.connection.pub(b'topic', b'first')
+        self.connection.data_received(Error.pack(b'E_FIN_FAILED nope'))
+        self.assertFalse(future.done())
+
+    async def test_heartbeat(self):
+        '''Responds to heartbeats without answering a command'''
+        future = self.connection.pub(b'topic', b'first')
+        self.connection.data_received(Response.pack(constants.HEARTBEAT))
+        self.assertFalse(future.done())
+        self.assertEqual(
+            self.transport.written[-1], constants.NOP + constants.NL)
+
+    async def test_cancelled_waiter(self):
+        '''A cancelled command still consumes its response'''
+        first = self.connection.pub(b'topic', b'first')
+        second = self.connection.pub(b'topic', b'second')
+        first.cancel()
+        self.connection.data_received(
+            Response.pack(b'one') + Response.pack(b'two'))
+        self.assertEqual((await second).data, b'two')
+
+    async def test_messages(self):
+        '''Passes messages along, and decrements ready'''
+        self.connection.rdy(5)
+        self.connection.data_received(
+            message(b'a', b'hello') + message(b'b', b'world'))
+        self.assertEqual([m.body for m in self.messages], [b'hello', b'world'])
+        self.assertIsInstance(self.messages[0], Message)
+        self.assertEqual(self.connection.ready, 3)
+
+    async def test_connection_lost(self):
+        '''Fails everything waiting on a response when lost'''
+        future = self.connection.pub(b'topic', b'first')
+        self.connection.connection_lost(None)
+        with self.assertRaises(exceptions.ConnectionClosedException):
+            await future
+        self.assertEqual(self.closed, [self.connection])
+        self.assertFalse(self.connection.alive())
+
+    async def test_write_closed(self):
+        '''Raises when writing to a closed connection'''
+        self.connection.connection_lost(None)
+        with self.assertRaises(exceptions.ConnectionClosedException):
+            await self.connection.fin(b'a' * 16)
+
+    async def test_fin(self):
+        '''Writes a FIN'''
+        await self.connection.fin(b'a' * 16)
+        self.assertEqual(self.transport.written[-1], b'FIN ' + b'a' * 16 + b'\n')
+
+    async def test_fin_paused(self):
+        '''Waits for the transport to drain when paused'''
+        self.connection.pause_writing()
+        task = asyncio.ensure_future(self.connection.fin(b'a' * 16))
+        await asyncio.sleep(0)
+        self.assertFalse(task.done())
+        self.connection.resume_writing()
+        await task
+
+    async def test_message_handle(self):
+        '''Finishes a message that's handled successfully'''
+        self.connection.data_received(message(b'a', b'hello'))
+        async with self.messages[0].handle():
+            pass
+        self.assertTrue(self.messages[0].processed)
+        self.assertTrue(self.transport.written[-1].startswith(b'FIN '))
+
+    async def test_message_handle_exception(self):
+        '''Requeues a message that raises an exception'''
+        self.connection.data_received(message(b'a', b'hello'))
+        with self.assertRaises(ValueError):
+            async with self.messages[0].handle():
+                raise ValueError('boom')
+        self.assertTrue(self.transport.written[-1].startswith(b'REQ '))
+
+    def test_identified(self):
+        '''Picks up settings from the identify response'''
+        res = Response(self.connection, constants.FRAME_TYPE_RESPONSE,
+            json.dumps({'max_rdy_count': 10, 'msg_timeout': 5000}).encode())
+        self.connection.identified(res)
+        self.assertEqual(self.connection.max_rdy_count, 10)
+        self.assertEqual(self.connection.msg_timeout, 5.0)
+
+    def test_identified_auth_required(self):
+        '''Raises if auth is required but no secret was provided'''
+        res = Response(self.connection, constants.FRAME_TYPE_RESPONSE,
+            json.dumps({'auth_required': True}).encode())
+        self.assertRaises(exceptions.UnsupportedException,
+            self.connection.identified, res)
+
+
+class TestLoop(unittest.TestCase):
+    '''Tests for fitting in with the application's event loop'''
+    def test_use_uvloop(self):
+        '''Sets the event loop policy only when asked to'''
+        uvloop = mock.Mock()
+        with mock.patch('nsq.asyncio.uvloop', uvloop):
+            with mock.patch('asyncio.set_event_loop_policy') as set_policy:
+                self.assertTrue(use_uvloop())
+        set_policy.assert_called_once_with(uvloop.EventLoopPolicy())
+
+    def test_no_uvloop(self):
+        '''Says so when uvloop isn't installed'''
+        with mock.patch('nsq.asyncio.uvloop', None):
+            with mock.patch('asyncio.set_event_loop_policy') as set_policy:
+                self.assertFalse(use_uvloop())
+        self.assertFalse(set_policy.called)
+
+    def test_reader_outside_loop(self):
+        '''Readers may be made before the loop they run in'''
+        reader = Reader(b'topic', b'channel')
+
+        async def iterate():
+            await reader.close()
+            return [message async for message in reader]
+        self.assertEqual(asyncio.run(iterate()), [])
+
+
+class TestClients(unittest.IsolatedAsyncioTestCase):
+    '''Tests for the asyncio reader and producer against a fake nsqd'''
+    async def asyncSetUp(self):
+        self.nsqd = await FakeNsqd().start()
+
+    async def asyncTearDown(self):
+        await self.nsqd.stop()
+
+    async def test_connect(self):
+        '''Connects and identifies'''
+        async with Producer([self.nsqd.address]) as producer:
+            conn = producer.connections()[0]
+            self.assertTrue(conn.alive())
+            self.assertEqual(conn.max_rdy_count, 2500)
+            self.assertEqual(conn.msg_timeout, 60)
+
+    async def test_connect_failure(self):
+        '''Returns nothing when it can't connect'''
+        address = self.nsqd.address
+        await self.nsqd.stop()
+        producer = Producer([address])
+        with mock.patch('nsq.asyncio.connection.logger'):
+            await producer.start()
+        self.assertFalse(producer.connections()[0].alive())
+        await producer.close()
+
+    async def test_pub(self):
+        '''Waits for confirmation of publishes'''
+        async with Producer([self.nsqd.address]) as producer:
+            results = await asyncio.gather(
+                *[producer.pub(b'topic', b'%i' % i) for i in range(10)])
+            self.assertEqual(results, [b'OK'] * 10)
+            self.assertEqual(
+                self.nsqd.published, [b'%i' % i for i in range(10)])
+
+    async def test_mpub(self):
+        async with Producer([self.nsqd.address]) as producer:
+            self.assertEqual(await producer.mpub(b'topic', b'a', b'b'), b'OK')
+
+    async def test_dpub(self):
+        '''Waits for confirmation of deferred publishes'''
+        async with Producer([self.nsqd.address]) as producer:
+            self.assertEqual(await producer.dpub(b'topic', 1000, b'a'), b'OK')
+            self.assertEqual(self.nsqd.published, [(1000, b'a')])
+
+    async def test_pub_routed(self):
+        '''Tells the router about connections and publish latencies'''
+        router = routing.Latency()
+        async with Producer([self.nsqd.address], router=router) as producer:
+            conn, = producer.connections()
+            self.assertEqual(router.members(), [conn])
+            await producer.pub(b'topic', b'a', key=b'key')
+            self.assertIsNotNone(router.latency(conn))
+        self.assertEqual(router.members(), [])
+
+    async def test_pub_error(self):
+        '''Raises errors from publishing'''
+        async with Producer([self.nsqd.address]) as producer:
+            with self.assertRaises(exceptions.BadTopicException):
+                await producer.pub(b'bad', b'message')
+
+    async def test_pub_no_connections(self):
+        producer = Producer([])
+        with self.assertRaises(exceptions.ConnectionClosedException):
+            await producer.pub(b'topic', b'message')
+
+    async def test_read(self):
+        '''Iterates over messages, finishing them'''
+        self.nsqd.messages = [message(b'%i' % i, b'%i' % i) for i in range(5)]
+        bodies = []
+        async with Reader(b'topic', b'channel',
+            nsqd_tcp_addresses=[self.nsqd.address], max_in_flight=10) as reader:
+            async for msg in reader:
+                async with msg.handle():
+                    bodies.append(msg.body)
+                if len(bodies) == 5:
+                    break
+        self.assertEqual(bodies, [b'%i' % i for i in range(5)])
+        names = [command[0] for command in self.nsqd.commands]
+        self.assertEqual(names.count(constants.FIN), 5)
+        self.assertIn([constants.SUB, b'topic', b'channel'], self.nsqd.commands)
+
+    async def test_backoff(self):
+        '''Stops RDY when messages are requeued, until the backoff is over'''
+        self.nsqd.messages = [message(b'%i' % i, b'%i' % i) for i in range(5)]
+        async with Reader(b'topic', b'channel',
+            nsqd_tcp_addresses=[self.nsqd.address], max_in_flight=10,
+            backoff=backoff.Constant(0.05)) as reader:
+            async for msg in reader:
+                with self.assertRaises(ValueError):
+                    async with msg.handle():
+                        raise ValueError('downstream is down')
+                break
+            conn, = reader.connections()
+            self.assertEqual(conn.last_ready_sent, 0)
+            self.assertEqual(reader.throttle.backoffs, 1)
+            await asyncio.sleep(0.1)
+            self.assertEqual(conn.last_ready_sent, 1)
+
+    async def test_connections_per_nsqd(self):
+        '''Subscribes on several connections to each nsqd'''
+        async with Reader(b'topic', b'channel',
+            nsqd_tcp_addresses=[self.nsqd.address], max_in_flight=10,
+            connections_per_nsqd=2) as reader:
+            self.assertEqual(len(reader.connections()), 2)
+            self.assertEqual(
+                sorted(conn.last_ready_sent for conn in reader.connections()),
+                [5, 5])
+        names = [command[0] for command in self.nsqd.commands]
+        self.assertEqual(names.count(constants.SUB), 2)
+
+    async def test_close_stops_iteration(self):
+        '''Stops iterating once the reader has been closed'''
+        reader = await Reader(b'topic', b'channel',
+            nsqd_tcp_addresses=[self.nsqd.address]).start()
+        await reader.close()
+        self.assertEqual([msg async for msg in reader], [])
+        self.assertIn([constants.CLS], self.nsqd.commands)
+
+    async def test_discover(self):
+        '''Connects to producers found through lookupd'''
+        host, port = self.nsqd.address.split(':')
+        reader = Reader(b'topic', b'channel',
+            lookupd_http_addresses=['http://localhost:4161'])
+        lookup = {'producers': [
+            {'broadcast_address': host, 'tcp_port': int(port)}]}
+        with mock.patch.object(
+            reader._lookupd[0], 'lookup', return_value=lookup):
+            await reader.start()
+        self.assertEqual(len(reader.connections()), 1)
+        self.assertTrue(reader.connections()[0].alive())
+        await reader.close()
+
+    async def test_retire(self):
+        '''Retires connections to producers that drop out of lookupd'''
+        host, port = self.nsqd.address.split(':')
+        reader = Reader(b'topic', b'channel',
+            lookupd_http_addresses=['http://localhost:4161'])
+        lookup = {'producers': [
+            {'broadcast_address': host, 'tcp_port': int(port)}]}
+        with mock.patch.object(
+            reader._lookupd[0], 'lookup', return_value=lookup):
+            await reader.start()
+        conn, = reader.connections()
+        with mock.patch.object(
+            reader._lookupd[0], 'lookup', return_value={'producers': []}):
+            await reader.check_connections()
+        self.assertEqual(reader.active_connections(), [])
+        await asyncio.gather(*reader._retiring.values())
+        self.assertEqual(reader.connections(), [])
+        self.assertFalse(conn.alive())
+        self.assertIn([constants.RDY, b'0'], self.nsqd.commands)
+        self.assertIn([constants.CLS], self.nsqd.commands)
+        await reader.close()
+
+    async def test_discover_failure(self):
+        '''Carries on when lookupd can't be queried'''
+        reader = Reader(b'topic', b'channel',
+            lookupd_http_addresses=['http://localhost:4161'])
+        with mock.patch.object(
+            reader._lookupd[0], 'lookup', side_effect=Exception('boom')):
+            with mock.patch('nsq.asyncio.client.logger'):
+                self.assertEqual(await reader.discover(b'topic'), [])
+
+    async def test_redistributes_on_close(self):
+        '''Redistributes the ready state when a connection is lost'''
+        other = await FakeNsqd().start()
+        try:
+            reader = await Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=[self.nsqd.address, other.address],
+                max_in_flight=10).start()
+            conns = sorted(reader.connections(), key=lambda c: c.port)
+            self.assertEqual([c.last_ready_sent for c in conns], [5, 5])
+            await conns[0].close()
+            self.assertEqual(conns[1].last_ready_sent, 10)
+            await reader.close()
+        finally:
+            await other.stop()
@@ -167,3 +167,89 @@ class TestDecrementingAttemptCounter(unittest.TestCase):
         '''Success never lets the attempts count drop below 0'''
         self.counter.success()
         self.assertEqual(self.counter.attempts, 0)
+
+
+class TestThrottle(unittest.TestCase):
+    '''Test our consumer throttle'''
+    def setUp(self):
+        self.throttle = backoff.Throttle(backoff.Linear(10, 0))
+        self.now = 1000.0
+
+    def at(self, elapsed=0):
+        '''Patch the time to be some time from now'''
+        self.now += elapsed
+        return mock.patch('nsq.backoff.time.time', return_value=self.now)
+
+    def allowed(self, elapsed=0):
+        '''How many of 64 may be in flight after some time has passed'''
+        with self.at(elapsed):
+            return self.throttle.max_in_flight(64)
+
+    def fail(self, elapsed=0):
+        '''Fail after some time has passed'''
+        with self.at(elapsed):
+            return self.throttle.failed()
+
+    def succeed(self, elapsed=0):
+        '''Succeed after some time has passed'''
+        with self.at(elapsed):
+            return self.throttle.succeeded()
+
+    def test_unthrottled(self):
+        '''Everything may be in flight when nothing's failing'''
+        self.assertFalse(self.succeed())
+        self.assertEqual(self.allowed(), 64)
+
+    def test_backoff(self):
+        '''A failure stops everything for the backoff'''
+        self.assertTrue(self.fail())
+        self.assertEqual(self.allowed(), 0)
+        self.assertEqual(self.allowed(9), 0)
+        with self.at():
+            self.assertEqual(self.throttle.remaining(), 1)
+
+    def test_ignored_during_backoff(self):
+        '''Outcomes during a backoff are ignored'''
+        self.fail()
+        self.assertFalse(self.fail(1))
+        self.assertFalse(self.succeed(1))
+        self.assertEqual(self.allowed(8), 1)
+
+    def test_test_message(self):
+        '''A single message is let through once the backoff is over'''
+        self.fail()
+        with self.at(10):
+            self.assertTrue(self.throttle.ended())
+            self.assertFalse(self.throttle.ended())
+        self.assertEqual(self.allowed(), 1)
+
+    def test_ramp(self):
+        '''Successes double how many may be in flight'''
+        self.fail()
+        self.fail(10)
+        self.fail(20)
+        self.assertEqual(self.allowed(30), 1)
+        self.assertTrue(self.succeed())
+        self.assertEqual(self.allowed(), 16)
+        self.succeed()
+        self.assertEqual(self.allowed(), 32)
+        self.succeed()
+        self.assertEqual(self.allowed(), 64)
+        self.assertFalse(self.succeed())
+
+    def test_failed_test(self):
+        '''Failing the test message backs off for longer'''
+        self.fail()
+        self.fail(10)
+        self.assertEqual(self.allowed(19), 0)
+        self.assertEqual(self.allowed(1), 1)
+
+    def test_metrics(self):
+        '''Keeps track of how long and how often we've backed off'''
+        self.fail()
+        with self.at(5):
+            self.assertEqual(self.throttle.backoff_time(), 5)
+        self.fail(10)
+        with self.at(100):
+            self.assertEqual(self.throttle.backoff_time(), 30)
+        self.assertEqual(self.throttle.backoffs, 2)
@@ -66,3 +66,10 @@ class TestConnectionChecker(unittest.TestCase):
             checker = ConnectionChecker(mock_client, 10)
             mock_init.assert_called_with(
                 checker, 10, mock_client.check_connections)
+
+    def test_jitter(self):
+        '''Jitters the interval between checks'''
+        checker = ConnectionChecker(mock.Mock(), 10, jitter=0.5)
+        delays = [checker.delay() for _ in range(100)]
+        self.assertTrue(all(5 <= delay <= 15 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
@@ -7,10 +7,15 @@ from nsq import exceptions
 from nsq.http import ClientException
 
 from common import HttpClientIntegrationTest, MockedConnectionTest
+from common.mockedconnectiontest import MockConnection
 from contextlib import contextmanager
 import errno
 import select
 import socket
+import struct
+import threading
+import time
+import unittest
 
 
 class TestClientNsqd(HttpClientIntegrationTest):
@@ -130,6 +135,140 @@ class TestClientLookupd(HttpClientIntegrationTest):
             MockClient.assert_called_with('foo', access_token='hello')
 
 
+class TestClientDiscovery(unittest.TestCase):
+    '''Tests for discovering nsqd instances through several lookupds'''
+    addresses = ['http://localhost:4161', 'http://localhost:4162']
+
+    def setUp(self):
+        self.lookupds = []
+        for address in self.addresses:
+            lookupd = mock.Mock()
+            lookupd.__str__ = mock.Mock(return_value=address)
+            lookupd.lookup.return_value = {'producers': [
+                {'broadcast_address': 'localhost', 'tcp_port': 4150}]}
+            self.lookupds.append(lookupd)
+        with mock.patch('nsq.client.nsqlookupd.Client',
+            side_effect=self.lookupds):
+            with mock.patch('nsq.client.connection.Connection', MockConnection):
+                self.client = client.Client(
+                    lookupd_http_addresses=self.addresses, topic='topic',
+                    discovery_ttl=60)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_deduplicates(self):
+        '''Connects once to producers known to several lookupds'''
+        self.assertEqual(len(self.client.connections()), 1)
+
+    def test_concurrent(self):
+        '''Queries lookupds and connects to what's discovered at once'''
+        lookups = threading.Barrier(2, timeout=5)
+        for index, lookupd in enumerate(self.lookupds):
+            lookupd.lookup.side_effect = (lambda topic, index=index: (
+                lookups.wait(), {'producers': [{
+                    'broadcast_address': 'localhost', 'tcp_port': 4151 + index}]}
+            )[1])
+        connects = threading.Barrier(2, timeout=5)
+
+        def connect(*args, **kwargs):
+            connects.wait()
+            return MockConnection(*args)
+
+        self.client._discovery_cache.clear()
+        with mock.patch('nsq.client.connection.Connection', side_effect=connect):
+            new = self.client.discover('topic')
+        self.assertEqual(sorted(conn.port for conn in new), [4151, 4152])
+
+    def test_cached(self):
+        '''Uses cached results until they expire'''
+        self.client.discover('topic')
+        for lookupd in self.lookupds:
+            self.assertEqual(lookupd.lookup.call_count, 1)
+        with mock.patch('nsq.client.time.time', return_value=time.time() + 61):
+            self.client.discover('topic')
+        for lookupd in self.lookupds:
+            self.assertEqual(lookupd.lookup.call_count, 2)
+
+    def test_latency(self):
+        '''Keeps track of how long discovery takes'''
+        self.assertGreaterEqual(self.client.discovery_latency, 0)
+        self.assertEqual(set(self.client.lookupd_latency), set(self.addresses))
+        self.client.discover('topic')
+        self.assertEqual(
+            list(self.client.lookupd_latency.values()), [None, None])
+
+    def test_failure(self):
+        '''Discovers what it can when a lookupd fails'''
+        self.client._discovery_cache.clear()
+        self.lookupds[0].lookup.side_effect = ClientException
+        self.lookupds[1].lookup.return_value = {'producers': [
+            {'broadcast_address': 'localhost', 'tcp_port': 4151}]}
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            with mock.patch('nsq.client.logger'):
+                new = self.client.discover('topic')
+        self.assertEqual([conn.port for conn in new], [4151])
+
+
+class TestClientRetirement(unittest.TestCase):
+    '''Tests for retiring connections to nsqd instances that disappear'''
+    def setUp(self):
+        self.lookupd = mock.Mock()
+        self.lookupd.lookup.return_value = {'producers': [
+            {'broadcast_address': 'localhost', 'tcp_port': 4150},
+            {'broadcast_address': 'localhost', 'tcp_port': 4151}]}
+        with mock.patch('nsq.client.nsqlookupd.Client',
+            return_value=self.lookupd):
+            with mock.patch('nsq.client.connection.Connection', MockConnection):
+                self.client = client.Client(
+                    lookupd_http_addresses=['http://localhost:4161'],
+                    nsqd_tcp_addresses=['localhost:4152'], topic='topic')
+        self.gone = [
+            conn for conn in self.client.connections() if conn.port == 4151][0]
+
+    def disappear(self):
+        '''The nsqd on port 4151 drops out of discovery'''
+        self.lookupd.lookup.return_value = {'producers': [
+            {'broadcast_address': 'localhost', 'tcp_port': 4150}]}
+        self.client.discover('topic')
+
+    def test_retires(self):
+        '''Closes connections to nsqd instances that have disappeared'''
+        self.disappear()
+        self.assertTrue(self.gone.cls.called)
+        self.assertFalse(self.gone.alive())
+        self.assertEqual(
+            sorted(conn.port for conn in self.client.connections()),
+            [4150, 4152])
+
+    def test_lookupd_failure(self):
+        '''Doesn't retire anything if a lookupd couldn't be queried'''
+        self.lookupd.lookup.side_effect = ClientException
+        with mock.patch('nsq.client.logger'):
+            self.client.discover('topic')
+        self.assertEqual(len(self.client.connections()), 3)
+
+    def test_drains(self):
+        '''Waits for a connection to drain before closing it'''
+        with mock.patch.object(self.client, 'drained', return_value=False):
+            self.disappear()
+            self.assertTrue(self.gone.alive())
+            self.assertNotIn(self.gone, self.client.active_connections())
+            for _ in range(10):
+                self.assertNotEqual(self.client.route(), self.gone)
+        self.client.reap()
+        self.assertFalse(self.gone.alive())
+
+    def test_drain_timeout(self):
+        '''Gives up on draining after the drain timeout'''
+        with mock.patch.object(self.client, 'drained', return_value=False):
+            self.disappear()
+            with mock.patch('nsq.client.time.time',
+                return_value=time.time() + 61):
+                self.client.reap()
+        self.assertFalse(self.gone.alive())
+
+
 class TestClientMultiple(MockedConnectionTest):
     '''Tests for our client class'''
     @contextmanager
@@ -174,6 +313,17 @@ class TestClientMultiple(MockedConnectionTest):
             for conn in self.connections:
                 conn.nop.assert_called_with()
 
+    def test_responded(self):
+        '''Invokes the responded hook with responses, but not heartbeats'''
+        conn = self.connections[0]
+        conn.response(constants.HEARTBEAT)
+        conn.response(b'OK')
+        with self.readable([conn]):
+            with mock.patch.object(self.client, 'responded') as responded:
+                self.client.read()
+                responded.assert_called_once_with(conn, mock.ANY)
+                self.assertEqual(responded.call_args[0][1].data, b'OK')
+
     def test_closes_on_fatal(self):
         '''All but a few errors are considered fatal'''
         self.connections[0].error(exceptions.InvalidException)
@@ -261,6 +411,27 @@ class TestClientMultiple(MockedConnectionTest):
                     self.client.read()
                     mock_sleep.assert_called_with(self.client._timeout)
 
+    def test_flush_acks_due(self):
+        '''Flushes coalesced acks that are due'''
+        conn = self.connections[0]
+        with mock.patch.object(conn, 'ack_deadline', return_value=0):
+            self.client.flush_acks(self.connections)
+            conn.flush_acks.assert_called_with()
+
+    def test_flush_acks_timeout(self):
+        '''Waits no longer than until the next acks are due'''
+        conn = self.connections[0]
+        with mock.patch('nsq.client.time.time', return_value=100):
+            with mock.patch.object(conn, 'ack_deadline', return_value=100.01):
+                timeout = self.client.flush_acks(self.connections)
+        self.assertAlmostEqual(timeout, 0.01)
+        self.assertFalse(conn.flush_acks.called)
+
+    def test_flush_acks_none(self):
+        '''Waits the usual timeout if there are no coalesced acks'''
+        self.assertEqual(
+            self.client.flush_acks(self.connections), self.client._timeout)
+
     def test_random_connection(self):
         '''Yields a random client'''
         found = []
@@ -269,6 +440,64 @@ class TestClientMultiple(MockedConnectionTest):
                 found.append(conn)
         self.assertEqual(set(found), set(self.client.connections()))
 
+    def test_random_connection_unsaturated(self):
+        '''Avoids saturated connections'''
+        saturated, unsaturated = self.connections
+        with mock.patch.object(saturated, 'saturated', return_value=True):
+            for _ in range(20):
+                with self.client.random_connection() as conn:
+                    self.assertEqual(conn, unsaturated)
+
+    def test_random_connection_all_saturated(self):
+        '''Uses saturated connections if there's nothing else'''
+        found = set()
+        for conn in self.connections:
+            conn.saturated = mock.Mock(return_value=True)
+        for _ in range(20):
+            with self.client.random_connection() as conn:
+                found.add(conn)
+        self.assertEqual(found, set(self.connections))
+
+    def test_route_dead(self):
+        '''Stops routing to connections that have died'''
+        dead, alive = self.connections
+        dead._alive = False
+        for _ in range(20):
+            self.assertEqual(self.client.route(), alive)
+        self.assertEqual(self.client._router.members(), [alive])
+
+    def test_route_closed(self):
+        '''Stops routing to connections that are closed'''
+        closed, alive = self.connections
+        self.client.close_connection(closed)
+        self.assertEqual(self.client._router.members(), [alive])
+
+    def test_route_resync(self):
+        '''Finds living connections again if it runs out'''
+        for conn in self.connections:
+            self.client.close_connection(conn)
+            conn._alive = True
+        self.assertIn(self.client.route(), self.connections)
+        self.assertEqual(
+            set(self.client._router.members()), set(self.connections))
+
+    def test_route_none(self):
+        '''Raises if there are no living connections'''
+        for conn in self.connections:
+            conn.close()
+        self.assertRaises(
+            exceptions.ConnectionClosedException, self.client.route)
+
+    def test_router(self):
+        '''Routers may be selected by name'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            nsq_client = client.Client(
+                nsqd_tcp_addresses=['localhost:1', 'localhost:2'],
+                router='round_robin')
+        found = [nsq_client.route() for _ in range(4)]
+        self.assertEqual(found[:2], found[2:])
+        self.assertEqual(set(found), set(nsq_client.connections()))
+
     def test_wait_response(self):
         '''Waits until a response is available'''
         with mock.patch.object(
@@ -287,18 +516,29 @@ class TestClientMultiple(MockedConnectionTest):
         '''Pub called on a random connection and waits for a response'''
         connection = mock.Mock()
         with mock.patch.object(
-            self.client, 'connections', return_value=[connection]):
+            self.client, 'route', return_value=connection):
             with mock.patch.object(
                 self.client, 'wait_response', return_value=['response']):
                 self.assertEqual(self.client.pub('foo', 'bar'), ['response'])
                 connection.pub.assert_called_with('foo', 'bar')
 
+    def test_dpub(self):
+        '''Dpub called on a random connection and waits for a response'''
+        connection = mock.Mock()
+        with mock.patch.object(
+            self.client, 'route', return_value=connection):
+            with mock.patch.object(
+                self.client, 'wait_response', return_value=['response']):
+                self.assertEqual(
+                    self.client.dpub('foo', 1000, 'bar'), ['response'])
+                connection.dpub.assert_called_with('foo', 1000, 'bar')
+
     def test_mpub(self):
         '''Mpub called on a random connection and waits for a response'''
         connection = mock.Mock()
         messages = ['hello', 'how', 'are', 'you']
         with mock.patch.object(
-            self.client, 'connections', return_value=[connection]):
+            self.client, 'route', return_value=connection):
             with mock.patch.object(
                 self.client, 'wait_response', return_value=['response']):
                 self.assertEqual(
@@ -341,6 +581,168 @@ class TestClientMultiple(MockedConnectionTest):
             self.client.reconnected.assert_called_with(conn)
 
 
+class TestClientConnectionsPerNsqd(unittest.TestCase):
+    '''Tests for our client with several connections to each nsqd'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client = client.Client(
+                nsqd_tcp_addresses=['localhost:12345', 'localhost:12346'],
+                connections_per_nsqd=3)
+
+    def test_connections(self):
+        '''Opens several connections to each nsqd'''
+        connections = self.client.connections()
+        self.assertEqual(len(connections), 6)
+        ports = [conn.port for conn in connections]
+        self.assertEqual(sorted(ports), [12345] * 3 + [12346] * 3)
+
+    def test_add_limit(self):
+        '''Refuses more connections to an nsqd than configured'''
+        self.assertEqual(self.client.add(MockConnection('localhost', 12345)), None)
+        self.assertEqual(self.client.add(self.client.connections()[0]), None)
+
+    def test_remove(self):
+        '''Replaces removed connections when checking connections'''
+        conn = self.client.connections()[0]
+        self.assertEqual(self.client.remove(conn), conn)
+        self.assertNotIn(conn, self.client.connections())
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client.check_connections()
+        self.assertEqual(len(self.client.connections()), 6)
+
+    def test_routes(self):
+        '''Publishes are routed across all of the connections'''
+        found = set(self.client.route() for _ in range(100))
+        self.assertEqual(found, set(self.client.connections()))
+
+
+class TestClientSelector(unittest.TestCase):
+    '''Tests for our client when registering connections with a selector'''
+    def setUp(self):
+        self.client = client.Client(timeout=0.01, selector=True)
+        self.servers = []
+        self.connections = [self.connect(port) for port in range(3)]
+
+    def tearDown(self):
+        self.client.close()
+        for server in self.servers:
+            server.close()
+
+    def connect(self, port):
+        '''Add a connection over a socketpair'''
+        with mock.patch.object(client.connection.Connection, 'connect'):
+            conn = client.connection.Connection('localhost', port)
+        conn._reset()
+        sock, server = socket.socketpair()
+        conn._socket = sock
+        conn.setblocking(0)
+        self.servers.append(server)
+        self.client.add(conn)
+        return conn
+
+    def respond(self, index, data):
+        '''Send a response frame to a connection'''
+        self.servers[index].sendall(
+            struct.pack('>ll', len(data) + 4, constants.FRAME_TYPE_RESPONSE) +
+            data)
+
+    def test_registers_connections(self):
+        '''Adding a connection registers it with the selector'''
+        self.assertEqual(set(self.client._registered), set(self.connections))
+
+    def test_read(self):
+        '''Reads from only the readable connections'''
+        self.respond(1, b'hello')
+        responses = self.client.read()
+        self.assertEqual([res.data for res in responses], [b'hello'])
+
+    def test_read_timeout(self):
+        '''Returns nothing when nothing is ready'''
+        self.assertEqual(self.client.read(), [])
+
+    def test_writes_pending(self):
+        '''Connections with pending data are flushed'''
+        conn = self.connections[2]
+        conn.nop()
+        self.assertIn(conn, self.client._interest_changes)
+        self.client.read()
+        self.assertFalse(conn.pending())
+        self.assertEqual(self.servers[2].recv(100), constants.NOP + b'\n')
+
+    def test_interest_reset(self):
+        '''Stops waiting to write once there's nothing pending'''
+        conn = self.connections[0]
+        conn.nop()
+        self.client.read()
+        self.client.read()
+        key = self.client._selector.get_key(conn.fileno())
+        self.assertEqual(key.events, client.selectors.EVENT_READ)
+
+    def test_wakeup(self):
+        '''Writing while selecting wakes up the selector'''
+        self.client._selecting = True
+        self.connections[0].nop()
+        self.assertEqual(self.client._wakeup_reader.recv(10), b'\x00')
+
+    def test_remove_unregisters(self):
+        '''Removing a connection unregisters it'''
+        conn = self.connections[0]
+        fileno = conn.fileno()
+        self.client.remove(conn)
+        self.assertNotIn(conn, self.client._registered)
+        self.assertNotIn(fileno, self.client._selector.get_map())
+
+    def test_closed_unregistered(self):
+        '''Connections that die are unregistered when selected'''
+        conn = self.connections[0]
+        self.servers[0].close()
+        with mock.patch.object(conn, 'alive', return_value=False):
+            self.assertEqual(self.client.read(), [])
+        self.assertNotIn(conn, self.client._registered)
+
+    def test_closed_then_written(self):
+        '''Connections closed outside of the client and then written to are
+        unregistered rather than breaking the read'''
+        conn = self.connections[0]
+        conn.close()
+        conn.fin(b'1' * 16)
+        self.respond(1, b'hello')
+        responses = self.client.read()
+        self.assertEqual([res.data for res in responses], [b'hello'])
+        self.assertNotIn(conn, self.client._registered)
+
+    def test_modify_fails(self):
+        '''Connections the selector can no longer modify are unregistered'''
+        conn = self.connections[0]
+        conn.nop()
+        with mock.patch.object(
+            self.client._selector, 'modify', side_effect=OSError(9, 'EBADF')):
+            self.assertEqual(self.client.read(), [])
+        self.assertNotIn(conn, self.client._registered)
+
+    def test_reconnect_registers(self):
+        '''Reestablished connections are registered'''
+        conn = self.connections[0]
+        self.client._unregister(conn)
+        with mock.patch.object(conn, 'connect', return_value=True):
+            self.client._reconnect(conn)
+        self.assertIn(conn, self.client._registered)
+
+    def test_stale_file_descriptor(self):
+        '''A connection reusing a stale descriptor replaces it'''
+        stale = self.connections[0]
+        with mock.patch.object(client.connection.Connection, 'connect'):
+            conn = client.connection.Connection('localhost', 10)
+        conn._reset()
+        conn._socket = mock.Mock(fileno=mock.Mock(return_value=stale.fileno()))
+        conn._socket.setblocking = mock.Mock()
+        self.client._register(conn)
+        self.assertNotIn(stale, self.client._registered)
+        self.assertIn(conn, self.client._registered)
+        self.client._unregister(conn)
+        conn._socket = None
+
+
 class TestClientNsqdWithConnectTimeout(HttpClientIntegrationTest):
     '''Test our client class when a connection timeout is set'''
     nsqd_ports = (14150,)
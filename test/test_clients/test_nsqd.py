@@ -11,6 +11,15 @@ class TestNsqdClient(ClientTest):
     def setUp(self):
         self.client = nsqd.Client('http://foo:1')
 
+    def test_pub_defer(self):
+        '''Publishes with a deferral'''
+        with self.patched_post() as post:
+            post.return_value.content = b'OK'
+            self.client.pub('topic', b'message', defer=1000)
+            post.assert_called_with(
+                'pub', params={'topic': 'topic', 'defer': 1000},
+                data=b'message')
+
     def test_mpub_ascii(self):
         '''Publishes ascii messages fine'''
         with self.patched_post() as post:
@@ -0,0 +1,70 @@
+'''Test our command encoders'''
+
+import unittest
+
+from nsq import commands
+from nsq import constants
+from nsq import util
+
+
+class TestCommands(unittest.TestCase):
+    '''Test the command encoders'''
+    def test_integer(self):
+        '''Encodes integers as ASCII'''
+        self.assertEqual(commands.integer(0), b'0')
+        self.assertEqual(commands.integer(2500), b'2500')
+        self.assertEqual(commands.integer(-1), b'-1')
+
+    def test_integer_cached(self):
+        '''Returns the same encoding for repeated values'''
+        self.assertIs(commands.integer(1234), commands.integer(1234))
+
+    def test_rdy(self):
+        '''Encodes RDY'''
+        self.assertEqual(commands.rdy(5), constants.RDY + b' 5\n')
+
+    def test_fin(self):
+        '''Encodes FIN'''
+        self.assertEqual(commands.fin(b'id'), constants.FIN + b' id\n')
+
+    def test_req(self):
+        '''Encodes REQ'''
+        self.assertEqual(commands.req(b'id', 10), constants.REQ + b' id 10\n')
+
+    def test_touch(self):
+        '''Encodes TOUCH'''
+        self.assertEqual(commands.touch(b'id'), constants.TOUCH + b' id\n')
+
+    def test_fin_many(self):
+        '''Encodes many FINs as consecutive commands'''
+        ids = [b'a', b'b', b'c']
+        self.assertEqual(
+            commands.fin_many(ids), b''.join(map(commands.fin, ids)))
+
+    def test_req_many(self):
+        '''Encodes many REQs as consecutive commands'''
+        ids = [b'a', b'b', b'c']
+        self.assertEqual(
+            commands.req_many(ids, 10),
+            b''.join(commands.req(i, 10) for i in ids))
+
+    def test_touch_many(self):
+        '''Encodes many TOUCHes as consecutive commands'''
+        ids = [b'a', b'b', b'c']
+        self.assertEqual(
+            commands.touch_many(ids), b''.join(map(commands.touch, ids)))
+
+    def test_dpub_many(self):
+        '''Encodes many DPUBs sharing a topic and delay'''
+        expected = b''.join(
+            constants.DPUB + b' topic 1500\n' + util.pack(message)
+            for message in (b'a', b'bc'))
+        self.assertEqual(
+            commands.dpub_many(b'topic', 1500, [b'a', b'bc']), expected)
+        self.assertEqual(commands.dpub_many(b'topic', 1500, []), b'')
+
+    def test_many_empty(self):
+        '''Encodes nothing when there are no message IDs'''
+        self.assertEqual(commands.fin_many([]), b'')
+        self.assertEqual(commands.req_many([], 10), b'')
+        self.assertEqual(commands.touch_many([]), b'')
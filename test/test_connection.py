@@ -8,12 +8,15 @@ import ssl
 from collections import deque
 
 from nsq import connection
+from nsq import commands
 from nsq import constants
 from nsq import exceptions
 from nsq import response
 from nsq import util
 from nsq import json
+from nsq.decoder import FrameDecoder
 from common import MockedSocketTest, HttpClientIntegrationTest
+from common.mockedsockettest import MockSocket
 
 
 class TestConnection(MockedSocketTest):
@@ -37,6 +40,31 @@ class TestConnection(MockedSocketTest):
         self.assertEqual(
             list(self.connection.pending()), [constants.NOP + constants.NL])
 
+    def test_watch_pending(self):
+        '''Notifies the watcher when there's data pending'''
+        watcher = mock.Mock()
+        self.connection.watch(watcher)
+        self.connection.nop()
+        self.connection.nop()
+        watcher.assert_called_once_with(self.connection)
+
+    def test_watch_flushed(self):
+        '''Notifies the watcher when everything pending has been sent'''
+        watcher = mock.Mock()
+        self.connection.nop()
+        self.connection.watch(watcher)
+        self.connection.flush()
+        watcher.assert_called_once_with(self.connection)
+
+    def test_watch_partial(self):
+        '''Does not notify the watcher when data is still pending'''
+        watcher = mock.Mock()
+        self.connection.nop()
+        self.connection.watch(watcher)
+        with mock.patch.object(self.socket, 'send', return_value=1):
+            self.connection.flush()
+        self.assertFalse(watcher.called)
+
     def test_flush_partial(self):
         '''Keeps its place when flushing out partial messages'''
         # We'll tell the connection it has only sent one byte when flushing
@@ -48,6 +76,20 @@ class TestConnection(MockedSocketTest):
             message = constants.NOP + constants.NL
             self.assertEqual(list(self.connection.pending()), [message[1:]])
 
+    def test_flush_after_partial(self):
+        '''Sends the rest of a partial message as bytes on the next flush'''
+        message = constants.NOP + constants.NL
+        with mock.patch.object(self.socket, 'send', return_value=1):
+            self.connection.nop()
+            self.connection.flush()
+        self.connection.nop()
+        with mock.patch.object(self.socket, 'send', return_value=7) as send:
+            self.assertEqual(self.connection.flush(), 7)
+        data, = send.call_args[0]
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(data, message[1:] + message)
+        self.assertEqual(list(self.connection.pending()), [])
+
     def test_flush_full(self):
         '''Pops off messages it has flushed completely'''
         # We'll tell the connection it has only sent one byte when flushing
@@ -131,6 +173,16 @@ class TestConnection(MockedSocketTest):
                 mock_socket.send.side_effect = socket.error('foo')
                 self.assertRaises(socket.error, self.connection.flush)
 
+    def test_flush_would_block_ssl_not_requeued(self):
+        '''The buffer to retry after SSL_ERROR_WANT_WRITE isn't also pending'''
+        pending = deque([b'1', b'2', b'3'])
+        with mock.patch.object(self.connection, '_pending', pending):
+            with mock.patch.object(self.connection, '_socket') as mock_socket:
+                mock_socket.send.side_effect = ssl.SSLError(
+                    ssl.SSL_ERROR_WANT_WRITE)
+                self.connection.flush()
+            self.assertEqual(list(pending), [])
+
     def test_eager_flush(self):
         '''Sending on a non-blocking connection does not eagerly flushes'''
         with mock.patch.object(self.connection, 'flush') as mock_flush:
@@ -164,31 +216,31 @@ class TestConnection(MockedSocketTest):
     def test_read_timeout(self):
         '''Returns no results after a socket timeout'''
         with mock.patch.object(self.connection, '_socket') as mock_socket:
-            mock_socket.recv.side_effect = socket.timeout
+            mock_socket.recv_into.side_effect = socket.timeout
             self.assertEqual(self.connection.read(), [])
 
     def test_read_socket_error(self):
         '''Re-raises socket non-errno socket errors'''
         with mock.patch.object(self.connection, '_socket') as mock_socket:
-            mock_socket.recv.side_effect = socket.error('foo')
+            mock_socket.recv_into.side_effect = socket.error('foo')
             self.assertRaises(socket.error, self.connection.read)
 
     def test_read_would_block(self):
         '''Returns no results if it would block'''
         with mock.patch.object(self.connection, '_socket') as mock_socket:
-            mock_socket.recv.side_effect = socket.error(errno.EAGAIN)
+            mock_socket.recv_into.side_effect = socket.error(errno.EAGAIN)
             self.assertEqual(self.connection.read(), [])
 
     def test_read_would_block_ssl_write(self):
         '''Returns no results if it would block on a SSL socket'''
         with mock.patch.object(self.connection, '_socket') as mock_socket:
-            mock_socket.recv.side_effect = ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE)
+            mock_socket.recv_into.side_effect = ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE)
             self.assertEqual(self.connection.read(), [])
 
     def test_read_would_block_ssl_read(self):
         '''Returns no results if it would block on a SSL socket'''
         with mock.patch.object(self.connection, '_socket') as mock_socket:
-            mock_socket.recv.side_effect = ssl.SSLError(ssl.SSL_ERROR_WANT_READ)
+            mock_socket.recv_into.side_effect = ssl.SSLError(ssl.SSL_ERROR_WANT_READ)
             self.assertEqual(self.connection.read(), [])
 
     def test_read_partial(self):
@@ -215,6 +267,45 @@ class TestConnection(MockedSocketTest):
             self.connection, constants.FRAME_TYPE_RESPONSE, b'hello')
         self.assertEqual(self.connection.read(), [expected] * 10)
 
+    def test_read_large(self):
+        '''Can read responses larger than the read buffer'''
+        body = b'x' * (FrameDecoder.BUFFER_SIZE * 2)
+        self.socket.write(response.Response.pack(body))
+        responses = []
+        while not responses:
+            responses = self.connection.read()
+        self.assertEqual(responses[0].data, body)
+
+    def test_read_decrements_ready(self):
+        '''Each message read decrements the ready count'''
+        self.connection.ready = 10
+        self.socket.write(response.Response.pack(b'hello'))
+        self.socket.write(
+            response.Message.pack(0, 1, b'0' * 16, b'hello') * 3)
+        self.assertEqual(len(self.connection.read()), 4)
+        self.assertEqual(self.connection.ready, 7)
+
+    def test_in_flight(self):
+        '''Counts messages read until they're finished or requeued'''
+        self.socket.write(
+            response.Message.pack(0, 1, b'0' * 16, b'hello') * 4)
+        self.connection.read()
+        self.assertEqual(self.connection.in_flight, 4)
+        self.connection.fin(b'a')
+        self.connection.req(b'b', 10)
+        self.assertEqual(self.connection.in_flight, 2)
+        self.connection.fin_many([b'c', b'd', b'e'])
+        self.assertEqual(self.connection.in_flight, 0)
+
+    def test_listen(self):
+        '''Tells a listener about messages being finished and requeued'''
+        listener = mock.Mock()
+        self.connection.listen(listener)
+        self.connection.fin(b'a')
+        listener.assert_called_with(self.connection, 1, True)
+        self.connection.req_many([b'b', b'c'], 10)
+        listener.assert_called_with(self.connection, 2, False)
+
     def test_fileno(self):
         '''Returns the connection's file descriptor appropriately'''
         self.assertEqual(
@@ -286,6 +377,18 @@ class TestConnection(MockedSocketTest):
             (constants.PUB, b' foo', constants.NL, util.pack(b'hello')))
         self.assertSent(expected, self.connection.pub, b'foo', b'hello')
 
+    def test_dpub(self):
+        '''Appropriately sends dpub'''
+        expected = b''.join(
+            (constants.DPUB, b' foo 1000', constants.NL, util.pack(b'hello')))
+        self.assertSent(expected, self.connection.dpub, b'foo', 1000, b'hello')
+
+    def test_dpub_many(self):
+        '''Sends many dpubs with the same delay at once'''
+        expected = commands.dpub_many(b'foo', 1000, [b'a', b'b'])
+        self.assertSent(
+            expected, self.connection.dpub_many, b'foo', 1000, [b'a', b'b'])
+
     def test_mpub(self):
         '''Appropriately sends mpub'''
         expected = b''.join((
@@ -313,6 +416,29 @@ class TestConnection(MockedSocketTest):
         expected = b''.join((constants.TOUCH, b' message_id', constants.NL))
         self.assertSent(expected, self.connection.touch, b'message_id')
 
+    def test_fin_many(self):
+        '''Appropriately sends many fins at once'''
+        expected = b''.join((constants.FIN, b' a', constants.NL,
+            constants.FIN, b' b', constants.NL))
+        self.assertSent(expected, self.connection.fin_many, [b'a', b'b'])
+
+    def test_req_many(self):
+        '''Appropriately sends many reqs at once'''
+        expected = b''.join((constants.REQ, b' a 10', constants.NL,
+            constants.REQ, b' b 10', constants.NL))
+        self.assertSent(expected, self.connection.req_many, [b'a', b'b'], 10)
+
+    def test_touch_many(self):
+        '''Appropriately sends many touches at once'''
+        expected = b''.join((constants.TOUCH, b' a', constants.NL,
+            constants.TOUCH, b' b', constants.NL))
+        self.assertSent(expected, self.connection.touch_many, [b'a', b'b'])
+
+    def test_many_empty(self):
+        '''Sends nothing for an empty list of message IDs'''
+        self.connection.fin_many([])
+        self.assertEqual(len(self.connection.pending()), 0)
+
     def test_cls(self):
         '''Appropriately sends cls'''
         expected = b''.join((constants.CLS, constants.NL))
@@ -466,11 +592,11 @@ class TestConnection(MockedSocketTest):
         self.connection._reset()
         self.assertEqual(self.connection._out_buffer, b'')
 
-    def test_reset_buffer(self):
-        '''Resets buffer'''
-        self.connection._buffer = True
+    def test_reset_decoder(self):
+        '''Resets the frame decoder'''
+        self.connection._decoder.feed(b'hello')
         self.connection._reset()
-        self.assertEqual(self.connection._buffer, b'')
+        self.assertEqual(len(self.connection._decoder), 0)
 
     def test_reset_identify_response(self):
         '''Resets identify_response'''
@@ -514,13 +640,43 @@ class TestConnection(MockedSocketTest):
             self.connection.identified, res)
 
     def test_auth_required_provided(self):
-        '''Sends the auth message if required and provided'''
+        '''Authenticates if required and provided'''
         res = response.Response(self.connection, response.Response.FRAME_TYPE,
             json.dumps({'auth_required': True}))
-        with mock.patch.object(self.connection, 'auth') as mock_auth:
+        with mock.patch.object(self.connection, 'authenticate') as mock_auth:
             with mock.patch.object(self.connection, '_auth_secret', 'hello'):
                 self.connection.identified(res)
-                mock_auth.assert_called_with('hello')
+                mock_auth.assert_called_with()
+
+    def auth_socket(self):
+        '''A socket for a server that requires auth'''
+        sock = MockSocket()
+        sock.identify({'auth_required': True})
+        return sock
+
+    def test_auth_response_consumed(self):
+        '''Reads the auth response while connecting'''
+        sock = self.auth_socket()
+        sock.response(json.dumps({'identity': 'me'}).encode('UTF-8'))
+        with mock.patch('nsq.connection.socket.socket', return_value=sock):
+            conn = connection.Connection(
+                'localhost', 1234, 0.01, auth_secret=b'hello')
+        self.assertTrue(conn.alive())
+        self.assertIn(
+            constants.AUTH + constants.NL + util.pack(b'hello'), sock.read())
+        sock.response(b'OK')
+        res, = conn.read()
+        self.assertEqual(res.data, b'OK')
+
+    def test_auth_failed(self):
+        '''Fails to connect if auth is refused'''
+        sock = self.auth_socket()
+        sock.error(exceptions.AuthFailedException)
+        with mock.patch('nsq.connection.socket.socket', return_value=sock):
+            with mock.patch('nsq.connection.logger'):
+                conn = connection.Connection(
+                    'localhost', 1234, 0.01, auth_secret=b'hello')
+        self.assertFalse(conn.alive())
 
     def test_auth_provided_not_required(self):
         '''Logs a warning if you provide auth when none is required'''
@@ -533,6 +689,401 @@ class TestConnection(MockedSocketTest):
                     'Authentication secret provided but not required')
 
 
+class TestZeroCopyConnection(MockedSocketTest):
+    '''Tests about zero-copy reads'''
+    def setUp(self):
+        self.connection = self.connect(
+            zero_copy=True, min_read_size=64, max_read_size=64)
+        self.connection.setblocking(0)
+        self.socket = self.connection._socket
+
+    def read_message(self, body):
+        '''Write a message to the client and read it back'''
+        self.socket.write(response.Message.pack(0, 1, b'0' * 16, body))
+        return self.connection.read()[0]
+
+    def test_message_view(self):
+        '''Message bodies are views into the read buffer'''
+        message = self.read_message(b'hello')
+        self.assertIsInstance(message.body, memoryview)
+        self.assertEqual(message.body, b'hello')
+
+    def test_response_bytes(self):
+        '''Responses are still provided as bytes'''
+        self.socket.response(b'OK')
+        self.assertEqual(self.connection.read()[0].data, b'OK')
+
+    def test_views_survive(self):
+        '''Earlier message bodies are not overwritten by later reads'''
+        with mock.patch.object(FrameDecoder, 'BUFFER_SIZE', 64):
+            messages = [
+                self.read_message(str(i).encode() * 20) for i in range(10)]
+        for i, message in enumerate(messages):
+            self.assertEqual(message.body, str(i).encode() * 20)
+
+
+class TestAckCoalescing(MockedSocketTest):
+    '''Tests about coalescing FIN, REQ and TOUCH'''
+    def setUp(self):
+        self.connection = self.connect(coalesce_acks=True, ack_max_count=3,
+            ack_max_bytes=1024, ack_max_delay_us=10 * 1000 * 1000)
+        self.socket = self.connection._socket
+        self.socket.read()
+
+    def test_disabled(self):
+        '''Acks are sent immediately by default'''
+        conn = self.connect()
+        conn._socket.read()
+        conn.fin(b'message_id')
+        self.assertEqual(conn._socket.read(), commands.fin(b'message_id'))
+
+    def test_buffers(self):
+        '''Holds on to acks until a limit is reached'''
+        self.connection.fin(b'a')
+        self.connection.req(b'b', 10)
+        self.assertEqual(self.socket.read(), b'')
+        self.assertIsNotNone(self.connection.ack_deadline())
+
+    def test_count(self):
+        '''Sends acks in a single write once there are enough of them'''
+        with mock.patch.object(self.socket, 'sendall') as sendall:
+            for message_id in (b'a', b'b', b'c'):
+                self.connection.fin(message_id)
+            sendall.assert_called_once_with(
+                commands.fin_many([b'a', b'b', b'c']))
+        self.assertIsNone(self.connection.ack_deadline())
+
+    def test_bytes(self):
+        '''Sends acks once they're large enough'''
+        self.connection.touch(b'x' * 1024)
+        self.assertEqual(self.socket.read(), commands.touch(b'x' * 1024))
+
+    def test_deadline(self):
+        '''Sends acks once the oldest has waited long enough'''
+        self.connection.fin(b'a')
+        with mock.patch('nsq.connection.time.time', return_value=1e12):
+            self.connection.fin(b'b')
+        self.assertEqual(self.socket.read(), commands.fin_many([b'a', b'b']))
+
+    def test_deadline_read(self):
+        '''Sends acks that are due when reading'''
+        self.connection.setblocking(0)
+        self.connection.fin(b'a')
+        self.connection.read()
+        self.assertEqual(self.socket.read(), b'')
+        with mock.patch('nsq.connection.time.time', return_value=1e12):
+            self.connection.read()
+        self.assertEqual(self.socket.read(), commands.fin(b'a'))
+        self.assertIsNone(self.connection.ack_deadline())
+
+    def test_msg_timeout(self):
+        '''Never waits more than a fraction of the message timeout'''
+        conn = self.connect({'msg_timeout': 1000},
+            coalesce_acks=True, ack_max_delay_us=10 * 1000 * 1000)
+        self.assertEqual(conn.msg_timeout, 1.0)
+        self.assertEqual(conn.ack_delay(), 0.1)
+
+    def test_flush_acks(self):
+        '''Can explicitly send coalesced acks'''
+        self.connection.fin(b'a')
+        self.connection.flush_acks()
+        self.assertEqual(self.socket.read(), commands.fin(b'a'))
+
+    def test_cls(self):
+        '''Sends coalesced acks before closing cleanly'''
+        self.connection.fin(b'a')
+        self.connection.cls()
+        self.assertEqual(
+            self.socket.read(), commands.fin(b'a') + constants.CLS + b'\n')
+
+    def test_close(self):
+        '''Sends coalesced acks before closing'''
+        self.connection.fin(b'a')
+        self.connection.close()
+        self.assertEqual(self.socket.read(), commands.fin(b'a'))
+
+
+class TestBackpressure(MockedSocketTest):
+    '''Tests about bounding the data waiting to be sent'''
+    def connect_bounded(self, overflow):
+        '''A non-blocking connection allowing 30 pending bytes'''
+        conn = self.connect(high_water=30, low_water=10, overflow=overflow)
+        conn.setblocking(0)
+        return conn
+
+    def test_pending_bytes(self):
+        '''Keeps track of how many bytes are waiting to be sent'''
+        self.connection.nop()
+        self.connection.fin(b'message_id')
+        self.assertEqual(self.connection.pending_bytes(), 19)
+        self.connection.flush()
+        self.assertEqual(self.connection.pending_bytes(), 0)
+
+    def test_pending_bytes_partial(self):
+        '''Partial sends are accounted for'''
+        self.connection.nop()
+        with mock.patch.object(self.socket, 'send', return_value=1):
+            self.connection.flush()
+        self.assertEqual(self.connection.pending_bytes(), 3)
+
+    def test_unbounded(self):
+        '''By default, any amount of data may be pending'''
+        for _ in range(1000):
+            self.connection.nop()
+        self.assertFalse(self.connection.saturated())
+
+    def test_raise(self):
+        '''Raises an exception when the high water mark is exceeded'''
+        conn = self.connect_bounded('raise')
+        conn.fin(b'0' * 16)
+        self.assertRaises(
+            exceptions.BufferFullException, conn.fin, b'0' * 16)
+        self.assertTrue(conn.saturated())
+        self.assertEqual(conn.pending_bytes(), 21)
+
+    def test_saturated_until_low_water(self):
+        '''Stays saturated until drained to the low water mark'''
+        conn = self.connect_bounded('raise')
+        conn.fin(b'0' * 16)
+        self.assertRaises(
+            exceptions.BufferFullException, conn.fin, b'0' * 16)
+        with mock.patch.object(conn._socket, 'send', return_value=6):
+            conn.flush()
+            self.assertTrue(conn.saturated())
+            conn.flush()
+            self.assertFalse(conn.saturated())
+
+    def test_block(self):
+        '''Flushes until drained to the low water mark'''
+        conn = self.connect_bounded('block')
+        conn.fin(b'0' * 16)
+        with mock.patch('nsq.connection.select.select') as mock_select:
+            conn.fin(b'1' * 16)
+            self.assertTrue(mock_select.called)
+        self.assertEqual(list(conn.pending()), [commands.fin(b'1' * 16)])
+        self.assertFalse(conn.saturated())
+
+    def test_block_closed(self):
+        '''Raises an exception when blocking on a closed connection'''
+        conn = self.connect_bounded('block')
+        conn.fin(b'0' * 16)
+        conn._socket = None
+        self.assertRaises(
+            exceptions.ConnectionClosedException, conn.fin, b'1' * 16)
+
+    def test_drop_oldest(self):
+        '''Drops the oldest commands to make room'''
+        conn = self.connect_bounded('drop-oldest')
+        conn.fin(b'0' * 16)
+        conn.nop()
+        conn.fin(b'1' * 16)
+        self.assertEqual(list(conn.pending()), [commands.fin(b'1' * 16)])
+        self.assertEqual(conn.pending_bytes(), 21)
+
+    def test_drop_keeps_partial(self):
+        '''Does not drop partially-sent commands'''
+        conn = self.connect_bounded('drop-oldest')
+        conn.fin(b'0' * 16)
+        conn.nop()
+        with mock.patch.object(conn._socket, 'send', return_value=7):
+            conn.flush()
+        conn.fin(b'1' * 16)
+        sent = commands.fin(b'0' * 16) + constants.NOP + constants.NL
+        self.assertEqual(
+            list(conn.pending()), [sent[7:], commands.fin(b'1' * 16)])
+
+    def test_callback(self):
+        '''Invokes a callback when the high water mark is exceeded'''
+        callback = mock.Mock()
+        conn = self.connect_bounded(callback)
+        conn.fin(b'0' * 16)
+        conn.fin(b'1' * 16)
+        callback.assert_called_once_with(conn, commands.fin(b'1' * 16))
+        self.assertEqual(len(conn.pending()), 2)
+
+    def test_invalid_policy(self):
+        '''Rejects unknown overflow policies'''
+        self.assertRaises(AssertionError, self.connect, overflow='foo')
+
+
+class TestVectoredFlush(MockedSocketTest):
+    '''Tests about flushing with sendmsg'''
+    def setUp(self):
+        MockedSocketTest.setUp(self)
+        self.patched = mock.patch.object(
+            self.connection, '_vectored', return_value=True)
+        self.patched.start()
+
+    def tearDown(self):
+        self.patched.stop()
+
+    def test_sendmsg(self):
+        '''Sends all the pending buffers without joining them'''
+        pending = deque([b'hello', b'howdy'])
+        with mock.patch.object(self.connection, '_pending', pending):
+            with mock.patch.object(self.connection, '_socket') as mock_socket:
+                mock_socket.sendmsg.return_value = 10
+                self.assertEqual(self.connection.flush(), 10)
+                mock_socket.sendmsg.assert_called_with([b'hello', b'howdy'])
+                self.assertEqual(list(pending), [])
+
+    def test_partial(self):
+        '''Keeps a view of partially-sent messages'''
+        pending = deque([b'hello', b'howdy'])
+        with mock.patch.object(self.connection, '_pending', pending):
+            with mock.patch.object(self.connection, '_socket') as mock_socket:
+                mock_socket.sendmsg.return_value = 7
+                self.connection.flush()
+                self.assertEqual(list(pending), [b'wdy'])
+                self.assertIsInstance(pending[0], memoryview)
+                mock_socket.sendmsg.return_value = 3
+                self.connection.flush()
+                self.assertEqual(list(pending), [])
+
+    def test_iov_max(self):
+        '''Sends no more than IOV_MAX buffers at once'''
+        pending = deque([b'a', b'b', b'c'])
+        with mock.patch.object(self.connection, '_pending', pending):
+            with mock.patch.object(self.connection, '_socket') as mock_socket:
+                with mock.patch('nsq.connection.IOV_MAX', 2):
+                    mock_socket.sendmsg.return_value = 2
+                    self.connection.flush()
+                    mock_socket.sendmsg.assert_called_with([b'a', b'b'])
+                    self.assertEqual(list(pending), [b'c'])
+
+    def test_empty(self):
+        '''Returns 0 without sending if there's nothing pending'''
+        with mock.patch.object(self.connection, '_socket') as mock_socket:
+            self.assertEqual(self.connection.flush(), 0)
+            self.assertFalse(mock_socket.sendmsg.called)
+
+    def test_would_block(self):
+        '''Keeps everything pending if it would block'''
+        pending = deque([b'hello'])
+        with mock.patch.object(self.connection, '_pending', pending):
+            with mock.patch.object(self.connection, '_socket') as mock_socket:
+                mock_socket.sendmsg.side_effect = socket.error(errno.EAGAIN)
+                self.assertEqual(self.connection.flush(), 0)
+                self.assertEqual(list(pending), [b'hello'])
+
+    def test_socket_error(self):
+        '''Re-raises socket non-EAGAIN errors'''
+        pending = deque([b'hello'])
+        with mock.patch.object(self.connection, '_pending', pending):
+            with mock.patch.object(self.connection, '_socket') as mock_socket:
+                mock_socket.sendmsg.side_effect = socket.error('foo')
+                self.assertRaises(socket.error, self.connection.flush)
+
+
+class TestVectoredSocket(MockedSocketTest):
+    '''Which sockets are flushed with sendmsg'''
+    def test_plain_socket(self):
+        '''Plain sockets use sendmsg'''
+        sock = socket.socket()
+        try:
+            self.assertTrue(self.connection._vectored(sock))
+        finally:
+            sock.close()
+
+    def test_wrapped_socket(self):
+        '''Wrapped sockets do not'''
+        self.assertFalse(self.connection._vectored(self.socket))
+
+    def test_socketpair(self):
+        '''Can flush over a real socket'''
+        server, client = socket.socketpair()
+        try:
+            with mock.patch.object(self.connection, '_socket', client):
+                self.connection.nop()
+                self.connection.fin(b'message_id')
+                self.connection.flush()
+            self.assertEqual(server.recv(1024), b'NOP\nFIN message_id\n')
+        finally:
+            server.close()
+            client.close()
+
+
+class TestReadSize(MockedSocketTest):
+    '''Tests about adapting how much is read from the socket at a time'''
+    def setUp(self):
+        self.connection = self.connect(
+            min_read_size=1024, max_read_size=64 * 1024)
+        self.connection.setblocking(0)
+        self.socket = self.connection._socket
+
+    def test_grows(self):
+        '''Reads more at a time when reads fill the requested size'''
+        self.socket.write(b'\x00' * 8192)
+        self.connection.read()
+        self.assertEqual(self.connection._read_size, 2048)
+
+    def test_shrinks(self):
+        '''Reads less at a time when reads come back mostly empty'''
+        self.connection._read_size = 8192
+        self.socket.write(response.Response.pack(b'hello'))
+        self.connection.read()
+        self.assertEqual(self.connection._read_size, 4096)
+
+    def test_floor(self):
+        '''Does not read less than the minimum'''
+        self.socket.write(response.Response.pack(b'hello'))
+        self.connection.read()
+        self.assertEqual(self.connection._read_size, 1024)
+
+    def test_ceiling(self):
+        '''Does not read more than the maximum'''
+        self.connection._read_size = 64 * 1024
+        self.socket.write(b'\x00' * (128 * 1024))
+        self.connection.read()
+        self.assertEqual(self.connection._read_size, 64 * 1024)
+
+    def test_rcvbuf(self):
+        '''Grows to the kernel's receive buffer size when it's known'''
+        self.connection._rcvbuf = 32 * 1024
+        self.socket.write(b'\x00' * 8192)
+        self.connection.read()
+        self.assertEqual(self.connection._read_size, 32 * 1024)
+
+    def test_completes_frame(self):
+        '''Reads enough to complete a partially-read frame'''
+        body = b'x' * 10000
+        packed = response.Response.pack(body)
+        self.socket.write(packed[:100])
+        self.assertEqual(self.connection.read(), [])
+        self.socket.write(packed[100:])
+        self.assertEqual(self.connection.read()[0].data, body)
+
+    def test_fionread(self):
+        '''Once a read fills up, drains everything the kernel has in one more'''
+        server, client = socket.socketpair()
+        try:
+            client.setblocking(0)
+            body = b'x' * 1000
+            server.sendall(response.Response.pack(body) * 40)
+            with mock.patch.object(self.connection, '_socket', client):
+                first = len(self.connection.read())
+                self.assertLess(first, 40)
+                self.assertEqual(len(self.connection.read()), 40 - first)
+        finally:
+            server.close()
+            client.close()
+
+    def test_fionread_short(self):
+        '''Doesn't ask the kernel how much it has after a short read'''
+        server, client = socket.socketpair()
+        try:
+            client.setblocking(0)
+            with mock.patch.object(self.connection, '_socket', client):
+                with mock.patch('nsq.connection.fcntl.ioctl') as ioctl:
+                    for _ in range(3):
+                        server.sendall(response.Response.pack(b'hello'))
+                        self.assertEqual(len(self.connection.read()), 1)
+            self.assertFalse(ioctl.called)
+        finally:
+            server.close()
+            client.close()
+
+
 class TestTLSConnectionIntegration(HttpClientIntegrationTest):
     '''We can establish a connection with TLS'''
     def setUp(self):
@@ -0,0 +1,129 @@
+'''Tests for our frame decoder'''
+
+import unittest
+
+import mock
+import struct
+
+from nsq import constants
+from nsq import response
+from nsq.decoder import FrameDecoder
+
+
+class TestFrameDecoder(unittest.TestCase):
+    '''Test the frame decoder'''
+    def setUp(self):
+        self.decoder = FrameDecoder()
+        self.message = response.Message.pack(0, 1, b'0' * 16, b'hello')
+
+    def test_empty(self):
+        '''Decodes nothing from an empty buffer'''
+        self.assertEqual(self.decoder.decode(), ([], 0))
+
+    def test_response(self):
+        '''Decodes a complete response'''
+        self.decoder.feed(response.Response.pack(b'hello'))
+        self.assertEqual(self.decoder.decode(),
+            ([(constants.FRAME_TYPE_RESPONSE, b'hello')], 0))
+
+    def test_partial(self):
+        '''Waits for the rest of a partial frame'''
+        packed = response.Response.pack(b'hello')
+        self.decoder.feed(packed[:-1])
+        self.assertEqual(self.decoder.decode(), ([], 0))
+        self.decoder.feed(packed[-1:])
+        self.assertEqual(self.decoder.decode(),
+            ([(constants.FRAME_TYPE_RESPONSE, b'hello')], 0))
+
+    def test_partial_size(self):
+        '''Waits for the rest of a partial size'''
+        self.decoder.feed(b'\x00\x00')
+        self.assertEqual(self.decoder.decode(), ([], 0))
+        self.assertEqual(len(self.decoder), 2)
+
+    def test_needed(self):
+        '''Knows how many bytes remain in the next frame'''
+        packed = response.Response.pack(b'hello')
+        self.assertEqual(self.decoder.needed(), 4)
+        self.decoder.feed(packed[:2])
+        self.assertEqual(self.decoder.needed(), 2)
+        self.decoder.feed(packed[2:6])
+        self.assertEqual(self.decoder.needed(), len(packed) - 6)
+        self.decoder.feed(packed[6:])
+        self.assertEqual(self.decoder.needed(), 0)
+
+    def test_counts_messages(self):
+        '''Counts the number of message frames decoded'''
+        self.decoder.feed(response.Response.pack(b'hello'))
+        self.decoder.feed(self.message * 5)
+        self.decoder.feed(response.Error.pack(b'E_INVALID'))
+        frames, messages = self.decoder.decode()
+        self.assertEqual(len(frames), 7)
+        self.assertEqual(messages, 5)
+
+    def test_limit(self):
+        '''Decodes no more than the limit'''
+        self.decoder.feed(self.message * 5)
+        frames, messages = self.decoder.decode(2)
+        self.assertEqual((len(frames), messages), (2, 2))
+        frames, messages = self.decoder.decode()
+        self.assertEqual((len(frames), messages), (3, 3))
+
+    def test_reserve_commit(self):
+        '''Data may be written directly into the reserved buffer'''
+        packed = response.Response.pack(b'hello')
+        view = self.decoder.reserve(len(packed))
+        self.assertGreaterEqual(len(view), len(packed))
+        view[:len(packed)] = packed
+        self.decoder.commit(len(packed))
+        self.assertEqual(self.decoder.decode(),
+            ([(constants.FRAME_TYPE_RESPONSE, b'hello')], 0))
+
+    def test_grows(self):
+        '''Grows its buffer for frames larger than it'''
+        body = b'x' * (FrameDecoder.BUFFER_SIZE * 3)
+        packed = response.Response.pack(body)
+        for index in range(0, len(packed), 4096):
+            self.decoder.feed(packed[index:index + 4096])
+        self.assertEqual(self.decoder.decode(),
+            ([(constants.FRAME_TYPE_RESPONSE, body)], 0))
+
+    def test_compacts(self):
+        '''Moves partial frames to the front of the buffer when it fills'''
+        packed = response.Response.pack(b'hello')
+        with mock.patch.object(FrameDecoder, 'BUFFER_SIZE', 16):
+            decoder = FrameDecoder()
+            found = []
+            for _ in range(10):
+                decoder.feed(packed[:7])
+                found.extend(decoder.decode()[0])
+                decoder.feed(packed[7:])
+                found.extend(decoder.decode()[0])
+        self.assertEqual(found, [(constants.FRAME_TYPE_RESPONSE, b'hello')] * 10)
+
+    def test_copies(self):
+        '''Provides message data as bytes'''
+        self.decoder.feed(self.message)
+        (_, data), = self.decoder.decode()[0]
+        self.assertIsInstance(data, bytes)
+
+    def test_zero_copy(self):
+        '''Provides message data as views in zero-copy mode'''
+        decoder = FrameDecoder(zero_copy=True)
+        decoder.feed(self.message)
+        decoder.feed(response.Response.pack(b'hello'))
+        frames, _ = decoder.decode()
+        self.assertIsInstance(frames[0][1], memoryview)
+        self.assertEqual(frames[0][1], self.message[8:])
+        self.assertIsInstance(frames[1][1], bytes)
+
+    def test_zero_copy_views_survive(self):
+        '''Views remain valid as more data is decoded'''
+        with mock.patch.object(FrameDecoder, 'BUFFER_SIZE', 64):
+            decoder = FrameDecoder(zero_copy=True)
+            found = []
+            for index in range(20):
+                decoder.feed(struct.pack('>ll', 8, 2) + struct.pack('>l', index))
+                found.extend(data for _, data in decoder.decode()[0])
+        self.assertEqual(
+            [struct.unpack('>l', data)[0] for data in found], list(range(20)))
@@ -0,0 +1,512 @@
+from contextlib import contextmanager
+import mock
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import unittest
+
+from nsq import connection
+from nsq import constants
+from nsq import exceptions
+from nsq import producer
+from nsq import response
+from nsq import spool
+
+from common.mockedconnectiontest import MockConnection
+
+
+class TestProducer(unittest.TestCase):
+    '''Tests for our pipelined producer'''
+    nsqd_ports = (12345, 12346)
+
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            hosts = ['localhost:%s' % port for port in self.nsqd_ports]
+            self.producer = producer.Producer(hosts, selector=False)
+            self.connections = self.producer.connections()
+
+    def read(self, connections):
+        '''Read with the provided connections readable'''
+        value = (connections, [], [])
+        with mock.patch('nsq.client.select.select', return_value=value):
+            return self.producer.read()
+
+    @property
+    def connection(self):
+        '''The connection we'll publish on'''
+        return self.connections[0]
+
+    def publish(self, count):
+        '''Publish count messages on our connection'''
+        with mock.patch.object(self.connections[1], '_alive', False):
+            return [self.producer.pub(b'topic', b'%i' % i) for i in range(count)]
+
+    def test_pub(self):
+        '''Sends a PUB on a connection and returns a pending future'''
+        future, = self.publish(1)
+        self.connection.pub.assert_called_with(b'topic', b'0')
+        self.assertFalse(future.done())
+        self.assertEqual(self.producer.pending(), 1)
+
+    def test_mpub(self):
+        '''Sends an MPUB on a connection'''
+        with mock.patch.object(self.connections[1], '_alive', False):
+            self.producer.mpub(b'topic', b'a', b'b')
+        self.connection.mpub.assert_called_with(b'topic', b'a', b'b')
+
+    def test_send_unlocked(self):
+        '''Responses can be read while a publish is being sent'''
+        def pub(*args):
+            # Its future is already waiting, in case the response beats us
+            self.assertEqual(self.producer.pending(), 1)
+        self.connection.pub.side_effect = pub
+        self.publish(1)
+        self.connection.pub.assert_called_with(b'topic', b'0')
+
+    def test_send_failure(self):
+        '''Stops waiting on publishes that couldn't be sent'''
+        self.publish(1)
+        self.connection.pub.side_effect = socket.error('broken')
+        self.assertRaises(socket.error, self.publish, 1)
+        self.assertEqual(self.producer.pending(), 1)
+
+    def test_fifo(self):
+        '''Resolves futures in the order their commands were sent'''
+        futures = self.publish(3)
+        self.connection.response(b'first')
+        self.connection.response(b'second')
+        self.read([self.connection])
+        self.assertEqual(futures[0].result(0), b'first')
+        self.assertEqual(futures[1].result(0), b'second')
+        self.assertFalse(futures[2].done())
+
+    def test_per_connection(self):
+        '''Responses only resolve futures on their own connection'''
+        future, = self.publish(1)
+        self.connections[1].response(b'OK')
+        with mock.patch('nsq.producer.logger'):
+            self.read([self.connections[1]])
+        self.assertFalse(future.done())
+
+    def test_heartbeat(self):
+        '''Heartbeats don't resolve futures'''
+        future, = self.publish(1)
+        self.connection.response(constants.HEARTBEAT)
+        self.read([self.connection])
+        self.assertFalse(future.done())
+
+    def test_error(self):
+        '''Errors are raised from the future, and the rest fail as closed'''
+        futures = self.publish(2)
+        self.connection.error(exceptions.BadTopicException)
+        self.read([self.connection])
+        self.assertRaises(
+            exceptions.BadTopicException, futures[0].result, 0)
+        self.assertRaises(
+            exceptions.ConnectionClosedException, futures[1].result, 0)
+
+    def test_close_connection(self):
+        '''Fails everything waiting when a connection is closed'''
+        future, = self.publish(1)
+        self.producer.close_connection(self.connection)
+        self.assertRaises(
+            exceptions.ConnectionClosedException, future.result, 0)
+        self.assertEqual(self.producer.pending(), 0)
+
+    def test_no_connections(self):
+        '''Raises when there are no connections to publish on'''
+        for conn in self.connections:
+            conn.close()
+        self.assertRaises(exceptions.ConnectionClosedException,
+            self.producer.pub, b'topic', b'message')
+
+    def test_reconnected(self):
+        '''Tracks publishes on reconnected connections'''
+        self.producer.close_connection(self.connection)
+        self.producer.reconnected(self.connection)
+        self.connection._alive = True
+        future, = self.publish(1)
+        self.connection.response(b'OK')
+        self.read([self.connection])
+        self.assertEqual(future.result(0), b'OK')
+
+    def test_drained(self):
+        '''Connections are drained once their publishes are acknowledged'''
+        self.publish(1)
+        self.assertFalse(self.producer.drained(self.connection))
+        self.assertTrue(self.producer.drained(self.connections[1]))
+        self.connection.response(b'OK')
+        self.read([self.connection])
+        self.assertTrue(self.producer.drained(self.connection))
+
+    def test_retiring(self):
+        '''Doesn't publish on connections that are being retired'''
+        with mock.patch.object(self.producer, 'drained', return_value=False):
+            self.producer.retire(self.connections[1])
+        for _ in range(10):
+            self.producer.pub(b'topic', b'message')
+        self.assertFalse(self.connections[1].pub.called)
+        self.assertTrue(self.connections[1].alive())
+
+    def test_running(self):
+        '''Reads responses in the background'''
+        with mock.patch.object(self.producer, 'read') as read:
+            with self.producer.running() as thread:
+                while not read.called:
+                    time.sleep(0.001)
+            self.assertFalse(thread.is_alive())
+
+    def test_running_checks_connections(self):
+        '''Checks connections in the background while running'''
+        with mock.patch('nsq.client.ConnectionChecker') as checker:
+            with mock.patch.object(self.producer, 'read'):
+                with self.producer.running():
+                    checker.return_value.start.assert_called_once_with()
+            checker.return_value.stop.assert_called_once_with()
+
+
+class TestRouting(unittest.TestCase):
+    '''Tests for choosing connections to publish on'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            hosts = ['localhost:%s' % port for port in range(12345, 12349)]
+            self.producer = producer.Producer(
+                hosts, selector=False, router='consistent_hash')
+            self.connections = self.producer.connections()
+
+    def sent(self, method):
+        '''The connections that method was called on'''
+        return [conn for conn in self.connections if getattr(conn, method).called]
+
+    def test_key(self):
+        '''Publishes with the same key go to the same connection'''
+        for i in range(5):
+            self.producer.pub(b'topic', b'%i' % i, key=b'key')
+            self.producer.mpub(b'topic', b'a', b'b', key=b'key')
+        self.assertEqual(len(self.sent('pub')), 1)
+        self.assertEqual(self.sent('pub'), self.sent('mpub'))
+
+    def test_batched_key(self):
+        '''Keyed publishes are batched for their connection'''
+        self.producer.configure_batching(enabled=True)
+        for i in range(5):
+            self.producer.pub(b'topic', b'%i' % i, key=b'key')
+        self.producer.flush_batches(force=True)
+        conn, = self.sent('mpub')
+        conn.mpub.assert_called_once_with(
+            b'topic', b'0', b'1', b'2', b'3', b'4')
+
+    def test_latency(self):
+        '''Tells the router how long publishes took to be acknowledged'''
+        with mock.patch.object(self.producer._router, 'acked') as acked:
+            self.producer.pub(b'topic', b'a', key=b'key')
+            conn, = self.sent('pub')
+            conn.response(b'OK')
+            value = ([conn], [], [])
+            with mock.patch('nsq.client.select.select', return_value=value):
+                self.producer.read()
+            self.assertEqual(acked.call_args[0][0], conn)
+            self.assertGreaterEqual(acked.call_args[0][1], 0)
+
+
+class TestSpooling(unittest.TestCase):
+    '''Tests for spooling messages when there's nowhere to publish them'''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.producer = producer.Producer(['localhost:12345'],
+                selector=False, spool=self.path, spool_drain_interval=60)
+            self.connection, = self.producer.connections()
+        # Respond to every MPUB
+        self.connection.mpub.side_effect = (
+            lambda *args: self.connection.response(b'OK'))
+
+    def tearDown(self):
+        self.producer.close()
+        shutil.rmtree(self.path)
+
+    @contextmanager
+    def running(self):
+        '''Read responses in the background'''
+        value = ([self.connection], [], [])
+        with mock.patch('nsq.client.select.select', return_value=value):
+            with self.producer.running():
+                yield
+
+    def test_spool(self):
+        '''Spools messages when there are no connections'''
+        self.connection.close()
+        futures = [
+            self.producer.pub(b'topic', b'a'),
+            self.producer.mpub(b'topic', b'b', b'c')
+        ]
+        self.assertEqual(
+            [future.result(0) for future in futures], [producer.SPOOLED] * 2)
+        self.assertFalse(self.producer._spool.empty())
+
+    def test_spool_batch(self):
+        '''Spools batches when there are no connections'''
+        self.producer.configure_batching(enabled=True)
+        self.connection.close()
+        future = self.producer.pub(b'topic', b'a')
+        self.producer.flush_batches(force=True)
+        self.assertEqual(future.result(0), producer.SPOOLED)
+
+    def test_spool_keyed_batch(self):
+        '''Spools keyed batched publishes when there are no connections'''
+        self.producer.configure_batching(enabled=True)
+        self.connection.close()
+        future = self.producer.pub(b'topic', b'a', key=b'key')
+        self.producer.flush_batches(force=True)
+        self.assertEqual(future.result(0), producer.SPOOLED)
+        self.assertFalse(self.producer._spool.empty())
+
+    def test_spool_full(self):
+        '''Publishes that don't fit in the spool fail without spooling'''
+        self.producer._spool.close()
+        self.producer._spool = spool.Spool(
+            self.path, segment_bytes=1024, max_bytes=1024)
+        self.connection.close()
+        self.assertRaises(exceptions.SpoolFullException,
+            self.producer.mpub, b'topic', *([b'x' * 100] * 20))
+        self.assertTrue(self.producer._spool.empty())
+
+    def test_no_spool(self):
+        '''Raises when there's no spool'''
+        self.producer._spool.close()
+        self.producer._spool = None
+        self.connection.close()
+        self.assertRaises(exceptions.ConnectionClosedException,
+            self.producer.pub, b'topic', b'a')
+
+    def test_drain(self):
+        '''Republishes spooled messages with MPUB once reconnected'''
+        self.connection.close()
+        self.producer.pub(b'foo', b'a')
+        self.producer.pub(b'foo', b'b')
+        self.producer.pub(b'bar', b'c')
+        # Reconnect as the connection checker would
+        self.connection.ready_to_reconnect.return_value = True
+        self.connection.connect.side_effect = (
+            lambda: setattr(self.connection, '_alive', True) or True)
+        self.producer.check_connections()
+        with self.running():
+            self.assertEqual(self.producer.drain_spool(timeout=1), 3)
+        self.assertEqual(self.connection.mpub.call_args_list, [
+            mock.call(b'foo', b'a', b'b'), mock.call(b'bar', b'c')])
+        self.assertTrue(self.producer._spool.empty())
+
+    def test_drain_failure(self):
+        '''Keeps spooled messages if they can't be published'''
+        self.connection.close()
+        self.producer.pub(b'topic', b'a')
+        with mock.patch('nsq.producer.logger'):
+            self.assertEqual(self.producer.drain_spool(timeout=1), 0)
+        self.assertFalse(self.producer._spool.empty())
+
+    def test_drain_rejected(self):
+        '''Drops spooled messages that nsqd rejects'''
+        self.connection.close()
+        self.producer.pub(b'bad', b'a')
+        self.connection._alive = True
+        self.connection.mpub.side_effect = (
+            lambda *args: self.connection.error(exceptions.BadTopicException))
+        with self.running(), mock.patch('nsq.producer.logger'):
+            self.assertEqual(self.producer.drain_spool(timeout=1), 0)
+        self.assertTrue(self.producer._spool.empty())
+
+
+class TestProducerSocketPair(unittest.TestCase):
+    '''Tests for our producer over real sockets'''
+    def setUp(self):
+        self.producer = producer.Producer(timeout=0.01)
+        with mock.patch.object(connection.Connection, 'connect'):
+            self.conn = connection.Connection('localhost', 1)
+        self.conn._reset()
+        self.conn._socket, self.server = socket.socketpair()
+        self.conn.setblocking(0)
+        self.producer.add(self.conn)
+
+    def tearDown(self):
+        self.producer.close()
+        self.server.close()
+
+    def test_pipelined(self):
+        '''Many publishes are in flight at once'''
+        with self.producer.running():
+            futures = [
+                self.producer.pub(b'topic', b'%i' % i) for i in range(100)]
+            # Wait until all of the commands have been received
+            received = b''
+            expected = b''.join(
+                constants.PUB + b' topic\n' + struct.pack('>l', len(b'%i' % i)) +
+                b'%i' % i for i in range(100))
+            while len(received) < len(expected):
+                received += self.server.recv(65536)
+            self.assertEqual(received, expected)
+            self.server.sendall(response.Response.pack(b'OK') * 100)
+            self.assertEqual(
+                [future.result(1) for future in futures], [b'OK'] * 100)
+
+
+class TestBatching(unittest.TestCase):
+    '''Tests for folding publishes into MPUB'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.producer = producer.Producer(
+                ['localhost:12345'], selector=False, batch=True,
+                batch_max_count=3, batch_max_bytes=100, batch_linger_ms=1000)
+            self.connection, = self.producer.connections()
+
+    def read(self):
+        '''Read with our connection readable'''
+        value = ([self.connection], [], [])
+        with mock.patch('nsq.client.select.select', return_value=value):
+            return self.producer.read()
+
+    def test_full_count(self):
+        '''Sends an MPUB once there are enough messages'''
+        futures = [self.producer.pub(b'topic', b'%i' % i) for i in range(3)]
+        self.connection.mpub.assert_called_once_with(b'topic', b'0', b'1', b'2')
+        self.connection.response(b'OK')
+        self.read()
+        self.assertEqual([f.result(0) for f in futures], [b'OK'] * 3)
+        self.assertEqual(self.producer.batch_stats()['full_count'], 1)
+
+    def test_full_bytes(self):
+        '''Sends an MPUB once the messages are large enough'''
+        self.producer.pub(b'topic', b'x' * 50)
+        self.assertFalse(self.connection.mpub.called)
+        self.producer.pub(b'topic', b'x' * 50)
+        self.connection.mpub.assert_called_once_with(
+            b'topic', b'x' * 50, b'x' * 50)
+        self.assertEqual(self.producer.batch_stats()['full_bytes'], 1)
+
+    def test_per_topic(self):
+        '''Batches messages separately for each topic'''
+        self.producer.pub(b'foo', b'a')
+        self.producer.pub(b'bar', b'b')
+        self.producer.pub(b'foo', b'c')
+        self.assertFalse(self.connection.mpub.called)
+        self.producer.pub(b'foo', b'd')
+        self.connection.mpub.assert_called_once_with(b'foo', b'a', b'c', b'd')
+
+    def test_linger(self):
+        '''Sends batches once they've waited long enough'''
+        self.producer.pub(b'topic', b'a')
+        self.assertGreater(self.producer.flush_batches(), 0)
+        with mock.patch('nsq.producer.time.time', return_value=time.time() + 2):
+            self.assertEqual(self.producer.flush_batches(), None)
+        self.connection.mpub.assert_called_once_with(b'topic', b'a')
+        self.assertEqual(self.producer.batch_stats()['linger'], 1)
+
+    def test_flush_due(self):
+        '''Doesn't wait past the next batch's deadline'''
+        self.producer.configure_batching(linger_ms=10)
+        self.producer.pub(b'topic', b'a')
+        self.assertLessEqual(
+            self.producer.flush_due(self.producer.connections()), 0.01)
+
+    def test_error(self):
+        '''Every message's future gets the MPUB's error'''
+        futures = [self.producer.pub(b'topic', b'%i' % i) for i in range(3)]
+        self.connection.error(exceptions.BadTopicException)
+        self.read()
+        for future in futures:
+            self.assertRaises(exceptions.BadTopicException, future.result, 0)
+
+    def test_configure(self):
+        '''Batching parameters may be changed at runtime'''
+        self.producer.pub(b'topic', b'a')
+        self.producer.configure_batching(max_count=1)
+        # What was waiting is sent out
+        self.connection.mpub.assert_called_once_with(b'topic', b'a')
+        self.producer.pub(b'topic', b'b')
+        self.connection.mpub.assert_called_with(b'topic', b'b')
+        stats = self.producer.batch_stats()
+        self.assertEqual(stats['forced'], 1)
+        self.assertEqual(stats['full_count'], 1)
+
+    def test_disable(self):
+        '''Publishes directly when batching is disabled'''
+        self.producer.configure_batching(enabled=False)
+        self.producer.pub(b'topic', b'a')
+        self.connection.pub.assert_called_once_with(b'topic', b'a')
+
+    def test_stats(self):
+        '''Keeps track of the achieved batch sizes'''
+        for i in range(5):
+            self.producer.pub(b'topic', b'%i' % i)
+        self.producer.flush_batches(force=True)
+        stats = self.producer.batch_stats()
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(stats['messages'], 5)
+        self.assertEqual(stats['bytes'], 5 * 5)
+        self.assertEqual(stats['mean_size'], 2.5)
+
+    def test_close(self):
+        '''Sends anything batched when closing'''
+        self.producer.pub(b'topic', b'a')
+        self.producer.close()
+        self.connection.mpub.assert_called_once_with(b'topic', b'a')
+
+    def test_no_connections(self):
+        '''Fails the batch's futures if it can't be sent'''
+        self.connection.close()
+        future = self.producer.pub(b'topic', b'a')
+        self.producer.flush_batches(force=True)
+        self.assertRaises(
+            exceptions.ConnectionClosedException, future.result, 0)
+
+
+class TestDeferred(unittest.TestCase):
+    '''Tests for deferred publishing'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.producer = producer.Producer(
+                ['localhost:12345'], selector=False, batch=True,
+                batch_max_count=3, dpub_bucket_ms=100)
+            self.connection, = self.producer.connections()
+
+    def test_unbatched(self):
+        '''Sends a DPUB directly when not batching'''
+        self.producer.configure_batching(enabled=False)
+        self.producer.dpub(b'topic', 1000, b'a')
+        self.connection.dpub.assert_called_once_with(b'topic', 1000, b'a')
+
+    def test_buckets(self):
+        '''Groups messages with deadlines in the same bucket'''
+        with mock.patch('nsq.producer.time.time', return_value=1000.0):
+            self.producer.dpub(b'topic', 1010, b'a')
+            self.producer.dpub(b'topic', 5000, b'b')
+            self.producer.dpub(b'topic', 1050, b'c')
+            self.producer.dpub(b'other', 1050, b'd')
+            self.assertFalse(self.connection.dpub_many.called)
+            self.producer.dpub(b'topic', 1090, b'e')
+            # The delay is rounded up to the end of the bucket
+            self.connection.dpub_many.assert_called_once_with(
+                b'topic', 1100, [b'a', b'c', b'e'])
+
+    def test_delay_elapsed(self):
+        '''The delay accounts for the time spent waiting to be sent'''
+        with mock.patch('nsq.producer.time.time', return_value=1000.0):
+            self.producer.dpub(b'topic', 1000, b'a')
+        with mock.patch('nsq.producer.time.time', return_value=1000.25):
+            self.producer.flush_batches(force=True)
+        self.connection.dpub_many.assert_called_once_with(
+            b'topic', 750, [b'a'])
+
+    def test_responses(self):
+        '''Each message's future is resolved by its own DPUB's response'''
+        futures = [self.producer.dpub(b'topic', 0, b'%i' % i) for i in range(3)]
+        self.connection.response(b'OK')
+        self.connection.error(exceptions.BadMessageException)
+        self.connection.response(b'OK')
+        value = ([self.connection], [], [])
+        with mock.patch('nsq.client.select.select', return_value=value):
+            self.producer.read()
+        self.assertEqual(futures[0].result(0), b'OK')
+        self.assertRaises(
+            exceptions.BadMessageException, futures[1].result, 0)
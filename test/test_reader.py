@@ -1,11 +1,21 @@
+from concurrent.futures import Future
 import mock
 
+import functools
+import socket
+import threading
+import time
+import unittest
 import uuid
 
+from nsq import backoff
+from nsq import connection
+from nsq import constants
 from nsq import reader
 from nsq import response
 
 from common import HttpClientIntegrationTest
+from common.mockedconnectiontest import MockConnection
 
 
 class TestReader(HttpClientIntegrationTest):
@@ -45,17 +55,20 @@ class TestReader(HttpClientIntegrationTest):
             self.client.added(conn)
             self.assertFalse(mock_reconnected.called)
 
-    def test_it_checks_max_in_flight(self):
-        '''Raises an exception if more connections than in-flight limit'''
-        with mock.patch.object(self.client, '_max_in_flight', 0):
-            self.assertRaises(NotImplementedError, self.client.distribute_ready)
+    def test_it_rotates_ready(self):
+        '''Rotates RDY 1 if there are more connections than max_in_flight'''
+        with mock.patch.object(self.client, '_max_in_flight', 1):
+            self.client.distribute_ready()
+        self.assertEqual(
+            sorted(conn.last_ready_sent for conn in self.client.connections()),
+            [0, 1])
 
     def test_it_distributes_ready(self):
-        '''It distributes RDY with util.distribute'''
-        with mock.patch('nsq.reader.distribute') as mock_distribute:
+        '''It sends the RDY its allocator plans'''
+        with mock.patch.object(self.client._allocator, 'plan') as mock_plan:
             counts = range(10)
             connections = [mock.Mock(max_rdy_count=100) for _ in counts]
-            mock_distribute.return_value = zip(counts, connections)
+            mock_plan.return_value = zip(counts, connections)
             self.client.distribute_ready()
             for count, connection in zip(counts, connections):
                 connection.rdy.assert_called_with(count)
@@ -64,7 +77,8 @@ class TestReader(HttpClientIntegrationTest):
         '''It does not distribute RDY state to dead connections'''
         dead = mock.Mock(max_rdy_count=100)
         dead.alive.return_value = False
-        alive = mock.Mock(max_rdy_count=100)
+        alive = mock.Mock(max_rdy_count=100, host='localhost', port=4150,
+            ready=0, last_ready_sent=0, received=0)
         alive.alive.return_value = True
         with mock.patch.object(
             self.client, 'connections', return_value=[alive, dead]):
@@ -173,3 +187,610 @@ class TestReader(HttpClientIntegrationTest):
         with mock.patch.object(self.client, 'distribute_ready') as mock_ready:
             self.client.close_connection(self.client.connections()[0])
             mock_ready.assert_called_with()
+
+
+class TestReaderReady(unittest.TestCase):
+    '''Tests for the RDY given to connections as they're made'''
+    def setUp(self):
+        addresses = ['localhost:%i' % port for port in range(4150, 4160)]
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=addresses, max_in_flight=2,
+                ready_rotation=30.0)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_within_max_in_flight(self):
+        '''Connections outnumbering max_in_flight don't all get RDY'''
+        connections = self.client.connections()
+        self.assertEqual(len(connections), 10)
+        self.assertLessEqual(
+            sum(conn.last_ready_sent for conn in connections), 2)
+        self.assertEqual(
+            len([conn for conn in connections if conn.last_ready_sent]), 2)
+
+    def test_reconnected(self):
+        '''Reconnected connections wait for their turn for RDY'''
+        idle = [conn for conn in self.client.connections()
+            if not conn.last_ready_sent][0]
+        self.client.reconnected(idle)
+        self.assertEqual(idle.last_ready_sent, 0)
+
+    def test_rotation(self):
+        '''The rotation period may be configured'''
+        self.assertEqual(self.client._allocator._rotation, 30.0)
+
+
+class TestReaderBackoff(unittest.TestCase):
+    '''Tests for throttling a reader while messages are being requeued'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=['localhost:4150', 'localhost:4151'],
+                max_in_flight=10, backoff=backoff.Constant(10))
+        self.connections = self.client.connections()
+        for conn in self.connections:
+            conn.ready = conn.last_ready_sent = 5
+            conn.max_rdy_count = 2500
+            conn.rdy.side_effect = functools.partial(self.rdy, conn)
+
+    def tearDown(self):
+        self.client.close()
+
+    def rdy(self, conn, count):
+        '''Record the RDY sent to a connection'''
+        conn.ready = conn.last_ready_sent = count
+
+    def ready(self):
+        '''The last RDY sent to each connection'''
+        return [conn.last_ready_sent for conn in self.connections]
+
+    def test_listens(self):
+        '''Listens to its connections for messages being finished'''
+        for conn in self.connections:
+            conn.listen.assert_called_with(self.client.landed)
+
+    def test_backs_off(self):
+        '''Requeues stop all RDY'''
+        self.client.landed(self.connections[0], 1, False)
+        self.assertEqual(self.ready(), [0, 0])
+
+    def test_test_message(self):
+        '''Lets one message through once the backoff has ended'''
+        self.client.landed(self.connections[0], 1, False)
+        with mock.patch('nsq.backoff.time.time', return_value=time.time() + 10):
+            self.assertTrue(self.client.needs_distribute_ready())
+            self.client.distribute_ready()
+        self.assertEqual(sorted(self.ready()), [0, 1])
+
+    def test_ramps_up(self):
+        '''Successes ramp RDY back up'''
+        self.client.landed(self.connections[0], 1, False)
+        with mock.patch('nsq.backoff.time.time', return_value=time.time() + 10):
+            self.client.landed(self.connections[0], 1, True)
+        self.assertEqual(self.ready(), [5, 5])
+        self.assertEqual(self.client.throttle.backoffs, 1)
+
+    def test_disabled(self):
+        '''Doesn't back off by default'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=['localhost:4150'])
+        self.assertIsNone(client.throttle)
+        conn, = client.connections()
+        conn.rdy.reset_mock()
+        client.landed(conn, 1, False)
+        self.assertFalse(conn.rdy.called)
+
+    def test_default_policy(self):
+        '''Backs off with the default policy if asked to'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=['localhost:4150'], backoff=True)
+        self.assertIsInstance(client.throttle, backoff.Throttle)
+
+
+def upper(message):
+    '''A handler that can be run in another process'''
+    if message.body == b'fail':
+        raise ValueError('Failed')
+    return message.body.upper()
+
+
+class TestReaderRun(unittest.TestCase):
+    '''Tests for handling messages on a pool of workers'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=['localhost:4150'], backoff=False)
+        self.conn, = self.client.connections()
+        self.conn.ready = self.conn.last_ready_sent = 10
+        self.conn.max_rdy_count = 2500
+        self.conn.pending.return_value = False
+
+    def tearDown(self):
+        self.client.close()
+
+    def select(self, *args):
+        '''Pretend our connection is readable every so often'''
+        time.sleep(0.001)
+        return [self.conn], [], []
+
+    def run_until(self, handler, condition, **kwargs):
+        '''Run the handler in the background until condition is met'''
+        thread = threading.Thread(
+            target=self.client.run, args=(handler,), kwargs=kwargs)
+        with mock.patch.object(self.client, 'connection_checker'):
+            with mock.patch('nsq.client.select.select', side_effect=self.select):
+                thread.start()
+                deadline = time.time() + 10
+                while not condition() and time.time() < deadline:
+                    time.sleep(0.001)
+                self.client.stop()
+                thread.join()
+
+    def test_fin(self):
+        '''Messages are finished on their connection once handled'''
+        self.conn.message(b'hello', b'1' * 16)
+        handled = []
+        self.run_until(handled.append, lambda: self.conn.fin.called)
+        self.conn.fin.assert_called_with(b'1' * 16)
+        self.assertEqual([message.body for message in handled], [b'hello'])
+
+    def test_req(self):
+        '''Messages are requeued if their handler raises'''
+        self.conn.message(b'fail', b'1' * 16)
+        with mock.patch('nsq.reader.logger'):
+            self.run_until(upper, lambda: self.conn.req.called)
+        self.conn.req.assert_called_with(b'1' * 16, 60)
+
+    def test_concurrency(self):
+        '''Runs handlers concurrently, with RDY for each worker'''
+        for index in range(4):
+            self.conn.message(b'%i' % index, b'%16i' % index)
+        barrier = threading.Barrier(4, timeout=5)
+        self.run_until(lambda message: barrier.wait(),
+            lambda: self.conn.fin.call_count == 4, concurrency=4)
+        self.assertEqual(self.conn.fin.call_count, 4)
+        self.assertEqual(self.client._max_in_flight, 4)
+
+    def test_stop(self):
+        '''Stopping waits for running handlers to return'''
+        self.conn.message(b'hello', b'1' * 16)
+        started = threading.Event()
+
+        def handler(message):
+            '''Take a little while'''
+            started.set()
+            time.sleep(0.05)
+        self.run_until(handler, started.is_set)
+        self.conn.fin.assert_called_with(b'1' * 16)
+
+    def test_process(self):
+        '''Runs handlers in other processes'''
+        self.conn.message(b'hello', b'1' * 16)
+        self.conn.message(b'fail', b'2' * 16)
+        with mock.patch('nsq.reader.logger'):
+            self.run_until(upper,
+                lambda: self.conn.fin.called and self.conn.req.called,
+                executor='process', concurrency=2)
+        self.conn.fin.assert_called_with(b'1' * 16)
+        self.conn.req.assert_called_with(b'2' * 16, 60)
+
+    def test_process_zero_copy(self):
+        '''Processes are given a copy of zero-copy messages as bytes'''
+        data = response.Message.header.pack(0, 1, b'1' * 16) + b'hello'
+        self.conn._responses.append(response.Message(
+            self.conn, response.Message.FRAME_TYPE, memoryview(data)))
+        pool = mock.Mock(spec=reader.ProcessPoolExecutor)
+        future = Future()
+        future.set_result(None)
+        pool.submit.return_value = future
+        self.run_until(None, lambda: self.conn.fin.called, executor=pool)
+        work = pool.submit.call_args[0][1]
+        self.assertIsInstance(work.data, bytes)
+        self.assertEqual(work.body, b'hello')
+        self.assertEqual(work.id, b'1' * 16)
+
+
+class TestReaderBatches(unittest.TestCase):
+    '''Tests for consuming messages in batches'''
+    setUp = TestReaderRun.setUp
+    tearDown = TestReaderRun.tearDown
+    select = TestReaderRun.select
+
+    def run_until(self, handler, condition, **kwargs):
+        '''Run the batch handler in the background until condition is met'''
+        thread = threading.Thread(
+            target=self.client.run_batches, args=(handler,), kwargs=kwargs)
+        with mock.patch.object(self.client, 'connection_checker'):
+            with mock.patch('nsq.client.select.select', side_effect=self.select):
+                thread.start()
+                deadline = time.time() + 10
+                while not condition() and time.time() < deadline:
+                    time.sleep(0.001)
+                self.client.stop()
+                thread.join()
+
+    def messages(self, count):
+        '''Send count messages'''
+        for index in range(count):
+            self.conn.message(b'%i' % index, b'%16i' % index)
+
+    def test_fin(self):
+        '''Full batches are finished with a single write'''
+        self.messages(4)
+        batches = []
+        self.run_until(batches.append, lambda: self.conn.fin_many.called,
+            max_size=2, max_wait=10)
+        self.assertEqual([len(batch) for batch in batches], [2, 2])
+        self.assertEqual(self.conn.fin_many.call_count, 2)
+        self.conn.fin_many.assert_called_with([b'%16i' % 2, b'%16i' % 3])
+
+    def test_req(self):
+        '''Batches are requeued if their handler raises'''
+        self.messages(2)
+
+        def handler(batch):
+            '''Fail'''
+            raise ValueError('Failed')
+        with mock.patch('nsq.reader.logger'):
+            self.run_until(handler, lambda: self.conn.req_many.called,
+                max_size=2)
+        self.conn.req_many.assert_called_with([b'%16i' % 0, b'%16i' % 1], 60)
+
+    def test_processed(self):
+        '''Messages the handler acknowledged itself are left alone'''
+        self.messages(2)
+        self.run_until(lambda batch: batch[0].req(0),
+            lambda: self.conn.fin_many.called, max_size=2)
+        self.conn.fin_many.assert_called_with([b'%16i' % 1])
+
+    def test_max_wait(self):
+        '''Partial batches are handled after max_wait'''
+        self.messages(1)
+        batches = []
+        self.run_until(batches.append, lambda: batches,
+            max_size=100, max_wait=0.01)
+        self.assertEqual([len(batch) for batch in batches], [1])
+
+    def test_msg_timeout(self):
+        '''Batches are handled with at least half their msg_timeout left'''
+        self.conn.msg_timeout = 0.02
+        self.messages(1)
+        batches = []
+        self.run_until(batches.append, lambda: batches,
+            max_size=100, max_wait=60)
+        self.assertEqual([len(batch) for batch in batches], [1])
+
+    def test_max_in_flight(self):
+        '''Raises max_in_flight so that a full batch may be in flight'''
+        self.client.set_max_in_flight(10)
+        self.messages(1)
+        self.run_until(lambda batch: None, lambda: self.conn.fin_many.called,
+            max_size=50, max_wait=0.01)
+        self.assertEqual(self.client._max_in_flight, 50)
+
+    def test_stop(self):
+        '''Partial batches are handled when stopping'''
+        self.messages(1)
+        batches = []
+        self.run_until(batches.append, lambda: not self.conn._responses,
+            max_size=100, max_wait=60)
+        self.assertEqual([len(batch) for batch in batches], [1])
+
+
+class TestReaderAutoTouch(unittest.TestCase):
+    '''Tests for touching messages while they're being handled'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=['localhost:4150'], auto_touch=0.5)
+        self.conn, = self.client.connections()
+        self.conn.ready = self.conn.last_ready_sent = 10
+        self.conn.max_rdy_count = 2500
+        self.toucher = self.client._toucher
+
+    def tearDown(self):
+        self.client.close()
+
+    def read(self):
+        '''Read a message from our connection'''
+        self.conn.message(b'hello', b'1' * 16)
+        with mock.patch('nsq.client.select.select',
+            return_value=([self.conn], [], [])):
+            return self.client.read()
+
+    def test_disabled(self):
+        '''Doesn't touch messages by default'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=['localhost:4150'])
+        self.assertIsNone(client._toucher)
+        client.close()
+
+    def test_tracks(self):
+        '''Messages that are read are touched until they're handled'''
+        message, = self.read()
+        self.assertEqual(self.toucher.pending(self.conn), 1)
+        self.toucher.touch(time.time() + 30)
+        self.conn.touch_many.assert_called_once_with([b'1' * 16])
+
+    def test_reconnected(self):
+        '''Messages from before a reconnection are forgotten'''
+        self.read()
+        self.client.reconnected(self.conn)
+        self.assertEqual(self.toucher.pending(self.conn), 0)
+
+    def test_close(self):
+        '''Closing the reader stops touching messages'''
+        self.client.close()
+        self.assertFalse(self.toucher.is_alive())
+
+
+class TestMultiReader(unittest.TestCase):
+    '''Tests for reading several subscriptions at once'''
+    def setUp(self):
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            self.client = reader.MultiReader(
+                [(b'foo', b'channel', 3), (b'bar', b'channel')],
+                nsqd_tcp_addresses=['localhost:4150', 'localhost:4151'],
+                max_in_flight=100)
+        for conn in self.client.connections():
+            conn.ready = conn.last_ready_sent = 10
+            conn.max_rdy_count = 2500
+            conn.pending.return_value = False
+
+    def tearDown(self):
+        self.client.close()
+
+    def subscription(self, topic):
+        '''The reader for a topic'''
+        for found, _, sub in self.client.readers():
+            if found == topic:
+                return sub
+
+    def read(self, connections):
+        '''Read with the provided connections readable'''
+        value = (connections, [], [])
+        with mock.patch('nsq.reader.select.select', return_value=value) as select:
+            return self.client.read(), select
+
+    def test_subscribes(self):
+        '''Each subscription has its own connections to each nsqd'''
+        self.assertEqual(len(self.client.connections()), 4)
+        for topic in (b'foo', b'bar'):
+            for conn in self.subscription(topic).connections():
+                conn.sub.assert_called_with(topic, b'channel')
+
+    def test_weights(self):
+        '''Splits max_in_flight by weight, after 1 for each subscription'''
+        self.assertEqual(self.subscription(b'foo')._max_in_flight, 74)
+        self.assertEqual(self.subscription(b'bar')._max_in_flight, 26)
+        for conn in self.client.connections():
+            conn.ready = 0
+        self.read([])
+        self.assertEqual(
+            sorted(conn.rdy.call_args[0][0] for conn in self.client.connections()),
+            [13, 13, 37, 37])
+
+    def test_rebalance(self):
+        '''Subscriptions without connections don't take up any of the budget'''
+        for conn in self.subscription(b'bar').connections():
+            conn.close()
+        self.client.rebalance()
+        self.assertEqual(self.subscription(b'foo')._max_in_flight, 100)
+
+    def test_budget(self):
+        '''Subscriptions never have more than max_in_flight between them'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.MultiReader(
+                [(b'%i' % index, b'channel') for index in range(40)],
+                nsqd_tcp_addresses=['localhost:4150'], max_in_flight=10)
+        try:
+            totals = [sum(sub._max_in_flight for _, _, sub in client.readers())]
+            chosen = set()
+            now = time.time()
+            for _ in range(4):
+                now += 5
+                with mock.patch('nsq.reader.time.time', return_value=now):
+                    client.rebalance()
+                totals.append(
+                    sum(sub._max_in_flight for _, _, sub in client.readers()))
+                chosen.update(topic for topic, _, sub in client.readers()
+                    if sub._max_in_flight)
+            self.assertEqual(totals, [10] * 5)
+            # Every subscription gets a turn
+            self.assertEqual(len(chosen), 40)
+        finally:
+            client.close()
+
+    def test_budget_rdy(self):
+        '''The RDY across every subscription's connections stays in budget'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.MultiReader(
+                [(b'%i' % index, b'channel') for index in range(6)],
+                nsqd_tcp_addresses=['localhost:4150'], max_in_flight=2)
+        try:
+            def total():
+                '''The RDY last sent to all of the connections'''
+                return sum(
+                    conn.last_ready_sent for conn in client.connections())
+            self.assertEqual(len(client.connections()), 6)
+            self.assertLessEqual(total(), 2)
+            now = time.time()
+            for _ in range(3):
+                now += 5
+                with mock.patch('nsq.reader.time.time', return_value=now):
+                    client.rebalance()
+                self.assertLessEqual(total(), 2)
+        finally:
+            client.close()
+
+    def test_rebalance_takes_back(self):
+        '''Subscriptions that lose their share have their RDY taken back'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.MultiReader(
+                [(b'%i' % index, b'channel') for index in range(3)],
+                nsqd_tcp_addresses=['localhost:4150'], max_in_flight=1)
+        try:
+            for conn in client.connections():
+                conn.rdy(1)
+            client.rebalance()
+            self.assertEqual(
+                sum(conn.last_ready_sent for conn in client.connections()), 1)
+        finally:
+            client.close()
+
+    def test_rotation_bounded(self):
+        '''The same subscriptions keep their share until it's time to rotate'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.MultiReader(
+                [(b'%i' % index, b'channel') for index in range(4)],
+                nsqd_tcp_addresses=['localhost:4150'], max_in_flight=2)
+        try:
+            def chosen():
+                '''The topics that currently have some of max_in_flight'''
+                client.rebalance()
+                return [topic for topic, _, sub in client.readers()
+                    if sub._max_in_flight]
+            first = chosen()
+            self.assertEqual(len(first), 2)
+            self.assertEqual(chosen(), first)
+            self.assertFalse(client.rotation_due())
+            with mock.patch('nsq.reader.time.time',
+                return_value=time.time() + 5):
+                self.assertTrue(client.rotation_due())
+                self.assertEqual(len(set(chosen()) - set(first)), 2)
+        finally:
+            client.close()
+
+    def test_one_select(self):
+        '''Selects over every subscription's connections at once'''
+        foo = self.subscription(b'foo').connections()[0]
+        bar = self.subscription(b'bar').connections()[1]
+        foo.message(b'hello')
+        bar.message(b'howdy')
+        found, select = self.read([foo, bar])
+        self.assertEqual(select.call_count, 1)
+        self.assertEqual(len(select.call_args[0][0]), 4)
+        self.assertEqual(
+            [(topic, res.body) for topic, _, res in found],
+            [(b'foo', b'hello'), (b'bar', b'howdy')])
+
+    def test_check_connections(self):
+        '''Checks every subscription's connections'''
+        for _, _, sub in self.client.readers():
+            sub.check_connections = mock.Mock()
+        self.client.check_connections()
+        for _, _, sub in self.client.readers():
+            sub.check_connections.assert_called_with()
+
+    def test_iter(self):
+        '''Yields the topic and channel of each message'''
+        foo = self.subscription(b'foo').connections()[0]
+        foo.message(b'hello')
+        with mock.patch.object(self.client, 'connection_checker'):
+            with mock.patch('nsq.reader.select.select',
+                return_value=([foo], [], [])):
+                topic, channel, message = next(iter(self.client))
+        self.assertEqual((topic, channel, message.body),
+            (b'foo', b'channel', b'hello'))
+
+    def test_auto_touch(self):
+        '''Every subscription shares one toucher, which tracks their messages'''
+        with mock.patch('nsq.client.connection.Connection', MockConnection):
+            client = reader.MultiReader(
+                [(b'foo', b'channel'), (b'bar', b'channel')],
+                nsqd_tcp_addresses=['localhost:4150'], auto_touch=0.5)
+        try:
+            toucher = client._toucher
+            self.assertEqual(
+                set(sub._toucher for _, _, sub in client.readers()),
+                set([toucher]))
+            for conn in client.connections():
+                conn.ready = conn.last_ready_sent = 10
+                conn.max_rdy_count = 2500
+                conn.pending.return_value = False
+            conn = client.connections()[0]
+            conn.message(b'hello')
+            with mock.patch('nsq.reader.select.select',
+                return_value=([conn], [], [])):
+                client.read()
+            self.assertEqual(toucher.pending(conn), 1)
+        finally:
+            client.close()
+        self.assertFalse(toucher.is_alive())
+
+
+class TestMultiReaderSelector(unittest.TestCase):
+    '''Tests for reading several subscriptions with one registered selector'''
+    def setUp(self):
+        self.client = reader.MultiReader(
+            [(b'foo', b'channel'), (b'bar', b'channel')],
+            timeout=0.01, selector=True, max_in_flight=10)
+        self.servers = []
+        self.connections = [
+            self.connect(self.subscription(topic), port)
+            for port, topic in enumerate((b'foo', b'bar'))]
+        # Consume the SUB and RDY sent on connecting
+        self.client.read()
+        for server in self.servers:
+            server.recv(1024)
+
+    def tearDown(self):
+        self.client.close()
+        for server in self.servers:
+            server.close()
+
+    def subscription(self, topic):
+        '''The reader for a topic'''
+        for found, _, sub in self.client.readers():
+            if found == topic:
+                return sub
+
+    def connect(self, sub, port):
+        '''Add a connection to a subscription over a socketpair'''
+        with mock.patch.object(connection.Connection, 'connect'):
+            conn = connection.Connection('localhost', port)
+        conn._reset()
+        conn._socket, server = socket.socketpair()
+        conn.setblocking(0)
+        server.settimeout(5)
+        self.servers.append(server)
+        sub.add(conn)
+        return conn
+
+    def test_registered(self):
+        '''Every subscription's connections share one selector'''
+        selector = self.client._selector
+        for _, _, sub in self.client.readers():
+            self.assertIs(sub._selector, selector)
+        registered = set(key.data for key in selector.get_map().values())
+        self.assertEqual(registered, set(self.connections + [None]))
+
+    def test_read(self):
+        '''Reads messages from each subscription's connections'''
+        self.servers[1].sendall(
+            response.Message.pack(0, 1, b'1' * 16, b'hello'))
+        found = []
+        deadline = time.time() + 5
+        while not found and time.time() < deadline:
+            found = self.client.read()
+        self.assertEqual(
+            [(topic, res.body) for topic, _, res in found], [(b'bar', b'hello')])
+
+    def test_writes_pending(self):
+        '''Connections with something to send are flushed'''
+        self.connections[0].nop()
+        self.client.read()
+        self.assertEqual(self.servers[0].recv(100), constants.NOP + b'\n')
+
+    def test_close(self):
+        '''Readers leave the shared selector for the MultiReader to close'''
+        sub = self.subscription(b'foo')
+        sub.close()
+        self.assertIsNotNone(self.client._selector.get_map())
+        self.assertNotIn(self.connections[0], set(
+            key.data for key in self.client._selector.get_map().values()))
@@ -0,0 +1,202 @@
+import mock
+import unittest
+
+from nsq import ready
+
+
+def connections(count, host='localhost'):
+    '''Some fake connections to different nsqd instances'''
+    return [
+        mock.Mock(host=host, port=port, received=0, ready=0, last_ready_sent=0,
+            max_rdy_count=2500)
+        for port in range(count)]
+
+
+class TestAllocator(unittest.TestCase):
+    '''Tests for our RDY allocator'''
+    def setUp(self):
+        self.allocator = ready.Allocator(window=10.0)
+        self.connections = connections(3)
+        self.now = 1000.0
+        self.allocator._updated = self.now
+
+    def clock(self):
+        '''Patch the time to be now'''
+        return mock.patch('nsq.ready.time.time', return_value=self.now)
+
+    def allocate(self, total=100, elapsed=1.0):
+        '''Allocate total after some time has passed'''
+        self.now += elapsed
+        with self.clock():
+            return [count for count, _ in
+                self.allocator.allocate(total, self.connections)]
+
+    def test_even(self):
+        '''Splits evenly until messages are received'''
+        self.assertEqual(self.allocate(), [33, 33, 34])
+
+    def test_rate(self):
+        '''Keeps a moving average of each connection's message rate'''
+        self.allocate()
+        self.connections[0].received = 100
+        self.allocate(elapsed=10.0)
+        rate = self.allocator.rate(self.connections[0])
+        self.assertAlmostEqual(rate, 10 * (1 - 1 / 2.718281828), places=3)
+        self.allocate(elapsed=10.0)
+        self.assertLess(self.allocator.rate(self.connections[0]), rate)
+
+    def test_weighted(self):
+        '''Busy connections get more, but idle ones still get 1'''
+        self.allocate()
+        self.connections[0].received = 300
+        self.connections[1].received = 100
+        self.assertEqual(self.allocate(), [73, 26, 1])
+        self.connections[0].received = 600
+        self.connections[1].received = 100
+        counts = self.allocate()
+        self.assertEqual(sum(counts), 100)
+        self.assertEqual(counts[2], 1)
+
+    def test_depth(self):
+        '''Connections to an nsqd with known depth get more'''
+        self.allocator.set_depth('localhost', 2, 6000)
+        self.assertEqual(self.allocate(), [1, 1, 98])
+
+    def test_depth_shared(self):
+        '''Depth is split among the connections to an nsqd'''
+        self.connections = connections(1) + connections(1)
+        self.allocator.set_depth('localhost', 0, 6000)
+        self.assertEqual(self.allocate(), [50, 50])
+
+    def test_reset(self):
+        '''Copes with a connection's count starting over'''
+        self.connections[0].received = 100
+        self.allocate()
+        self.connections[0].received = 10
+        self.allocate()
+        self.assertGreater(self.allocator.rate(self.connections[0]), 0)
+
+    def test_forgets(self):
+        '''Forgets about connections it's no longer allocating to'''
+        self.allocate()
+        self.connections[0].received = 100
+        self.allocate()
+        self.connections.pop(0)
+        self.allocate()
+        self.assertEqual(len(self.allocator._rates), 2)
+
+    def test_due(self):
+        '''Rebalancing is due once some of the window has passed'''
+        with self.clock():
+            self.assertFalse(self.allocator.due())
+        self.now += 3
+        with self.clock():
+            self.assertTrue(self.allocator.due())
+
+    def plan(self, total=100):
+        '''The counts planned for each connection'''
+        self.now += 1
+        with self.clock():
+            planned = self.allocator.plan(total, self.connections)
+        return [(count, self.connections.index(conn)) for count, conn in planned]
+
+    def test_plan_max_rdy_count(self):
+        '''Never plans more than a connection's max_rdy_count'''
+        self.connections[0].max_rdy_count = 10
+        self.assertIn((10, 0), self.plan())
+
+    def test_plan_unchanged(self):
+        '''Doesn't send RDY to connections that have plenty'''
+        for conn, count in zip(self.connections, (33, 33, 34)):
+            conn.ready = conn.last_ready_sent = count
+        self.assertEqual(self.plan(), [])
+
+    def test_plan_depleted(self):
+        '''Sends RDY to connections that have nearly used theirs up'''
+        for conn, count in zip(self.connections, (33, 33, 34)):
+            conn.ready = conn.last_ready_sent = count
+        self.connections[1].ready = 5
+        self.assertEqual(self.plan(), [(33, 1)])
+
+    def test_plan_decreases_first(self):
+        '''Sends decreases before increases'''
+        for conn, count in zip(self.connections, (1, 1, 98)):
+            conn.ready = conn.last_ready_sent = count
+        self.assertEqual(self.plan(), [(34, 2), (33, 0), (33, 1)])
+
+    def test_plan_slack(self):
+        '''Puts off small increases until they're needed'''
+        for conn, count in zip(self.connections, (30, 30, 40)):
+            conn.ready = conn.last_ready_sent = count
+        self.assertEqual(self.plan(), [(34, 2)])
+
+
+class TestRotation(unittest.TestCase):
+    '''Tests for rotating RDY when connections outnumber max_in_flight'''
+    def setUp(self):
+        self.allocator = ready.Allocator(window=10.0, rotation=5.0)
+        self.connections = connections(6)
+        self.now = 1000.0
+        self.allocator._updated = self.now
+
+    def rotate(self, total=2, elapsed=5.0):
+        '''The indexes of the connections chosen after some time has passed'''
+        self.now += elapsed
+        with mock.patch('nsq.ready.time.time', return_value=self.now):
+            allocated = self.allocator.allocate(total, self.connections)
+        self.assertEqual(set(count for count, _ in allocated) - set([0, 1]), set())
+        return [self.connections.index(conn)
+            for count, conn in allocated if count]
+
+    def test_subset(self):
+        '''Only max_in_flight connections get RDY 1'''
+        self.assertEqual(len(self.rotate()), 2)
+
+    def test_bounded(self):
+        '''The same subset keeps RDY until it's time to rotate'''
+        chosen = self.rotate()
+        self.assertEqual(self.rotate(elapsed=1.0), chosen)
+        self.assertNotEqual(self.rotate(elapsed=5.0), chosen)
+
+    def test_no_starvation(self):
+        '''Every connection gets a turn'''
+        found = set()
+        for _ in range(3):
+            found.update(self.rotate())
+        self.assertEqual(found, set(range(6)))
+
+    def test_busy_sooner(self):
+        '''Connections that have had messages come around again sooner'''
+        for _ in range(3):
+            self.rotate()
+        self.connections[0].received = 100
+        self.rotate(elapsed=1.0)
+        turns = [0 in self.rotate() for _ in range(6)]
+        self.assertGreater(turns.count(True), 2)
+        # But everyone else still gets a turn
+        found = set()
+        for _ in range(12):
+            found.update(self.rotate())
+        self.assertEqual(found, set(range(6)))
+
+    def test_replaces_dead(self):
+        '''Connections that go away are replaced right away'''
+        chosen = self.rotate()
+        self.connections.pop(chosen[0])
+        self.assertEqual(len(self.rotate(elapsed=1.0)), 2)
+
+    def test_due(self):
+        '''Rotation is due every rotation seconds'''
+        self.rotate()
+        with mock.patch('nsq.ready.time.time', return_value=self.now + 5):
+            self.assertTrue(self.allocator.due())
+
+    def test_plan(self):
+        '''Takes RDY away from the last subset before giving it to the next'''
+        for index in self.rotate():
+            self.connections[index].ready = 1
+            self.connections[index].last_ready_sent = 1
+        self.now += 5
+        with mock.patch('nsq.ready.time.time', return_value=self.now):
+            planned = self.allocator.plan(2, self.connections)
+        self.assertEqual([count for count, _ in planned], [0, 0, 1, 1])
@@ -1,5 +1,6 @@
 import unittest
 
+import functools
 import mock
 import uuid
 import six
@@ -19,6 +20,20 @@ class TestResponse(unittest.TestCase):
         self.assertEqual(res.__class__, response.Response)
         self.assertEqual(res.data, b'hello')
 
+    def test_from_raw_memoryview(self):
+        '''Responses constructed from memoryviews are bytes'''
+        raw = struct.pack('>l5s', constants.FRAME_TYPE_RESPONSE, b'hello')
+        res = response.Response.from_raw(None, memoryview(raw))
+        self.assertIsInstance(res.data, bytes)
+        self.assertEqual(res.data, b'hello')
+
+    def test_from_frame(self):
+        '''Can construct a response from a decoded frame'''
+        res = response.Response.from_frame(
+            None, constants.FRAME_TYPE_ERROR, b'E_INVALID')
+        self.assertEqual(res.__class__, response.Error)
+        self.assertEqual(res.data, b'E_INVALID')
+
     def test_from_raw_unknown_frame(self):
         '''Raises an exception for unknown frame types'''
         raw = struct.pack('>l5s', 9042, b'hello')
@@ -137,6 +152,15 @@ class TestMessage(unittest.TestCase):
         '''Can properly detect the message'''
         self.assertEqual(self.response.body, self.body)
 
+    def test_from_memoryview(self):
+        '''Messages constructed from memoryviews reference them'''
+        raw = memoryview(
+            struct.pack('>l31s', constants.FRAME_TYPE_MESSAGE, self.packed))
+        message = response.Response.from_raw(None, raw)
+        self.assertIsInstance(message.body, memoryview)
+        self.assertEqual(message.body, self.body)
+        self.assertEqual(message.id, self.id)
+
     def test_fin(self):
         '''Invokes the fin method'''
         self.response.fin()
@@ -219,3 +243,55 @@ class TestMessage(unittest.TestCase):
         except ValueError:
             # The connection should have been closed
             self.response.connection.close.assert_called_with()
+
+
+class TestBatch(unittest.TestCase):
+    '''Test acknowledging batches of messages'''
+    def setUp(self):
+        self.connections = [mock.Mock(), mock.Mock()]
+        self.messages = [
+            response.Message(conn, constants.FRAME_TYPE_MESSAGE,
+                struct.pack('>qH16s', 0, 1, b'%16i' % index))
+            for index, conn in enumerate(self.connections * 2)]
+
+    def test_fin_batch(self):
+        '''Finishes with a single write to each connection'''
+        response.fin_batch(self.messages)
+        first, second = self.connections
+        first.fin_many.assert_called_once_with([b'%16i' % 0, b'%16i' % 2])
+        second.fin_many.assert_called_once_with([b'%16i' % 1, b'%16i' % 3])
+        self.assertTrue(all(message.processed for message in self.messages))
+
+    def test_batch_order(self):
+        '''Writes to connections in the order their messages were first seen'''
+        writes = mock.Mock()
+        for index, conn in enumerate(self.connections):
+            conn.fin_many.side_effect = functools.partial(writes, index)
+        response.fin_batch(self.messages[::-1])
+        self.assertEqual(
+            [args[0][0] for args in writes.call_args_list], [1, 0])
+
+    def test_req_batch(self):
+        '''Requeues with a single write to each connection'''
+        response.req_batch(self.messages, 10)
+        first, second = self.connections
+        first.req_many.assert_called_once_with([b'%16i' % 0, b'%16i' % 2], 10)
+        second.req_many.assert_called_once_with([b'%16i' % 1, b'%16i' % 3], 10)
+        self.assertTrue(all(message.processed for message in self.messages))
+
+    def test_req_batch_delay(self):
+        '''Requeues with each message's own delay by default'''
+        response.req_batch(self.messages)
+        self.connections[0].req_many.assert_called_once_with(
+            [b'%16i' % 0, b'%16i' % 2], 60)
+
+    def test_socket_error(self):
+        '''Closes connections that fail, and carries on with the rest'''
+        first, second = self.connections
+        first.fin_many.side_effect = socket.error
+        response.fin_batch(self.messages)
+        first.close.assert_called_with()
+        second.fin_many.assert_called_once_with([b'%16i' % 1, b'%16i' % 3])
+        self.assertEqual(
+            [message.processed for message in self.messages],
+            [False, True, False, True])
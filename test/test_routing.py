@@ -0,0 +1,200 @@
+import mock
+import unittest
+
+from nsq import exceptions
+from nsq import routing
+
+
+def connections(count):
+    '''Some fake connections'''
+    found = []
+    for port in range(count):
+        conn = mock.Mock(host='localhost', port=port)
+        conn.saturated.return_value = False
+        conn.pending_bytes.return_value = 0
+        found.append(conn)
+    return found
+
+
+class TestRouter(unittest.TestCase):
+    '''Test our router base class'''
+    def setUp(self):
+        self.router = routing.Router()
+        self.connections = connections(2)
+
+    def test_membership(self):
+        '''Keeps track of connections as they're added and removed'''
+        for conn in self.connections:
+            self.router.add(conn)
+            self.router.add(conn)
+        self.assertEqual(self.router.members(), self.connections)
+        self.router.remove(self.connections[0])
+        self.router.remove(self.connections[0])
+        self.assertEqual(self.router.members(), self.connections[1:])
+
+    def test_empty(self):
+        '''Raises when there are no connections to choose from'''
+        self.assertRaises(
+            exceptions.ConnectionClosedException, self.router.choose)
+
+    def test_choose(self):
+        '''Not implemented on the base class'''
+        self.router.add(self.connections[0])
+        self.assertRaises(NotImplementedError, self.router.choose)
+
+    def test_get(self):
+        '''Routers can be given by name or instance'''
+        self.assertIsInstance(routing.get(), routing.Random)
+        self.assertIsInstance(routing.get('round_robin'), routing.RoundRobin)
+        self.assertIs(routing.get(self.router), self.router)
+        self.assertRaises(ValueError, routing.get, 'unknown')
+
+
+class TestRandom(unittest.TestCase):
+    '''Test our random router'''
+    def setUp(self):
+        self.router = routing.Random()
+        self.connections = connections(2)
+        for conn in self.connections:
+            self.router.add(conn)
+
+    def test_random(self):
+        '''Chooses all of the connections'''
+        found = set(self.router.choose() for _ in range(50))
+        self.assertEqual(found, set(self.connections))
+
+    def test_unsaturated(self):
+        '''Avoids saturated connections'''
+        saturated, unsaturated = self.connections
+        saturated.saturated.return_value = True
+        for _ in range(20):
+            self.assertEqual(self.router.choose(), unsaturated)
+
+
+class TestRoundRobin(unittest.TestCase):
+    '''Test our round-robin router'''
+    def setUp(self):
+        self.router = routing.RoundRobin()
+        self.connections = connections(3)
+        for conn in self.connections:
+            self.router.add(conn)
+
+    def test_turns(self):
+        '''Takes turns'''
+        found = [self.router.choose() for _ in range(6)]
+        self.assertEqual(found, self.connections * 2)
+
+    def test_saturated(self):
+        '''Skips saturated connections'''
+        self.connections[1].saturated.return_value = True
+        found = [self.router.choose() for _ in range(3)]
+        self.assertNotIn(self.connections[1], found)
+
+    def test_all_saturated(self):
+        '''Still takes turns when all connections are saturated'''
+        for conn in self.connections:
+            conn.saturated.return_value = True
+        found = [self.router.choose() for _ in range(3)]
+        self.assertEqual(found, self.connections)
+
+
+class TestLeastPending(unittest.TestCase):
+    '''Test our least-pending router'''
+    def test_least_pending(self):
+        '''Chooses the connection with the fewest pending bytes'''
+        router = routing.LeastPending()
+        conns = connections(3)
+        for conn, pending in zip(conns, (100, 10, 1000)):
+            conn.pending_bytes.return_value = pending
+            router.add(conn)
+        self.assertEqual(router.choose(), conns[1])
+
+
+class TestLatency(unittest.TestCase):
+    '''Test our latency-weighted router'''
+    def setUp(self):
+        self.router = routing.Latency(alpha=0.5)
+        self.connections = connections(2)
+        for conn in self.connections:
+            self.router.add(conn)
+
+    def test_moving_average(self):
+        '''Keeps a moving average of latency'''
+        conn = self.connections[0]
+        self.router.acked(conn, 1.0)
+        self.router.acked(conn, 2.0)
+        self.assertEqual(self.router.latency(conn), 1.5)
+
+    def test_removed(self):
+        '''Forgets about connections that are removed'''
+        conn = self.connections[0]
+        self.router.acked(conn, 1.0)
+        self.router.remove(conn)
+        self.router.acked(conn, 1.0)
+        self.assertEqual(self.router.latency(conn), None)
+
+    def test_weighted(self):
+        '''Prefers connections with lower latency'''
+        fast, slow = self.connections
+        self.router.acked(fast, 0.001)
+        self.router.acked(slow, 1.0)
+        found = [self.router.choose() for _ in range(100)]
+        self.assertGreater(found.count(fast), 90)
+
+    def test_unmeasured(self):
+        '''Connections without measurements still get chosen'''
+        self.router.acked(self.connections[0], 1.0)
+        found = set(self.router.choose() for _ in range(50))
+        self.assertEqual(found, set(self.connections))
+
+
+class TestConsistentHash(unittest.TestCase):
+    '''Test our consistent-hashing router'''
+    def setUp(self):
+        self.router = routing.ConsistentHash()
+        self.connections = connections(4)
+        for conn in self.connections:
+            self.router.add(conn)
+
+    def test_affinity(self):
+        '''Chooses the same connection for the same key'''
+        for key in (b'foo', 'bar', 12345):
+            conn = self.router.choose(key)
+            for _ in range(10):
+                self.assertEqual(self.router.choose(key), conn)
+
+    def test_spread(self):
+        '''Keys are spread across connections'''
+        found = set(self.router.choose(b'%i' % i) for i in range(100))
+        self.assertEqual(found, set(self.connections))
+
+    def test_removed(self):
+        '''Only keys on a removed connection move'''
+        keys = [b'%i' % i for i in range(100)]
+        before = dict((key, self.router.choose(key)) for key in keys)
+        removed = self.connections[0]
+        self.router.remove(removed)
+        for key in keys:
+            if before[key] is not removed:
+                self.assertEqual(self.router.choose(key), before[key])
+            else:
+                self.assertNotEqual(self.router.choose(key), removed)
+
+    def test_connections_per_nsqd(self):
+        '''Keys go to the same nsqd, spread across its connections'''
+        extra = mock.Mock(host='localhost', port=0)
+        before = dict((b'%i' % i, self.router.choose(b'%i' % i)) for i in range(100))
+        self.router.add(extra)
+        chosen = set()
+        for key, conn in before.items():
+            now = self.router.choose(key)
+            self.assertEqual(now.port, conn.port)
+            self.assertEqual(self.router.choose(key), now)
+            chosen.add(now)
+        self.assertIn(extra, chosen)
+        self.assertIn(self.connections[0], chosen)
+
+    def test_no_key(self):
+        '''Messages without a key may go anywhere'''
+        found = set(self.router.choose() for _ in range(50))
+        self.assertEqual(found, set(self.connections))
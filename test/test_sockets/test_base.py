@@ -41,6 +41,21 @@ class TestSocketWrapper(unittest.TestCase):
         '''SocketWrapper.recv_into saises NotImplementedError'''
         self.assertRaises(NotImplementedError, self.wrapped.recv_into, 'foo', 5)
 
+    def test_recv_into_uses_recv(self):
+        '''SocketWrapper.recv_into copies the result of recv into the buffer'''
+        buff = bytearray(10)
+        with mock.patch.object(self.wrapped, 'recv', return_value=b'hello'):
+            self.assertEqual(self.wrapped.recv_into(buff, 5), 5)
+            self.wrapped.recv.assert_called_with(5, 0)
+        self.assertEqual(buff[:5], b'hello')
+
+    def test_recv_into_default_size(self):
+        '''SocketWrapper.recv_into reads up to the size of the buffer'''
+        buff = bytearray(10)
+        with mock.patch.object(self.wrapped, 'recv', return_value=b'') as recv:
+            self.wrapped.recv_into(buff)
+            recv.assert_called_with(10, 0)
+
     def test_inheritance_overrides(self):
         '''Classes that inherit can override things like accept'''
         class Foo(SocketWrapper):
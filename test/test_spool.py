@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nsq import exceptions
+from nsq.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+    '''Tests for our on-disk spool'''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = Spool(self.path, segment_bytes=1024, max_bytes=4096)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.path)
+
+    def reopen(self):
+        '''Close our spool and open it again'''
+        self.spool.close()
+        self.spool = Spool(self.path, segment_bytes=1024, max_bytes=4096)
+
+    def segments(self):
+        '''The names of our segment files'''
+        return sorted(name for name in os.listdir(self.path) if '.spool' in name)
+
+    def test_empty(self):
+        '''Reads nothing from an empty spool'''
+        self.assertTrue(self.spool.empty())
+        _, topic, messages = self.spool.read()
+        self.assertEqual(messages, [])
+
+    def test_read(self):
+        '''Reads back what was appended'''
+        self.spool.extend(b'topic', [b'a', b'b'])
+        self.spool.append(b'topic', b'c')
+        _, topic, messages = self.spool.read()
+        self.assertEqual(topic, b'topic')
+        self.assertEqual(messages, [b'a', b'b', b'c'])
+
+    def test_read_per_topic(self):
+        '''Reads stop before a different topic'''
+        self.spool.append(b'foo', b'a')
+        self.spool.append(b'bar', b'b')
+        position, topic, messages = self.spool.read()
+        self.assertEqual((topic, messages), (b'foo', [b'a']))
+        self.spool.commit(position)
+        _, topic, messages = self.spool.read()
+        self.assertEqual((topic, messages), (b'bar', [b'b']))
+
+    def test_read_limits(self):
+        '''Reads are limited by count and size'''
+        self.spool.extend(b'topic', [b'x' * 10] * 10)
+        _, _, messages = self.spool.read(max_count=3)
+        self.assertEqual(len(messages), 3)
+        _, _, messages = self.spool.read(max_bytes=50)
+        self.assertEqual(len(messages), 2)
+
+    def test_uncommitted(self):
+        '''Reads are repeated until committed'''
+        self.spool.append(b'topic', b'a')
+        self.spool.read()
+        position, _, messages = self.spool.read()
+        self.assertEqual(messages, [b'a'])
+        self.spool.commit(position)
+        self.assertTrue(self.spool.empty())
+        self.assertEqual(self.spool.read()[2], [])
+
+    def test_rotation(self):
+        '''Rotates through segments, deleting them once read'''
+        self.spool.extend(b'topic', [b'x' * 100] * 20)
+        self.assertEqual(len(self.segments()), 3)
+        position, _, messages = self.spool.read()
+        self.assertEqual(len(messages), 20)
+        self.spool.commit(position)
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_full(self):
+        '''Raises when there's no more room'''
+        self.assertRaises(exceptions.SpoolFullException,
+            self.spool.extend, b'topic', [b'x' * 100] * 100)
+        self.assertRaises(exceptions.SpoolFullException,
+            self.spool.append, b'topic', b'x' * 2048)
+
+    def test_full_atomic(self):
+        '''Appends none of a batch that doesn't fit'''
+        self.spool.extend(b'topic', [b'x' * 100] * 10)
+        size = self.spool.size()
+        self.assertRaises(exceptions.SpoolFullException,
+            self.spool.extend, b'topic', [b'x' * 100] * 40)
+        self.assertRaises(exceptions.SpoolFullException,
+            self.spool.extend, b'topic', [b'a', b'x' * 2048])
+        self.assertEqual(self.spool.size(), size)
+        self.assertEqual(len(self.segments()), 2)
+        _, _, messages = self.spool.read()
+        self.assertEqual(messages, [b'x' * 100] * 10)
+
+    def test_recover(self):
+        '''Picks up where it left off after being reopened'''
+        self.spool.extend(b'topic', [b'x' * 100] * 12)
+        position, _, _ = self.spool.read(max_count=5)
+        self.spool.commit(position)
+        self.reopen()
+        self.spool.append(b'topic', b'y')
+        _, _, messages = self.spool.read()
+        self.assertEqual(messages, [b'x' * 100] * 7 + [b'y'])
+
+    def test_torn_write(self):
+        '''Ignores a record that was only partly written'''
+        self.spool.extend(b'topic', [b'a', b'b'])
+        self.spool.close()
+        path = os.path.join(self.path, self.segments()[0])
+        with open(path, 'r+b') as fout:
+            # Corrupt the last byte of the second record
+            fout.seek(2 * (Spool.HEADER.size + Spool.TOPIC.size + 6) - 1)
+            fout.write(b'!')
+        self.spool = Spool(self.path, segment_bytes=1024, max_bytes=4096)
+        self.spool.append(b'topic', b'c')
+        _, _, messages = self.spool.read()
+        self.assertEqual(messages, [b'a', b'c'])
@@ -0,0 +1,136 @@
+import asyncio
+import mock
+import unittest
+
+from nsq import constants
+from nsq import exceptions
+
+from common.fakensqd import FakeNsqd, message
+
+try:
+    from tornado.testing import AsyncTestCase, gen_test
+    from nsq.tornado import Connection, Producer, Reader
+except ImportError:  # pragma: no cover
+    AsyncTestCase = unittest.TestCase
+    gen_test = lambda function: function
+    Connection = None
+
+
+@unittest.skipIf(Connection is None, 'tornado is not installed')
+class TestTornado(AsyncTestCase):
+    '''Tests for the tornado client against a fake nsqd'''
+    @gen_test
+    async def test_connect(self):
+        '''Connects and identifies over an IOStream'''
+        nsqd = await FakeNsqd().start()
+        try:
+            async with Producer([nsqd.address]) as producer:
+                conn = producer.connections()[0]
+                self.assertIsInstance(conn, Connection)
+                self.assertTrue(conn.alive())
+                self.assertEqual(conn.max_rdy_count, 2500)
+        finally:
+            await nsqd.stop()
+
+    @gen_test
+    async def test_pub(self):
+        '''Waits for confirmation of publishes'''
+        nsqd = await FakeNsqd().start()
+        try:
+            async with Producer([nsqd.address]) as producer:
+                self.assertEqual(await producer.pub(b'topic', b'hello'), b'OK')
+                with self.assertRaises(exceptions.BadTopicException):
+                    await producer.pub(b'bad', b'hello')
+            self.assertEqual(nsqd.published, [b'hello'])
+        finally:
+            await nsqd.stop()
+
+    @gen_test
+    async def test_iterate(self):
+        '''Can iterate over messages'''
+        nsqd = await FakeNsqd().start()
+        nsqd.messages = [message(b'%i' % i, b'%i' % i) for i in range(3)]
+        try:
+            bodies = []
+            async with Reader(b'topic', b'channel',
+                nsqd_tcp_addresses=[nsqd.address]) as reader:
+                async for msg in reader:
+                    await msg.fin()
+                    bodies.append(msg.body)
+                    if len(bodies) == 3:
+                        break
+            self.assertEqual(bodies, [b'0', b'1', b'2'])
+        finally:
+            await nsqd.stop()
+
+    @gen_test
+    async def test_handler(self):
+        '''Invokes callbacks and coroutines with messages, finishing them'''
+        for asynchronous in (False, True):
+            nsqd = await FakeNsqd().start()
+            nsqd.messages = [message(b'%i' % i, b'%i' % i) for i in range(3)]
+            bodies = []
+            if asynchronous:
+                async def handler(msg):
+                    bodies.append(msg.body)
+            else:
+                handler = lambda msg: bodies.append(msg.body)
+            try:
+                reader = await Reader(b'topic', b'channel',
+                    message_handler=handler,
+                    nsqd_tcp_addresses=[nsqd.address]).start()
+                while len(bodies) < 3:
+                    await self.sleep()
+                await reader.close()
+                self.assertEqual(bodies, [b'0', b'1', b'2'])
+                names = [command[0] for command in nsqd.commands]
+                self.assertEqual(names.count(constants.FIN), 3)
+            finally:
+                await nsqd.stop()
+
+    @gen_test
+    async def test_handler_exception(self):
+        '''Requeues messages when the handler raises an exception'''
+        nsqd = await FakeNsqd().start()
+        nsqd.messages = [message(b'0', b'0')]
+        try:
+            handler = mock.Mock(side_effect=ValueError('boom'))
+            with mock.patch('nsq.tornado.reader.logger'):
+                reader = await Reader(b'topic', b'channel',
+                    message_handler=handler,
+                    nsqd_tcp_addresses=[nsqd.address]).start()
+                while constants.REQ not in [c[0] for c in nsqd.commands]:
+                    await self.sleep()
+            await reader.close()
+        finally:
+            await nsqd.stop()
+
+    @gen_test
+    async def test_closed(self):
+        '''Notices when the stream is closed'''
+        nsqd = await FakeNsqd().start()
+        producer = await Producer([nsqd.address]).start()
+        conn = producer.connections()[0]
+        await nsqd.stop()
+        while conn.alive():
+            await self.sleep()
+        with self.assertRaises(exceptions.ConnectionClosedException):
+            await producer.pub(b'topic', b'hello')
+        await producer.close()
+
+    def test_flow_control(self):
+        '''Pauses writing once too much is unflushed, until it's flushed'''
+        conn = Connection('localhost', 4150, high_water=10, low_water=5)
+        conn._transport = mock.Mock()
+        conn._write(b'x' * 11)
+        self.assertTrue(conn._paused)
+        future = conn._transport.write.return_value
+        callback = future.add_done_callback.call_args[0][0]
+        future.cancelled.return_value = False
+        callback(future)
+        self.assertFalse(conn._paused)
+        self.assertEqual(conn._unflushed, 0)
+
+    async def sleep(self):
+        '''Yield to the IOLoop for a moment'''
+        await asyncio.sleep(0.01)
@@ -0,0 +1,167 @@
+import mock
+import socket
+import struct
+import time
+import unittest
+
+from nsq import connection
+from nsq import constants
+from nsq import response
+from nsq import touch
+
+
+def mock_connection(msg_timeout=10.0):
+    '''A fake connection'''
+    return mock.Mock(msg_timeout=msg_timeout, in_flight=0, **{
+        'alive.return_value': True})
+
+
+def message(conn, index):
+    '''A message received on a connection'''
+    return response.Message(conn, constants.FRAME_TYPE_MESSAGE,
+        struct.pack('>qH16s', 0, 1, b'%16i' % index))
+
+
+class TestToucher(unittest.TestCase):
+    '''Tests for touching in-flight messages'''
+    def setUp(self):
+        self.toucher = touch.Toucher(fraction=0.5)
+        self.conn = mock_connection()
+        self.now = 1000.0
+
+    def track(self, *messages):
+        '''Track messages as of now'''
+        with mock.patch('nsq.touch.time.time', return_value=self.now):
+            for message in messages:
+                self.toucher.track(message)
+
+    def touch(self, elapsed):
+        '''Touch whatever is due after some time has passed'''
+        self.now += elapsed
+        return self.toucher.touch(self.now)
+
+    def test_not_due(self):
+        '''Doesn't touch messages before fraction of msg_timeout'''
+        self.track(message(self.conn, 0))
+        self.assertEqual(self.touch(4.0), 0)
+        self.assertFalse(self.conn.touch_many.called)
+
+    def test_due(self):
+        '''Touches messages after fraction of msg_timeout'''
+        self.track(message(self.conn, 0))
+        self.assertEqual(self.touch(5.0), 1)
+        self.conn.touch_many.assert_called_once_with([b'%16i' % 0])
+
+    def test_coalesced(self):
+        '''Touches due around the same time go out in a single write'''
+        first = message(self.conn, 0)
+        self.track(first)
+        self.now += 0.2
+        self.track(message(self.conn, 1))
+        self.assertEqual(self.touch(4.9), 2)
+        self.conn.touch_many.assert_called_once_with(
+            [b'%16i' % 0, b'%16i' % 1])
+
+    def test_per_connection(self):
+        '''Each connection is touched separately, at its own msg_timeout'''
+        other = mock_connection(msg_timeout=60.0)
+        self.track(message(self.conn, 0), message(other, 1))
+        self.touch(5.0)
+        self.assertFalse(other.touch_many.called)
+        self.touch(25.0)
+        other.touch_many.assert_called_once_with([b'%16i' % 1])
+
+    def test_repeated(self):
+        '''Messages keep being touched until they're handled'''
+        msg = message(self.conn, 0)
+        self.track(msg)
+        self.touch(5.0)
+        self.touch(5.0)
+        self.assertEqual(self.conn.touch_many.call_count, 2)
+        msg.fin()
+        self.assertEqual(self.touch(5.0), 0)
+        self.assertEqual(self.toucher.pending(self.conn), 0)
+
+    def test_default_msg_timeout(self):
+        '''Assumes nsqd's default msg_timeout when it's unknown'''
+        self.conn.msg_timeout = None
+        self.assertEqual(self.toucher.interval(self.conn), 30.0)
+
+    def test_compacts(self):
+        '''Handled messages don't pile up'''
+        for index in range(200):
+            msg = message(self.conn, index)
+            self.track(msg)
+            msg.fin()
+        self.assertLess(self.toucher.pending(self.conn), 100)
+
+    def test_forget(self):
+        '''Forgets messages on connections that are closed or dead'''
+        other = mock_connection()
+        self.track(message(self.conn, 0), message(other, 1))
+        self.toucher.forget(self.conn)
+        other.alive.return_value = False
+        self.assertEqual(self.touch(5.0), 0)
+        self.assertEqual(self.toucher.pending(other), 0)
+
+    def test_socket_error(self):
+        '''Closes connections that can't be written to'''
+        self.conn.touch_many.side_effect = socket.error
+        self.track(message(self.conn, 0))
+        with mock.patch('nsq.touch.logger'):
+            self.assertEqual(self.touch(5.0), 0)
+        self.conn.close.assert_called_with()
+
+    def test_thread(self):
+        '''Runs in the background until stopped'''
+        self.conn.msg_timeout = 0.02
+        self.toucher.start()
+        try:
+            self.toucher.track(message(self.conn, 0))
+            deadline = time.time() + 5
+            while self.conn.touch_many.call_count < 2 and time.time() < deadline:
+                time.sleep(0.001)
+        finally:
+            self.toucher.stop()
+            self.toucher.join()
+        self.assertGreaterEqual(self.conn.touch_many.call_count, 2)
+
+
+class TestToucherSocketPair(unittest.TestCase):
+    '''Tests for touching messages over real sockets'''
+    def setUp(self):
+        with mock.patch.object(connection.Connection, 'connect'):
+            self.conn = connection.Connection('localhost', 1)
+        self.conn._reset()
+        self.conn._socket, self.server = socket.socketpair()
+        self.conn.setblocking(0)
+        self.conn.msg_timeout = 10.0
+        self.server.settimeout(5)
+        self.toucher = touch.Toucher(fraction=0.5)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+
+    def test_sends(self):
+        '''Touches are sent without waiting for the read loop to flush'''
+        with mock.patch('nsq.touch.time.time', return_value=1000.0):
+            self.toucher.track(message(self.conn, 0))
+            self.toucher.track(message(self.conn, 1))
+        self.assertEqual(self.toucher.touch(1005.0), 2)
+        self.assertEqual(list(self.conn.pending()), [])
+        expected = b'TOUCH %16i\nTOUCH %16i\n' % (0, 1)
+        received = b''
+        while len(received) < len(expected):
+            received += self.server.recv(1024)
+        self.assertEqual(received, expected)
+
+    def test_coalesced_acks(self):
+        '''Touches are sent even when acks are being coalesced'''
+        self.conn._coalesce_acks = True
+        self.conn._ack_max_count = 100
+        self.conn._ack_max_bytes = 65536
+        with mock.patch('nsq.touch.time.time', return_value=1000.0):
+            self.toucher.track(message(self.conn, 0))
+        self.toucher.touch(1005.0)
+        self.assertEqual(self.server.recv(1024), b'TOUCH %16i\n' % 0)
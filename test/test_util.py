@@ -73,3 +73,21 @@ class TestDistribute(unittest.TestCase):
         '''Distribute should always return integers'''
         parts = tuple(util.distribute(1000, (1, 2, 3)))
         self.assertEqual(parts, ((333, 1), (333, 2), (334, 3)))
+
+
+class TestApportion(unittest.TestCase):
+    '''Test apportioning a total by weight'''
+    def test_sum(self):
+        '''The parts always add up to the total'''
+        for total in range(50):
+            for weights in ((1,), (1, 1, 1), (3, 1), (0.5, 2.5, 7)):
+                self.assertEqual(sum(util.apportion(total, weights)), total)
+
+    def test_proportional(self):
+        '''Parts are in proportion to their weights'''
+        self.assertEqual(util.apportion(100, (3, 1)), [75, 25])
+        self.assertEqual(util.apportion(10, (1, 1, 1)), [3, 3, 4])
+
+    def test_no_weight(self):
+        '''Nothing is apportioned without any weight'''
+        self.assertEqual(util.apportion(10, (0, 0)), [0, 0])